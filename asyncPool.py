@@ -0,0 +1,139 @@
+######  concurrency helpers shared by the network-bound stages ######
+#
+# The HTTP calls themselves stay on requests (pooled keep-alive Sessions run in
+# a thread pool); asyncio or plain worker threads schedule them, bound
+# concurrency and rate limit them.
+
+import asyncio, random, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class TokenBucket:
+    """
+    Async token bucket: refills at `rate` tokens per second up to `capacity`.
+    acquire(n) waits until n tokens are available, so callers can also use it
+    for weighted budgets (e.g. tokens per minute with rate = tpm / 60).
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, tokens: float = 1):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # A request larger than the bucket can never fit; let it through once the bucket is full
+        tokens = min(tokens, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+class SyncTokenBucket:
+    """
+    Thread-safe token bucket for worker threads: acquire(n) blocks until n
+    tokens are available. Refills at `rate` tokens per second up to `capacity`.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens: float = 1):
+        tokens = min(tokens, self.capacity)
+        with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                time.sleep((tokens - self.tokens) / self.rate)
+
+    def wait_time(self, tokens: float = 1) -> float:
+        """Seconds until acquire(tokens) would go through without blocking (0 if it would now)."""
+        tokens = min(tokens, self.capacity)
+        with self._lock:
+            self._refill()
+            return max(0.0, (tokens - self.tokens) / self.rate)
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        tokens = min(tokens, self.capacity)
+        with self._lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return True
+            return False
+
+
+def pooled_session(pool_size: int) -> requests.Session:
+    """requests.Session whose connection pool holds pool_size keep-alive connections per host."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def retry_after_seconds(response) -> float:
+    """Seconds from a Retry-After header (delta-seconds form), None if absent or unparsable."""
+    value = response.headers.get('Retry-After') if response is not None else None
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class BlockingPool:
+    """Thread pool that runs blocking calls (requests) for coroutines."""
+
+    def __init__(self, workers: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+
+    async def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, lambda: fn(*args, **kwargs))
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+
+
+def run_async(coro):
+    """
+    asyncio.run() that also works inside Jupyter/Colab, where an event loop is
+    already running in the main thread: the coroutine then runs in a worker thread.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coro)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coro).result()
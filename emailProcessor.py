@@ -1,154 +1,721 @@
 ######  this is a utility file to process emails ######
 
 # download libraries
-import ast, re, json, time, os, requests, datetime, time, spacy
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+import ast, re, json, time, os, requests, datetime, time, spacy, random, zlib, hashlib, copy, platform, uuid
+from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
+from sklearn.pipeline import make_pipeline
+from sklearn.linear_model import LogisticRegression
+import numpy as np
+import joblib
+from scipy import sparse
+from joblib import Parallel, delayed
 from typing import Dict, Any, List
 from pathlib import Path
-from collections import Counter
-from google.colab import drive
+from collections import Counter, OrderedDict
+from recordStream import iter_records, iter_cases, RecordWriter
+from rxnormResolvers import RxNormCache, RxNavClient, OfflineRxNormResolver, DrugDictionary, MISS, RXNAV_BASE_URL, RXNAV_RATE_LIMIT, loose_normalize
+from asyncPool import run_async, SyncTokenBucket, pooled_session, retry_after_seconds, backoff_delay
+from llmClient import LLMResponseCache, LLMError, CircuitBreaker, LLMDispatcher, classify_status, OPENROUTER_URL
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+
+# Helper function to extract ALL bodies recursively
+def extract_all_bodies(email_obj):
+    """Extract all email bodies including forwarded messages"""
+    all_bodies = []
+
+    if isinstance(email_obj, list):
+        for email in email_obj:
+            all_bodies.extend(extract_all_bodies(email))
+
+    elif isinstance(email_obj, dict):
+        # Get this email's body
+        body = email_obj.get('body', '')
+        if body and len(body.strip()) > 0:
+            all_bodies.append(body)
+
+        # Recursively get forwarded message bodies
+        if 'forwardedMessage' in email_obj:
+            all_bodies.extend(extract_all_bodies(email_obj['forwardedMessage']))
+
+    return all_bodies
+
+# class to store each distinct email body once, keyed by a hash of its normalized text
+class BodyStore:
+  """
+  Content-addressed store of email bodies. The same quoted/forwarded message
+  appears in many cases; stages add every body here, compute on each unique
+  body once (get_or_compute) and fan the result back out to every copy.
+  """
+
+  def __init__(self):
+    self.bodies = {}   # key -> body text (first copy seen)
+    self.results = {}  # (stage, key) -> result
+    self.occurrences = 0
+
+  @staticmethod
+  def normalize(body: str) -> str:
+    # Drop quote markers and collapse whitespace so re-quoted copies match
+    lines = (re.sub(r'^(\s*>)+', '', line) for line in body.splitlines())
+    return re.sub(r'\s+', ' ', ' '.join(lines)).strip()
+
+  @classmethod
+  def key(cls, body: str) -> str:
+    return hashlib.sha1(cls.normalize(body).encode('utf-8')).hexdigest()
+
+  def add(self, body: str) -> str:
+    key = self.key(body)
+    self.bodies.setdefault(key, body)
+    self.occurrences += 1
+    return key
+
+  def get_or_compute(self, stage: str, key: str, compute):
+    if (stage, key) not in self.results:
+      self.results[(stage, key)] = compute(self.bodies[key])
+    return self.results[(stage, key)]
+
+  def combined(self, keys: list) -> str:
+    return ' '.join(self.bodies[k] for k in keys)
+
+  def summary(self) -> str:
+    return f"{len(self.bodies)} unique bodies out of {self.occurrences} ({self.occurrences - len(self.bodies)} duplicates)"
+
+# function to build item TF-IDF vectors while tokenizing each unique body once
+def vectorize_item_bodies(store: BodyStore, item_keys: list):
+  """
+  Equivalent to TfidfVectorizer(stop_words='english').fit_transform on the
+  joined bodies of each item: term counts are computed per unique body and
+  summed per item, then IDF-weighted. Returns (fitted pipeline, tfidf matrix).
+  """
+  keys = list(store.bodies)
+  column = {k: c for c, k in enumerate(keys)}
+  counter = CountVectorizer(stop_words='english', lowercase=True)
+  body_counts = counter.fit_transform([store.bodies[k] for k in keys])
+
+  rows = [r for r, item in enumerate(item_keys) for _ in item]
+  cols = [column[k] for item in item_keys for k in item]
+  incidence = sparse.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(len(item_keys), len(keys)))
+  item_counts = (incidence @ body_counts).tocsr()
+
+  transformer = TfidfTransformer()
+  tfidf = transformer.fit_transform(item_counts)
+  return make_pipeline(counter, transformer), tfidf
+
+# Helper for the sparse similarity engine: pairs above threshold for one row block.
+# Thresholding, ranking and top_k run on the block's CSR arrays as a whole, so the
+# worker threads spend their time in numpy/scipy rather than in per-row Python
+def _similar_pairs_block(tfidf, start: int, end: int, similarity_threshold: float, top_k: int = None):
+    # TfidfVectorizer rows are L2-normalised, so the dot product is the cosine similarity
+    block = (tfidf[start:end] @ tfidf.T).tocsr()
+    rows = np.repeat(np.arange(end - start), np.diff(block.indptr))
+    keep = (block.data > similarity_threshold) & (block.indices != rows + start)
+    rows, cols, vals = rows[keep], block.indices[keep], block.data[keep]
+
+    # Same order as the dense version: rounded score desc, ties by column
+    scores = _round_scores(vals)
+    order = np.lexsort((cols, -scores, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+    counts = np.bincount(rows, minlength=end - start)
+    if top_k is not None:
+        rank = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+        keep = rank < top_k
+        rows, cols, scores = rows[keep], cols[keep], scores[keep]
+        counts = np.minimum(counts, top_k)
+
+    bounds = np.concatenate(([0], np.cumsum(counts))).tolist()
+    pairs = list(zip(cols.tolist(), scores.tolist()))
+    return [(start + r, pairs[bounds[r]:bounds[r + 1]]) for r in range(end - start)]
+
+# Helper: scores rounded to 4 decimals like the dense version's round(float(v), 4).
+# np.round rounds v * 1e4 to even, so the rare values within float error of a
+# half step are redone with round() to keep the output identical
+def _round_scores(vals):
+    scores = np.round(vals, 4)
+    halfway = np.flatnonzero(np.abs(vals * 1e4 % 1 - 0.5) < 1e-6)
+    if len(halfway):
+        scores[halfway] = [round(v, 4) for v in vals[halfway].tolist()]
+    return scores
+
+# Helper to order one row's matches: score desc, ties by column (same as the dense version)
+def _rank_row_pairs(cols, vals, top_k: int = None):
+    order = np.argsort(cols, kind='stable')
+    row_pairs = sorted(
+        ((int(j), round(float(v), 4)) for j, v in zip(cols[order], vals[order])),
+        key=lambda x: x[1], reverse=True
+    )
+    if top_k is not None:
+        row_pairs = row_pairs[:top_k]
+    return row_pairs
+
+# function to find cross references straight from the sparse TF-IDF matrix
+def sparse_cross_references(tfidf, ids: list, similarity_threshold: float, top_k: int = None,
+                            block_size: int = 1000, n_jobs: int = 1):
+    """
+    Return {id: [{"cid", "score"}, ...]} for every pair above similarity_threshold
+    (optionally only the top_k per row), without building the dense N x N matrix.
+    Row blocks of block_size are multiplied against the matrix in n_jobs threads.
+    """
+    tfidf = tfidf.tocsr()
+    blocks = [(start, min(start + block_size, len(ids))) for start in range(0, len(ids), block_size)]
+    results = Parallel(n_jobs=n_jobs, prefer="threads")(
+        delayed(_similar_pairs_block)(tfidf, start, end, similarity_threshold, top_k)
+        for start, end in blocks
+    )
 
-# function to add cross reference email Ids
-def add_cross_references_emailIds(input_file: str,output_file: str,similarity_threshold: float):
-    """
-    Add cross-references email ids using email bodies
-    """   
-    # Load data
-    if input_file.endswith('.jsonl'):
-        with open(input_file, 'r', encoding='utf-8') as f:
-            data = [json.loads(line) for line in f]
+    crossRefIds = {}
+    for block_pairs in results:
+        for i, row_pairs in block_pairs:
+            crossRefIds[ids[i]] = [{"cid": ids[j], "score": score} for j, score in row_pairs]
+    return crossRefIds
+
+# MinHash / LSH near-duplicate search, for corpora too large even for sparse exact cosine
+MINHASH_PRIME = (1 << 31) - 1
+
+def minhash_signatures(token_lists: list, num_perm: int = 128, shingle_size: int = 1, seed: int = 42):
+    """
+    MinHash signatures over word shingles, one row per document.
+    Documents with no tokens get an all-MINHASH_PRIME row and are ignored by LSH.
+    """
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MINHASH_PRIME, size=num_perm, dtype=np.uint64)
+    b = rng.integers(0, MINHASH_PRIME, size=num_perm, dtype=np.uint64)
+    signatures = np.full((len(token_lists), num_perm), MINHASH_PRIME, dtype=np.uint64)
+    for d, tokens in enumerate(token_lists):
+        if len(tokens) >= shingle_size:
+            shingles = {' '.join(tokens[k:k + shingle_size]) for k in range(len(tokens) - shingle_size + 1)}
+        else:
+            shingles = {' '.join(tokens)} if tokens else set()
+        if not shingles:
+            continue
+        x = np.fromiter((zlib.crc32(sh.encode('utf-8')) % MINHASH_PRIME for sh in shingles),
+                        dtype=np.uint64, count=len(shingles))
+        signatures[d] = ((a[:, None] * x[None, :] + b[:, None]) % MINHASH_PRIME).min(axis=1)
+    return signatures
+
+def lsh_band_layout(signatures, tfidf, similarity_threshold: float, max_candidates_per_item: float = 100,
+                    sample_rows: int = 200, sample_pairs: int = 5000, seed: int = 42):
+    """
+    (bands, rows, expected recall) for a TF-IDF cosine threshold. A pair whose
+    signatures agree on a fraction J of positions shares a band with probability
+    1 - (1 - J ** rows) ** bands. J is sampled for random pairs (the background,
+    high in corpora full of boilerplate words) and for exact pairs above the
+    threshold from sample_rows rows. Layouts whose background rate would exceed
+    max_candidates_per_item candidates per item (so candidates stay linear in the
+    number of items) are ruled out; among the rest, the one with the fewest
+    candidates that still catches 95% of what the best one catches wins.
+    """
+    n, num_perm = signatures.shape
+    max_rate = min(1.0, max_candidates_per_item / max(1, n - 1))
+    rng = np.random.default_rng(seed)
+    non_empty = np.flatnonzero((signatures != MINHASH_PRIME).any(axis=1))
+    if len(non_empty) < 2:
+        return 1, num_perm, 1.0
+
+    def agreement(i, j):
+        keep = i != j
+        return (signatures[i[keep]] == signatures[j[keep]]).mean(axis=1)
+
+    background = agreement(*rng.choice(non_empty, size=(2, sample_pairs)))
+    pos_i, pos_j = [], []
+    for i in rng.choice(non_empty, size=min(sample_rows, len(non_empty)), replace=False):
+        sims = (tfidf[i] @ tfidf.T).tocsr()
+        close = sims.indices[sims.data > similarity_threshold]
+        pos_i.extend([i] * len(close))
+        pos_j.extend(close)
+    positives = agreement(np.array(pos_i, dtype=np.int64), np.array(pos_j, dtype=np.int64))
+    if not len(positives):
+        # no pair above the threshold in the sample: aim at the Jaccard of two equal-size word sets with cosine c
+        positives = np.array([similarity_threshold / (2 - similarity_threshold)])
+
+    layouts = []
+    for rows in range(1, num_perm + 1):
+        for bands in range(1, num_perm // rows + 1):
+            rate = (1 - (1 - background ** rows) ** bands).mean()
+            if rate > max_rate:
+                break # more bands only add candidates
+            layouts.append((rate, bands, rows, (1 - (1 - positives ** rows) ** bands).mean()))
+    if not layouts:
+        return 1, num_perm, float((positives ** num_perm).mean())
+    best_recall = max(layout[3] for layout in layouts)
+    rate, bands, rows, recall = min(layout for layout in layouts if layout[3] >= 0.95 * best_recall)
+    return bands, rows, recall
+
+def lsh_candidate_pairs(signatures, bands: int = 32, rows: int = None, max_bucket_size: int = None):
+    """
+    Candidate pairs (i, j), i < j, that share at least one LSH band bucket, as an (n, 2) int64 array.
+    A bucket larger than max_bucket_size (typically boilerplate shared by thousands of emails:
+    disclaimers, out-of-office replies) is not expanded into all its pairs; each member is only
+    paired with its nearest max_bucket_size - 1 members in corpus order, so the bucket costs
+    O(size * max_bucket_size) instead of O(size^2) and its members keep a partial set of refs.
+    """
+    rows = rows or signatures.shape[1] // bands
+    n = len(signatures)
+    non_empty = np.flatnonzero((signatures != MINHASH_PRIME).any(axis=1))
+    multipliers = np.random.default_rng(0).integers(1, 1 << 62, size=rows, dtype=np.uint64) | np.uint64(1)
+    codes = []
+    capped, largest = 0, 0
+    for band in range(bands):
+        # one 64-bit bucket hash per document; a rare collision only adds a candidate that is scored anyway
+        band_hash = (signatures[non_empty, band * rows:(band + 1) * rows] * multipliers).sum(axis=1)
+        order = np.argsort(band_hash, kind='stable')
+        sorted_hash = band_hash[order]
+        starts = np.flatnonzero(np.r_[True, sorted_hash[1:] != sorted_hash[:-1]])
+        sizes = np.diff(np.r_[starts, len(order)])
+        for start, size in zip(starts[sizes > 1], sizes[sizes > 1]):
+            members = np.sort(non_empty[order[start:start + size]])
+            if max_bucket_size and size > max_bucket_size:
+                capped += 1
+                largest = max(largest, size)
+                for offset in range(1, max(1, (max_bucket_size - 1) // 2) + 1):
+                    codes.append(members[:-offset] * n + members[offset:])
+                continue
+            a, b = np.triu_indices(size, 1)
+            codes.append(members[a] * n + members[b])
+    if capped:
+        print(f"MinHash/LSH: {capped} buckets over {max_bucket_size} items (largest {largest}) "
+              f"paired only with their nearest members")
+    if not codes:
+        return np.zeros((0, 2), dtype=np.int64)
+    codes = np.unique(np.concatenate(codes))
+    return np.stack([codes // n, codes % n], axis=1)
+
+def minhash_cross_references(tfidf, token_lists: list, ids: list, similarity_threshold: float, top_k: int = None,
+                             num_perm: int = 128, bands: int = None, shingle_size: int = 1, score_chunk: int = 100000,
+                             max_candidates_per_item: float = 100, recall_sample: int = 0):
+    """
+    Same output as sparse_cross_references, but exact TF-IDF cosine scores are
+    only computed for the MinHash/LSH candidate pairs. The signatures are over
+    word sets (shingle_size=1) like the TF-IDF bag of words; longer shingles only
+    find much closer matches (near-duplicate text). Unless bands is given, the
+    band layout comes from lsh_band_layout, which keeps the candidates to about
+    max_candidates_per_item per item; no single bucket gives an item more than
+    that many candidates (see lsh_candidate_pairs). When the threshold is so low
+    that such a layout would miss most pairs, a warning suggests mode='tfidf'. recall_sample > 0
+    reports recall against the exact pairs next to the candidate rate.
+    """
+    tfidf = tfidf.tocsr()
+    signatures = minhash_signatures(token_lists, num_perm=num_perm, shingle_size=shingle_size)
+    if bands:
+        rows = num_perm // bands
     else:
-        with open(input_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        bands, rows, expected_recall = lsh_band_layout(signatures, tfidf, similarity_threshold, max_candidates_per_item)
+        if expected_recall < 0.5:
+            print(f"Warning: similarity_threshold {similarity_threshold} is too low for MinHash/LSH on this corpus "
+                  f"(expected recall {expected_recall:.2f} with bounded candidates); use mode='tfidf'")
+    candidates = lsh_candidate_pairs(signatures, bands=bands, rows=rows,
+                                     max_bucket_size=int(max_candidates_per_item) + 1)
+    all_pairs = len(ids) * (len(ids) - 1) // 2
+    print(f"MinHash/LSH ({bands} bands of {rows}): {len(candidates)} candidate pairs for {len(ids)} items "
+          f"({len(candidates) / max(1, all_pairs):.4%} of all pairs)")
+
+    matches = {i: ([], []) for i in range(len(ids))}
+    for start in range(0, len(candidates), score_chunk):
+        chunk = candidates[start:start + score_chunk]
+        scores = np.asarray(tfidf[chunk[:, 0]].multiply(tfidf[chunk[:, 1]]).sum(axis=1)).ravel()
+        for (i, j), score in zip(chunk, scores):
+            if score > similarity_threshold:
+                matches[i][0].append(j)
+                matches[i][1].append(score)
+                matches[j][0].append(i)
+                matches[j][1].append(score)
 
-    # Helper function to extract ALL bodies recursively
-    def extract_all_bodies(email_obj):
-        """Extract all email bodies including forwarded messages"""
-        all_bodies = []
-        
-        if isinstance(email_obj, list):
-            for email in email_obj:
-                all_bodies.extend(extract_all_bodies(email))
-        
-        elif isinstance(email_obj, dict):
-            # Get this email's body
-            body = email_obj.get('body', '')
-            if body and len(body.strip()) > 0:
-                all_bodies.append(body)
-            
-            # Recursively get forwarded message bodies
-            if 'forwardedMessage' in email_obj:
-                all_bodies.extend(extract_all_bodies(email_obj['forwardedMessage']))
-        
-        return all_bodies
+    crossRefIds = {}
+    for i, (cols, vals) in matches.items():
+        row_pairs = _rank_row_pairs(np.array(cols, dtype=np.int64), np.array(vals), top_k)
+        crossRefIds[ids[i]] = [{"cid": ids[j], "score": score} for j, score in row_pairs]
+    if recall_sample:
+        report_minhash_recall(tfidf, ids, crossRefIds, similarity_threshold, sample_size=recall_sample,
+                              candidates=len(candidates))
+    return crossRefIds
+
+def report_minhash_recall(tfidf, ids: list, crossRefIds: dict, similarity_threshold: float,
+                          sample_size: int = 200, seed: int = 42, candidates: int = None):
+    """Recall of the MinHash pairs against exact TF-IDF pairs on a random sample of rows (and the candidate rate, if given)."""
+    tfidf = tfidf.tocsr()
+    rows = sorted(random.Random(seed).sample(range(len(ids)), min(sample_size, len(ids))))
+    exact_total = 0
+    found = 0
+    for i in rows:
+        sims = (tfidf[i] @ tfidf.T).tocsr()
+        exact = {ids[j] for j, v in zip(sims.indices, sims.data) if j != i and v > similarity_threshold}
+        approx = {ref['cid'] for ref in crossRefIds.get(ids[i], [])}
+        exact_total += len(exact)
+        found += len(exact & approx)
+    recall = found / exact_total if exact_total else 1.0
+    scored = ''
+    if candidates is not None:
+        scored = f", {candidates} candidate pairs = {candidates / max(1, len(ids) * (len(ids) - 1) // 2):.4%} of N(N-1)/2"
+    print(f"MinHash recall on {len(rows)} sampled items: {recall:.3f} ({found}/{exact_total} exact pairs found{scored})")
+    return recall
+
+# function to add cross reference email Ids
+def add_cross_references_emailIds(input_file: str,output_file: str,similarity_threshold: float,return_data: bool = False,
+                                  top_k: int = None,n_jobs: int = 1,block_size: int = 1000,
+                                  mode: str = 'tfidf',num_perm: int = 128,bands: int = None,recall_sample: int = 0,
+                                  index_dir: str = None):
+    """
+    Add cross-references email ids using email bodies.
+    The input is streamed twice (bodies first, then the rewrite), so only the
+    bodies are held in memory. Returns (data, crossRefIds) as before, but data is
+    None unless return_data=True collects the written records.
+    mode='tfidf' scores every pair with sparse_cross_references (top_k, n_jobs, block_size);
+    mode='minhash' only scores MinHash/LSH candidates (num_perm, bands; by default the
+    bands are tuned to similarity_threshold) and, with recall_sample > 0, reports its
+    recall against the exact pairs on that many items.
+    With index_dir, the fitted vectorizer and matrix are saved as a CrossReferenceIndex
+    for add_cross_references_incremental.
+    """
+    if mode not in ('tfidf', 'minhash'):
+        raise ValueError(f"Unknown cross-reference mode: {mode!r}")
+
+    store = BodyStore()
+    item_keys, ids = collect_item_bodies(input_file, store)
+    print(f"Body store: {store.summary()}")
+
+    # Calculate similarity (each unique body is tokenized once)
+    vectorizer, tfidf = vectorize_item_bodies(store, item_keys)
+    if index_dir:
+        CrossReferenceIndex(index_dir, vectorizer, tfidf, ids).save()
+    if mode == 'minhash':
+        analyzer = vectorizer[0].build_analyzer()
+        token_lists = [
+            [token for k in keys for token in store.get_or_compute('tokens', k, analyzer)]
+            for keys in item_keys
+        ]
+        crossRefIds = minhash_cross_references(tfidf, token_lists, ids, similarity_threshold, top_k=top_k,
+                                               num_perm=num_perm, bands=bands, recall_sample=recall_sample)
+    else:
+        crossRefIds = sparse_cross_references(tfidf, ids, similarity_threshold, top_k=top_k,
+                                              block_size=block_size, n_jobs=n_jobs)
+ 
+    # Stream the input again, add crossRefInfo and save
+    data = write_cross_references(input_file, output_file, crossRefIds, return_data=return_data)
+    
+    print(f"Cross-references added to {len(ids)} items!")
     
-    # Extract texts and IDs    
-    texts = []
+    return data, crossRefIds
+
+# Helper: first pass over a file, body-store keys and id of every item with bodies
+def collect_item_bodies(input_file: str, store: BodyStore):
+    item_keys = []
     ids = []
-    id_to_item_map = {}
     items_with_no_bodies = []
     
-    for item in data:
-        if 'output' in item and isinstance(item['output'], str):
-            try:
-                output_obj = json.loads(item['output'])
-            except:
-                output_obj = item
-        else:
-            output_obj = item.get('output', item)
-        
+    for item, output_obj in iter_cases(input_file):
         # Get hasPart
         has_part = output_obj.get('hasPart')
         
         if has_part:
             all_bodies = extract_all_bodies(has_part)
             if all_bodies:
-                combined_body = ' '.join(all_bodies)
-                
-                item_id = item.get('email_id', len(texts))
-                texts.append(combined_body)
+                item_id = item.get('email_id', len(ids))
+                item_keys.append([store.add(body) for body in all_bodies])
                 ids.append(item_id)
-                id_to_item_map[item_id] = item
             else:
                 items_with_no_bodies.append(item.get('email_id'))
         else:
             items_with_no_bodies.append(item.get('email_id'))
     
-    print(f"Extracted {len(texts)} items with email bodies")
+    print(f"Extracted {len(ids)} items with email bodies")
     if items_with_no_bodies:
       print(f"Skipped {len(items_with_no_bodies)} items without bodies: {items_with_no_bodies}\n")
-
-    # Calculate similarity        
-    vectorizer = TfidfVectorizer(stop_words='english', lowercase=True)
-    tfidf = vectorizer.fit_transform(texts)
-    sim = cosine_similarity(tfidf)    
-    crossRefIds = {}
-    total_refs = 0    
-    for i in range(len(ids)):
-        cross_refs = []
-        for j in range(len(ids)):
-            if i != j and sim[i, j] > similarity_threshold:
-                cross_refs.append({
-                    "cid": ids[j],
-                    "score": round(float(sim[i, j]), 4)
-                })
-                total_refs += 1
-        
-        cross_refs.sort(key=lambda x: x['score'], reverse=True)
-        crossRefIds[ids[i]] = cross_refs 
- 
-    for item in data:
-        item_id = item.get('email_id')
-
-        if item_id in crossRefIds:
-            # Parse output
-            if 'output' in item and isinstance(item['output'], str):
-                try:
-                    output_obj = json.loads(item['output'])
-                except:
-                    continue
-            else:
-                output_obj = item.get('output', item)
-            
-            # Add crossRefInfo
-            has_part = output_obj.get('hasPart')
-            
-            if has_part:
-                cross_ref_section = {
-                    "crossRefEmails": crossRefIds[item_id],
-                    "totalCrossRefs": len(crossRefIds[item_id])
-                }
-                
-                if isinstance(has_part, dict):
-                    has_part['crossRefInfo'] = cross_ref_section
-                elif isinstance(has_part, list):
-                    output_obj['crossRefInfo'] = cross_ref_section
+    return item_keys, ids
+
+# Helper: second pass, write crossRefInfo for every item in crossRefIds.
+# With merge=True the refs are added to any crossRefEmails the item already has.
+def write_cross_references(input_file: str, output_file: str, crossRefIds: dict, return_data: bool = False,
+                           merge: bool = False):
+    data = [] if return_data else None
+    with RecordWriter(output_file) as writer:
+        for item, output_obj in iter_cases(input_file):
+            item_id = item.get('email_id')
+            updated = None
+
+            if item_id in crossRefIds:
+                # Add crossRefInfo
+                has_part = output_obj.get('hasPart')
                 
-                # Update output
-                if 'output' in item and isinstance(item['output'], str):
-                    item['output'] = json.dumps(output_obj, ensure_ascii=False, indent=2)
-    
-    # Save
-    Path(output_file).parent.mkdir(parents=True, exist_ok=True)
-    
-    if output_file.endswith('.jsonl'):
-        with open(output_file, 'w', encoding='utf-8') as f:
-            for item in data:
-                f.write(json.dumps(item, ensure_ascii=False) + '\n')
-    else:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-    
-    print(f"Cross-references added to {len(ids)} items!")
-    
-    return data, crossRefIds
+                if has_part:
+                    target = has_part if isinstance(has_part, dict) else output_obj
+                    refs = crossRefIds[item_id]
+                    if merge:
+                        existing = (target.get('crossRefInfo') or {}).get('crossRefEmails') or []
+                        known = {ref['cid'] for ref in refs}
+                        refs = [ref for ref in existing if ref['cid'] not in known] + refs
+                        refs.sort(key=lambda x: x['score'], reverse=True)
+                    target['crossRefInfo'] = {
+                        "crossRefEmails": refs,
+                        "totalCrossRefs": len(refs)
+                    }
+                    
+                    # Update output
+                    updated = output_obj
+
+            writer.write(item, updated)
+            if return_data:
+                data.append(item)
+    return data
+
+# class to keep a persisted cross-reference index for incremental runs
+class CrossReferenceIndex:
+  """
+  Fitted TfidfVectorizer, TF-IDF matrix and id list stored in index_dir.
+  New documents are vectorized with the frozen vocabulary/IDF and compared
+  against the stored rows only; words unseen at fit time are ignored until the
+  index is rebuilt with add_cross_references_emailIds(..., index_dir=...).
+
+  save() writes the whole index (matrix.npz, ids.json); each incremental
+  ingest only appends a delta (delta_NNNN.npz, delta_NNNN.ids.json) and a
+  back-reference sidecar (backrefs_NNNN.json). A re-ingested id keeps its old
+  row on disk, masked out by the newer one, until the next save().
+  """
+
+  def __init__(self, index_dir: str, vectorizer, tfidf, ids: list, ingests: list = None):
+    self.index_dir = index_dir
+    self.vectorizer = vectorizer
+    self.tfidf = tfidf.tocsr()
+    self.ids = list(ids)
+    self.ingests = list(ingests) if ingests is not None else [0] * len(self.ids) # 0 = the saved base
+    self.pending_delta = None
+
+  @staticmethod
+  def delta_numbers(index_dir: str) -> List[int]:
+    return sorted(int(p.name[len('delta_'):-len('.npz')]) for p in Path(index_dir).glob('delta_*.npz'))
+
+  @classmethod
+  def load(cls, index_dir: str):
+    vectorizer = joblib.load(f"{index_dir}/vectorizer.joblib")
+    matrices = [sparse.load_npz(f"{index_dir}/matrix.npz")]
+    with open(f"{index_dir}/ids.json", 'r', encoding='utf-8') as f:
+      ids = json.load(f)
+    ingests = [0] * len(ids)
+    for n in cls.delta_numbers(index_dir):
+      matrices.append(sparse.load_npz(f"{index_dir}/delta_{n:04d}.npz"))
+      with open(f"{index_dir}/delta_{n:04d}.ids.json", 'r', encoding='utf-8') as f:
+        delta_ids = json.load(f)
+      ids += delta_ids
+      ingests += [n] * len(delta_ids)
+    return cls(index_dir, vectorizer, sparse.vstack(matrices).tocsr(), ids, ingests)
+
+  def live_rows(self) -> np.ndarray:
+    """Mask of the rows that are the latest version of their id."""
+    latest = {doc_id: i for i, doc_id in enumerate(self.ids)}
+    live = np.zeros(len(self.ids), dtype=bool)
+    live[list(latest.values())] = True
+    return live
+
+  def save(self):
+    """Write the live rows as a new base and drop every delta and sidecar."""
+    Path(self.index_dir).mkdir(parents=True, exist_ok=True)
+    live = np.flatnonzero(self.live_rows())
+    self.tfidf = self.tfidf[live]
+    self.ids = [self.ids[i] for i in live]
+    self.ingests = [0] * len(self.ids)
+    joblib.dump(self.vectorizer, f"{self.index_dir}/vectorizer.joblib")
+    sparse.save_npz(f"{self.index_dir}/matrix.npz", self.tfidf)
+    with open(f"{self.index_dir}/ids.json", 'w', encoding='utf-8') as f:
+      json.dump(self.ids, f, ensure_ascii=False)
+    for pattern in ('delta_*.npz', 'delta_*.ids.json', 'backrefs_*.json'):
+      for path in Path(self.index_dir).glob(pattern):
+        path.unlink()
+
+  def save_delta(self):
+    """Append the rows and back-references of the last add_documents call."""
+    delta = self.pending_delta
+    n = delta['ingest']
+    sparse.save_npz(f"{self.index_dir}/delta_{n:04d}.npz", delta.pop('rows'))
+    with open(f"{self.index_dir}/delta_{n:04d}.ids.json", 'w', encoding='utf-8') as f:
+      json.dump(delta['ids'], f, ensure_ascii=False)
+    with open(f"{self.index_dir}/backrefs_{n:04d}.json", 'w', encoding='utf-8') as f:
+      json.dump(delta, f, ensure_ascii=False)
+    self.pending_delta = None
+
+  def add_documents(self, new_ids: list, new_texts: list, similarity_threshold: float, top_k: int = None):
+    """
+    Append new documents and return (new_refs, back_refs): cross-references for
+    each new id, and the references existing ids gain to the new ones.
+    An id that is already indexed (or repeated in new_ids) replaces its old row
+    instead of being added twice. save_delta() persists the result.
+    """
+    latest = {doc_id: i for i, doc_id in enumerate(new_ids)} # last occurrence wins
+    order = sorted(latest.values())
+    new_ids = [new_ids[i] for i in order]
+    new_rows = self.vectorizer.transform([new_texts[i] for i in order]).tocsr()
+    replaced = sorted({doc_id for doc_id in self.ids if doc_id in latest}, key=str)
+    if replaced:
+      print(f"Re-indexing {len(replaced)} ids that were already in the index")
+    ingest = max([0] + self.delta_numbers(self.index_dir) + self.ingests) + 1
+    offset = len(self.ids)
+    self.tfidf = sparse.vstack([self.tfidf, new_rows]).tocsr()
+    self.ids += new_ids
+    self.ingests += [ingest] * len(new_ids)
+    live = self.live_rows()
+
+    new_refs = {}
+    back_refs = {}
+    sims = (new_rows @ self.tfidf.T).tocsr()
+    for r, new_id in enumerate(new_ids):
+      cols = sims.indices[sims.indptr[r]:sims.indptr[r + 1]]
+      vals = sims.data[sims.indptr[r]:sims.indptr[r + 1]]
+      keep = (vals > similarity_threshold) & (cols != offset + r) & live[cols]
+      row_pairs = _rank_row_pairs(cols[keep], vals[keep], top_k)
+      new_refs[new_id] = [{"cid": self.ids[j], "score": score} for j, score in row_pairs]
+      for j, score in row_pairs:
+        if j < offset:
+          back_refs.setdefault(self.ids[j], []).append({"cid": new_id, "score": score})
+    self.pending_delta = {'ingest': ingest, 'ids': new_ids, 'replaced': replaced, 'top_k': top_k,
+                          'back_refs': back_refs, 'rows': new_rows}
+    return new_refs, back_refs
+
+# Back-reference sidecars of an index, applied to records when they are merged
+class BackReferenceDeltas:
+  """
+  The backrefs_NNNN.json sidecars of a CrossReferenceIndex, in ingest order.
+  apply() brings a record's crossRefEmails up to date: for every ingest after
+  the one that produced the record, refs to re-ingested ids are dropped, the
+  new back-references added, and the list re-ranked and capped at top_k.
+  """
+
+  def __init__(self, index_dir: str, top_k: int = None):
+    self.deltas = []
+    self.item_ingest = {}
+    for n in CrossReferenceIndex.delta_numbers(index_dir):
+      sidecar = Path(index_dir) / f"backrefs_{n:04d}.json"
+      if not sidecar.exists():
+        continue
+      with open(sidecar, 'r', encoding='utf-8') as f:
+        delta = json.load(f)
+      delta['replaced'] = set(delta['replaced'])
+      self.deltas.append(delta)
+      for doc_id in delta['ids']:
+        self.item_ingest[doc_id] = delta['ingest']
+    self.top_k = top_k if top_k is not None else next((d['top_k'] for d in reversed(self.deltas)), None)
+    self.patched = 0
+
+  def apply(self, item_id, refs: list) -> list:
+    """The updated refs, or None when no delta touches this item."""
+    since = self.item_ingest.get(item_id, 0)
+    changed = False
+    for delta in self.deltas:
+      if delta['ingest'] <= since:
+        continue
+      added = delta['back_refs'].get(item_id, [])
+      if not added and not any(ref['cid'] in delta['replaced'] for ref in refs):
+        continue
+      known = {ref['cid'] for ref in added}
+      refs = [ref for ref in refs if ref['cid'] not in delta['replaced'] and ref['cid'] not in known] + added
+      changed = True
+    if not changed:
+      return None
+    refs.sort(key=lambda x: x['score'], reverse=True)
+    self.patched += 1
+    return refs[:self.top_k] if self.top_k is not None else refs
+
+  def apply_to_case(self, item_id, output_obj: Dict) -> bool:
+    """Patch the case's crossRefInfo in place; returns whether it changed."""
+    has_part = output_obj.get('hasPart')
+    if not has_part or not self.deltas:
+      return False
+    target = has_part if isinstance(has_part, dict) else output_obj
+    refs = self.apply(item_id, list((target.get('crossRefInfo') or {}).get('crossRefEmails') or []))
+    if refs is None:
+      return False
+    target['crossRefInfo'] = {"crossRefEmails": refs, "totalCrossRefs": len(refs)}
+    return True
+
+# function to add cross references for new items using a persisted index
+def add_cross_references_incremental(new_input_file: str, output_file: str, index_dir: str,
+                                     similarity_threshold: float, top_k: int = None):
+  """
+  Cross-reference only the items in new_input_file against the index in index_dir
+  (and each other), write them to output_file and append the new rows to the index.
+  Existing records are not rewritten: the references they gain are stored as a
+  sidecar in index_dir and applied when the batches are merged
+  (merge_batches_to_jsonl(..., index_dir=...)) or by apply_cross_reference_deltas.
+  """
+  index = CrossReferenceIndex.load(index_dir)
+  store = BodyStore()
+  item_keys, ids = collect_item_bodies(new_input_file, store)
+  texts = [store.combined(keys) for keys in item_keys]
+  new_refs, back_refs = index.add_documents(ids, texts, similarity_threshold, top_k=top_k)
+  index.save_delta()
+
+  write_cross_references(new_input_file, output_file, new_refs)
+  print(f"Cross-references added to {len(ids)} new items ({len(index.ids)} rows indexed); "
+        f"back-references for {len(back_refs)} existing items saved to {index_dir}")
+  return new_refs, back_refs
+
+# function to apply an index's back-reference sidecars to a file of existing records
+def apply_cross_reference_deltas(input_file: str, output_file: str, index_dir: str, top_k: int = None) -> int:
+  """Stream input_file to output_file with the back-references applied; returns the number of records patched."""
+  deltas = BackReferenceDeltas(index_dir, top_k)
+  with RecordWriter(output_file) as writer:
+    for item, output_obj in iter_cases(input_file):
+      writer.write(item, output_obj if deltas.apply_to_case(item.get('email_id'), output_obj) else None)
+  print(f"Back-references applied to {deltas.patched} items")
+  return deltas.patched
+
+# spaCy models loaded in this process, by name
+_SPACY_MODELS = {}
+
+def load_ner_model(model_name: str = "en_ner_bc5cdr_md"):
+  """Load a spaCy NER model once per process, with every pipe except tok2vec/ner disabled."""
+  if model_name not in _SPACY_MODELS:
+    nlp = spacy.load(model_name)
+    unused = [name for name in nlp.pipe_names if name not in ("tok2vec", "ner")]
+    nlp.select_pipes(disable=unused)
+    _SPACY_MODELS[model_name] = nlp
+  return _SPACY_MODELS[model_name]
+
+# Helper to split long text into pieces under max_chars, preferring paragraph/line/word boundaries
+def chunk_text(text: str, max_chars: int):
+  chunks = []
+  while len(text) > max_chars:
+    cut = max_chars
+    for sep in ('\n\n', '\n', ' '):
+      pos = text.rfind(sep, 0, max_chars)
+      if pos > max_chars // 2:
+        cut = pos + len(sep)
+        break
+    chunks.append(text[:cut])
+    text = text[cut:]
+  if text:
+    chunks.append(text)
+  return chunks
 
 # class to add rxnorm drugs list
 class extractRXnormDrugs:
-  def __init__(self,input_file:str,output_file:str):
+  def __init__(self,input_file:str,output_file:str,batch_size:int = 64,n_process:int = 1,
+               max_chunk_chars:int = 100000,cache_path:str = None,cache_ttl_days:float = 30,
+               cache_max_entries:int = 500000,rxnav_concurrency:int = 8,
+               rxnav_rate:float = RXNAV_RATE_LIMIT,rxnorm_index:str = None,
+               mention_matcher:str = 'spacy',drug_dictionary:DrugDictionary = None,
+               rxnav_base_url:str = RXNAV_BASE_URL):
     self.input_file = input_file
     self.output_file = output_file
+    # nlp.pipe settings; bodies longer than max_chunk_chars (and nlp.max_length) are split
+    self.batch_size = batch_size
+    self.n_process = n_process
+    self.max_chunk_chars = max_chunk_chars
+    self.rxnav_base_url = rxnav_base_url # e.g. a local stand-in server in tests
+    # Terms resolved concurrently, all requests kept under rxnav_rate per second
+    self.rxnav_concurrency = rxnav_concurrency
+    self.rxnav_rate = rxnav_rate
+    # With an index from rxnormResolvers.build_rxnorm_index, lookups run offline instead of on RxNav
+    self.resolver = OfflineRxNormResolver(rxnorm_index) if rxnorm_index else None
+    # How drug mentions are found: 'spacy' (NER), 'dictionary' (DrugDictionary only)
+    # or 'prefilter' (NER only on bodies where the dictionary finds something)
+    if mention_matcher not in ('spacy', 'dictionary', 'prefilter'):
+      raise ValueError(f"mention_matcher must be 'spacy', 'dictionary' or 'prefilter', not {mention_matcher!r}")
+    if mention_matcher != 'spacy' and drug_dictionary is None:
+      raise ValueError(f"mention_matcher={mention_matcher!r} needs a drug_dictionary")
+    self.mention_matcher = mention_matcher
+    self.drug_dictionary = drug_dictionary
+    # Optional on-disk cache of RxNav answers shared across runs
+    self.cache = None
+    if cache_path:
+      self.cache = RxNormCache(cache_path, ttl_seconds=cache_ttl_days * 24 * 3600,
+                               max_entries=cache_max_entries)
 
   def is_valid_drug_term(self,term):
       """Filter out invalid drug terms"""
@@ -174,10 +741,7 @@ class extractRXnormDrugs:
           return False
       return True
 
-  # Load Spacy model with entity recognition
-  def extract_chemicals_with_spacy(self,text):
-    nlp = spacy.load("en_ner_bc5cdr_md")
-    doc = nlp(text)
+  def chemicals_from_doc(self,doc):
     chemicals = []
     for ent in doc.ents:
       if ent.label_ in ["CHEMICAL", "DRUG"]:
@@ -187,112 +751,186 @@ class extractRXnormDrugs:
           chemicals.append(term)
     return chemicals
 
+  def chemicals_from_dictionary(self,text):
+    return [span for _, _, span in self.drug_dictionary.find_spans(text) if self.is_valid_drug_term(span)]
+
+  # Chemical terms for each text, using the configured mention matcher
+  def extract_chemicals_batch(self,texts):
+    if self.mention_matcher == 'dictionary':
+      return [self.chemicals_from_dictionary(text) for text in texts]
+    if self.mention_matcher == 'prefilter':
+      flagged = [idx for idx, text in enumerate(texts) if self.drug_dictionary.has_match(text)]
+      results = [[] for _ in texts]
+      for idx, terms in zip(flagged, self.extract_chemicals_spacy_batch([texts[idx] for idx in flagged])):
+        results[idx] = terms
+      return results
+    return self.extract_chemicals_spacy_batch(texts)
+
+  # Run the (once-loaded) Spacy NER model over many texts with nlp.pipe
+  def extract_chemicals_spacy_batch(self,texts):
+    nlp = load_ner_model()
+    max_chars = min(self.max_chunk_chars, nlp.max_length - 1)
+    pieces = [(chunk, idx) for idx, text in enumerate(texts) for chunk in chunk_text(text, max_chars)]
+    results = [[] for _ in texts]
+    for doc, idx in nlp.pipe(pieces, as_tuples=True, batch_size=self.batch_size, n_process=self.n_process):
+      results[idx].extend(self.chemicals_from_doc(doc))
+    return results
+
+  # Spacy model with entity recognition, for a single text
+  def extract_chemicals_with_spacy(self,text):
+    return self.extract_chemicals_spacy_batch([text])[0]
+
+  def compare_mention_matchers(self,max_bodies:int = None):
+    """
+    Run spaCy NER and the drug dictionary over the same unique bodies of the
+    input file and report throughput and how many of the NER terms the
+    dictionary also finds (recall against NER, terms compared loosely normalized).
+    """
+    store = BodyStore()
+    for item, output_obj in iter_cases(self.input_file):
+      for body in extract_all_bodies(output_obj.get('hasPart') or []):
+        store.add(body)
+    texts = list(store.bodies.values())[:max_bodies]
+
+    start = time.time()
+    ner_terms = self.extract_chemicals_spacy_batch(texts)
+    ner_seconds = time.time() - start
+    start = time.time()
+    dict_terms = [self.chemicals_from_dictionary(text) for text in texts]
+    dict_seconds = time.time() - start
+
+    ner_set = {loose_normalize(t) for terms in ner_terms for t in terms} - {''}
+    dict_set = {loose_normalize(t) for terms in dict_terms for t in terms} - {''}
+    report = {
+      'bodies': len(texts),
+      'ner_seconds': round(ner_seconds, 2),
+      'dictionary_seconds': round(dict_seconds, 2),
+      'ner_terms': len(ner_set),
+      'dictionary_terms': len(dict_set),
+      'shared_terms': len(ner_set & dict_set),
+      'recall_vs_ner': round(len(ner_set & dict_set) / len(ner_set), 3) if ner_set else None,
+    }
+    print(f"NER: {report['ner_terms']} terms in {ner_seconds:.1f}s | "
+          f"dictionary: {report['dictionary_terms']} terms in {dict_seconds:.1f}s | "
+          f"recall vs NER: {report['recall_vs_ner']}")
+    return report
+
+  def fetch_drug_name(self,rxcui):
+      """Drug name for an RXCUI, None if RxNav has none; raises on network errors"""
+      r = requests.get(f"{self.rxnav_base_url}/rxcui/{rxcui}/properties.json", timeout=30)
+      r.raise_for_status()
+      properties = r.json().get("properties") or {}
+      return properties.get("name")
+
+  def fetch_rxcui(self,term):
+      """Best RXCUI for a term, None if RxNav has no candidate; raises on network errors"""
+      r = requests.get(f"{self.rxnav_base_url}/approximateTerm.json",
+                       params={"term": term, "maxEntries": 1}, timeout=30)
+      r.raise_for_status()
+      candidates = (r.json().get("approximateGroup") or {}).get("candidate") or []
+      return candidates[0].get("rxcui") if candidates else None
+
   def get_drug_name_from_rxcui(self,rxcui):
       """Get the drug name directly from RXCUI"""
-      url = f"https://rxnav.nlm.nih.gov/REST/rxcui/{rxcui}/properties.json"
-      try:
-          r = requests.get(url)
-          result = r.json()
-          properties = result.get("properties", {})
-          name = properties.get("name")
+      if self.resolver is not None:
+        return self.resolver.get_drug_name_from_rxcui(rxcui)
+      if self.cache is not None:
+        name = self.cache.get_name(rxcui)
+        if name is not MISS:
           return name
+      try:
+          name = self.fetch_drug_name(rxcui)
       except Exception as e:
-          return None
+          return None # not cached, so the next run retries it
+      if self.cache is not None:
+        self.cache.set_name(rxcui, name)
+      return name
 
   def rxnorm_match(self,term):
       """Get RXCUI for a chemical/drug term"""
-      url = "https://rxnav.nlm.nih.gov/REST/approximateTerm.json"
+      if self.resolver is not None:
+        return self.resolver.rxnorm_match(term)
+      if self.cache is not None:
+        rxcui = self.cache.get_rxcui(term)
+        if rxcui is not MISS:
+          return rxcui
       try:
-          r = requests.get(url, params={"term": term, "maxEntries": 1})
-          result = r.json()
-          candidates = result.get("approximateGroup", {}).get("candidate", [])
-          return candidates[0].get("rxcui")
-      except:
-          return None
-
-  def extract_unique_chemical_terms(self):
+          rxcui = self.fetch_rxcui(term)
+      except Exception:
+          return None # not cached, so the next run retries it
+      if self.cache is not None:
+        self.cache.set_rxcui(term, rxcui)
+      return rxcui
+
+  def extract_unique_chemical_terms(self, return_data: bool = False):
+    """
+    Returns (all_terms, text_to_candidates, data). The records are streamed, so
+    data is None unless return_data=True loads them into a list.
+    """
     all_terms = set()
     text_to_candidates = {}
-    # Load data
-    if self.input_file.endswith('.jsonl'):
-        with open(self.input_file, 'r', encoding='utf-8') as f:
-            data = [json.loads(line) for line in f]
-    else:
-        with open(self.input_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-    
-    # Helper function to extract ALL bodies recursively
-    def extract_all_bodies(email_obj):
-        """Extract all email bodies including forwarded messages"""
-        all_bodies = []
-        
-        if isinstance(email_obj, list):
-            for email in email_obj:
-                all_bodies.extend(extract_all_bodies(email))
-        
-        elif isinstance(email_obj, dict):
-            # Get this email's body
-            body = email_obj.get('body', '')
-            if body and len(body.strip()) > 0:
-                all_bodies.append(body)
-            
-            # Recursively get forwarded message bodies
-            if 'forwardedMessage' in email_obj:
-                all_bodies.extend(extract_all_bodies(email_obj['forwardedMessage']))
-        
-        return all_bodies
-    
-    for item in data:
-      if 'output' in item and isinstance(item['output'], str):
-          try:
-              output_obj = json.loads(item['output'])
-          except:
-              output_obj = item
-      else:
-          output_obj = item.get('output', item)
-      
+    store = BodyStore() # NER runs once per unique body
+    item_keys = []
+    data = [] if return_data else None
+    for item, output_obj in iter_cases(self.input_file):
+      if return_data:
+        data.append(item)
       # Get hasPart
       has_part = output_obj.get('hasPart')
       
       if has_part:
         all_bodies = extract_all_bodies(has_part)
         if all_bodies:
-          combined_body = ' '.join(all_bodies)
-          candidates = self.extract_chemicals_with_spacy(combined_body)
-          identifier = item.get('email_id')
-          if identifier not in text_to_candidates:
-            text_to_candidates[identifier] = []
-          text_to_candidates[identifier].extend(candidates)
-          all_terms.update(candidates)
+          item_keys.append((item.get('email_id'), [store.add(body) for body in all_bodies]))
+    print(f"Body store: {store.summary()}")
+
+    # Stream every unique body through nlp.pipe, then fan the terms back out
+    keys = list(store.bodies)
+    for key, terms in zip(keys, self.extract_chemicals_batch([store.bodies[k] for k in keys])):
+      store.results[('ner', key)] = terms
+
+    for identifier, body_keys in item_keys:
+      candidates = []
+      for key in body_keys:
+        candidates.extend(store.results[('ner', key)])
+      if identifier not in text_to_candidates:
+        text_to_candidates[identifier] = []
+      text_to_candidates[identifier].extend(candidates)
+      all_terms.update(candidates)
     return all_terms,text_to_candidates,data
         
   def parse_rxnorm(self,all_terms):
-    term_to_drugs = {}
-    for i,term in enumerate(all_terms):
-      rxcui = self.rxnorm_match(term)
-      if rxcui:
-        drug_names = self.get_drug_name_from_rxcui(rxcui)
-        if drug_names:
-          term_to_drugs[term] = drug_names
+    start = time.time()
+    if self.resolver is not None:
+      term_to_drugs = self.resolver.resolve_terms(all_terms)
+      print(f"RxNorm (offline): {len(term_to_drugs)}/{len(all_terms)} terms resolved in {time.time() - start:.1f}s")
+      return term_to_drugs
+    client = RxNavClient(self.rxnav_base_url, cache=self.cache, concurrency=self.rxnav_concurrency,
+                         rate=self.rxnav_rate)
+    term_to_drugs = run_async(client.resolve_terms(all_terms))
+    print(f"RxNorm: {len(term_to_drugs)}/{len(all_terms)} terms resolved with {client.requests} requests "
+          f"({client.errors} failed) in {time.time() - start:.1f}s")
+    if self.cache is not None:
+      print(f"RxNorm cache: {self.cache.hits} hits, {self.cache.misses} misses")
     return term_to_drugs
 
-  def add_rxnorm_drugs_name(self):
-      all_terms,text_to_candidates,data = self.extract_unique_chemical_terms()
+  def add_rxnorm_drugs_name(self, return_data: bool = False):
+      """
+      Write the records with drugsRXnorm added. Returns the number of records
+      written, or the records themselves with return_data=True.
+      """
+      all_terms,text_to_candidates,_ = self.extract_unique_chemical_terms()
+      data = [] if return_data else None
       term_to_drugs = self.parse_rxnorm(all_terms)
       
-      for item in data:
-          if 'output' in item and isinstance(item['output'], str):
-              try:
-                  output_obj = json.loads(item['output'])
-              except:
-                  output_obj = item
-          else:
-              output_obj = item.get('output', item)
-          
+      # Stream the input again and save
+      with RecordWriter(self.output_file) as writer:
+        for item, output_obj in iter_cases(self.input_file):
           # Get hasPart
           has_part = output_obj.get('hasPart')
           identifier = item.get('email_id')
           candidates = text_to_candidates.get(identifier,[])
+          updated = None
           all_drug_name = [] #collect all drug name
           for term in candidates:
             drug_name = term_to_drugs.get(term)
@@ -307,32 +945,611 @@ class extractRXnormDrugs:
               elif isinstance(has_part, list):
                 output_obj['drugsRXnorm'] = unique_drugs
               
-              if 'output' in item and isinstance(item['output'], str):
-                item['output'] = json.dumps(output_obj, ensure_ascii=False, indent=2)
-    
-      # Save
-      Path(self.output_file).parent.mkdir(parents=True, exist_ok=True)
-      
-      if self.output_file.endswith('.jsonl'):
-          with open(output_file, 'w', encoding='utf-8') as f:
-              for item in data:
-                  f.write(json.dumps(item, ensure_ascii=False) + '\n')
-      else:
-          with open(self.output_file, 'w', encoding='utf-8') as f:
-              json.dump(data, f, ensure_ascii=False, indent=2)
+              updated = output_obj
+          writer.write(item, updated)
+          if return_data:
+            data.append(item)
+
       print('File saved successfully')
-      return data
+      return data if return_data else writer.count
+
+# Rough token count (~4 characters per token) used for budgets and rate limits
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+# The six lists extract_body_info asks the model for
+ENRICHMENT_FIELDS = ["decisions_made", "concerns_raised", "people_mentioned",
+                     "locations_mentioned", "events_mentioned", "financial_mentions"]
+
+SYSTEM_PROMPT = "You are an expert at analyzing email content and extracting structured information. Always return valid JSON only."
+
+def empty_enrichment(error: str = None, error_type: str = None) -> Dict[str, Any]:
+    enrichment = {field: [] for field in ENRICHMENT_FIELDS}
+    if error is not None:
+        enrichment["error"] = error
+        enrichment["error_type"] = error_type or "unknown"
+    return enrichment
+
+# Merge the extractions of several chunks of one email: lists concatenated with
+# duplicates (case/whitespace-insensitive) removed; any chunk error is kept
+def merge_enrichments(parts: List[Dict[str, Any]]) -> Dict[str, Any]:
+    merged = empty_enrichment()
+    seen = {field: set() for field in ENRICHMENT_FIELDS}
+    for part in parts:
+        for field in ENRICHMENT_FIELDS:
+            values = part.get(field) or []
+            for value in values if isinstance(values, list) else [values]:
+                marker = json.dumps(value, sort_keys=True).lower() if isinstance(value, (dict, list)) else re.sub(r'\s+', ' ', str(value)).strip().lower()
+                if marker and marker not in seen[field]:
+                    seen[field].add(marker)
+                    merged[field].append(value)
+    failed = [part for part in parts if part.get('error')]
+    if failed:
+        merged['error'] = f"{len(failed)} of {len(parts)} chunks failed: {failed[0]['error']}"
+        merged['error_type'] = failed[0].get('error_type', 'unknown')
+    return merged
+
+# Parse a model reply as JSON, stripping ```json fences
+def parse_json_content(content: str):
+    content = content.strip()
+    if content.startswith('```json'):
+        content = content[7:]
+    if content.startswith('```'):
+        content = content[3:]
+    if content.endswith('```'):
+        content = content[:-3]
+    return json.loads(content.strip())
+
+# Every email with a body in a case, as (path, email object); the path is the list of
+# keys/indexes from the case object, e.g. ['hasPart', 1, 'forwardedMessage']
+def iter_email_paths(output_obj: Dict):
+    def walk(email_obj, path):
+        if not isinstance(email_obj, dict) or '@type' not in email_obj:
+            return
+        if 'EmailMessage' in email_obj.get('@type', '') and (email_obj.get('body') or '').strip():
+            yield path, email_obj
+        if 'forwardedMessage' in email_obj:
+            yield from walk(email_obj['forwardedMessage'], path + ['forwardedMessage'])
+
+    has_part = output_obj.get('hasPart')
+    if isinstance(has_part, list):
+        for idx, email in enumerate(has_part):
+            yield from walk(email, ['hasPart', idx])
+    elif isinstance(has_part, dict):
+        yield from walk(has_part, ['hasPart'])
+
+def get_at_path(obj, path):
+    for key in path:
+        obj = obj[key]
+    return obj
+
+# Failure index written next to each enriched batch: one JSON line per failed email
+def failure_index_path(output_file) -> Path:
+    output_file = Path(output_file)
+    return output_file.with_name(output_file.stem + '.failures.jsonl')
+
+def batch_failures(output_file, cases) -> List[Dict]:
+    """Index entries for every email of (item, case object) pairs whose enriched_content has an error."""
+    failures = []
+    for item_idx, (item, output_obj) in enumerate(cases):
+        if output_obj is None:
+            continue
+        for path, email_obj in iter_email_paths(output_obj):
+            enriched = email_obj.get('enriched_content')
+            if isinstance(enriched, dict) and enriched.get('error'):
+                failures.append({
+                    'file': Path(output_file).name,
+                    'item': item_idx,
+                    'email_id': item.get('email_id'),
+                    'path': path,
+                    'error_type': enriched.get('error_type', 'unknown'),
+                    'error': str(enriched['error'])[:300],
+                })
+    return failures
+
+def write_failure_index(output_file, failures: List[Dict]):
+    # Written even when empty, so a clean batch is never rescanned
+    index_path = failure_index_path(output_file)
+    with open(index_path, 'w', encoding='utf-8') as f:
+        for entry in failures:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+def read_failure_index(output_file) -> List[Dict]:
+    index_path = failure_index_path(output_file)
+    if not index_path.exists():
+        return []
+    return list(iter_records(str(index_path)))
+
+class EnrichmentPrefilter:
+  """
+  Cheap local check run before extract_body_info: is this body worth an LLM call?
+  Quoted text and forwarded-message headers are dropped first. Bodies with
+  fewer than min_words words are skipped, bodies with at least keep_words
+  words are always sent, and everything in between is scored by a small
+  linear model over length, keyword, number, capitalized-word, drug-mention
+  and acknowledgement/auto-reply features (score >= threshold is sent).
+  The default weights are hand-set; fit() or fit_from_enriched() learns them
+  from bodies that were already enriched.
+  """
+
+  HEADER_LINE = re.compile(r"^\s*(>|-{2,}.*(original|forwarded) message|(from|sent|to|cc|bcc|subject|date):)", re.I)
+  ACK = re.compile(r"(\W*(thanks?( you)?( very much)?|thx|ok(ay)?|got it|will do|received|noted|sounds good|"
+                   r"see attached|fyi|regards|best|cheers|yes|no)\W*)+", re.I)
+  AUTO_REPLY = re.compile(r"out of (the )?office|auto(matic)?[- ]?reply|away from (my|the) (desk|office)|"
+                          r"limited access to e-?mail|delivery (has )?failed|undeliverable", re.I)
+  KEYWORDS = re.compile(r"\b(opioids?|oxycontin|drugs?|doses?|prescri\w*|pharm\w*|fda|dea|budget|costs?|million|"
+                        r"meeting|decid\w*|decision|approv\w*|concern\w*|risks?|lawsuits?|settlement|sales|"
+                        r"marketing|study|trial|abuse|addiction|launch|plan)\b", re.I)
+  FEATURES = ['log_words', 'keywords', 'numbers', 'capitalized', 'drugs', 'ack', 'auto_reply']
+
+  def __init__(self, min_words: int = 3, keep_words: int = 60, threshold: float = 0.0,
+               weights: Dict[str, float] = None, bias: float = -1.0, drug_dictionary: DrugDictionary = None):
+    self.min_words = min_words
+    self.keep_words = keep_words
+    self.threshold = threshold
+    self.weights = weights or {'log_words': 0.6, 'keywords': 0.8, 'numbers': 0.3, 'capitalized': 0.15,
+                               'drugs': 1.0, 'ack': -3.0, 'auto_reply': -4.0}
+    self.bias = bias
+    self.drug_dictionary = drug_dictionary
+
+  def content(self, body: str) -> str:
+    return '\n'.join(line for line in body.splitlines() if not self.HEADER_LINE.match(line)).strip()
+
+  def features(self, body: str) -> Dict[str, float]:
+    text = self.content(body)
+    words = text.split()
+    return {
+      'words': len(words),
+      'log_words': float(np.log1p(len(words))),
+      'keywords': len(self.KEYWORDS.findall(text)),
+      'numbers': len(re.findall(r'[$%]|\d+', text)),
+      'capitalized': min(10, sum(1 for w in words[1:] if w[:1].isupper())),
+      'drugs': len(self.drug_dictionary.find_spans(text)) if self.drug_dictionary is not None else 0,
+      'ack': 1.0 if text and self.ACK.fullmatch(text) else 0.0,
+      'auto_reply': 1.0 if self.AUTO_REPLY.search(text) else 0.0,
+    }
+
+  def score(self, features: Dict[str, float]) -> float:
+    return self.bias + sum(self.weights[name] * features[name] for name in self.FEATURES)
+
+  def should_enrich(self, body: str) -> bool:
+    features = self.features(body)
+    if features['words'] < self.min_words:
+      return False
+    if features['words'] >= self.keep_words:
+      return True
+    return self.score(features) >= self.threshold
+
+  def fit(self, bodies: List[str], labels: List[bool]):
+    """Learn the weights with logistic regression; labels say whether enrichment found anything."""
+    X = np.array([[self.features(body)[name] for name in self.FEATURES] for body in bodies])
+    model = LogisticRegression(max_iter=1000, class_weight='balanced').fit(X, np.array(labels, dtype=int))
+    self.weights = dict(zip(self.FEATURES, model.coef_[0].tolist()))
+    self.bias = float(model.intercept_[0])
+    return self
+
+  def fit_from_enriched(self, files: List[str]):
+    """fit() on emails already enriched in earlier outputs (errors and skipped emails are ignored)."""
+    bodies, labels = [], []
+    for file in files:
+      for item, output_obj in iter_cases(str(file)):
+        for _, email_obj in iter_email_paths(output_obj):
+          enriched = email_obj.get('enriched_content')
+          if not isinstance(enriched, dict) or enriched.get('error') or enriched.get('skipped'):
+            continue
+          bodies.append(email_obj['body'])
+          labels.append(any(enriched.get(field) for field in ENRICHMENT_FIELDS))
+    print(f"Fitting prefilter on {len(bodies)} enriched emails ({sum(labels)} with content)")
+    return self.fit(bodies, labels)
+
+class EnrichmentJournal:
+  """
+  Append-only log of the emails of one batch that were enriched successfully,
+  one JSON line each (item index, path, body key, enriched_content), flushed
+  to disk as they complete. After a crash process_batch replays it onto the
+  batch and only sends the emails that are still missing; the finished
+  output file replaces it.
+  """
+
+  def __init__(self, path, batch_name: str):
+    self.path = Path(path)
+    self.batch_name = batch_name
+    self._file = None
+
+  def load(self) -> List[Dict]:
+    """Entries of an earlier run over the same batch; an unrelated or missing journal gives []."""
+    if not self.path.exists():
+      return []
+    entries = []
+    with open(self.path, 'r', encoding='utf-8') as f:
+      for line_no, line in enumerate(f):
+        try:
+          entry = json.loads(line)
+        except json.JSONDecodeError:
+          entry = None
+        if line_no == 0:
+          if not isinstance(entry, dict) or entry.get('batch') != self.batch_name:
+            return []
+          continue
+        if isinstance(entry, dict) and 'item' in entry:
+          entries.append(entry)
+        else:
+          print(f"Skipping unreadable line {line_no + 1} of {self.path}")
+    return entries
+
+  def _truncate_partial_line(self) -> bool:
+    """Cut a torn last line (crash mid-write) so appends start on a fresh line; False if not even the header survived."""
+    with open(self.path, 'rb+') as f:
+      size = pos = f.seek(0, os.SEEK_END)
+      end = 0
+      while pos > 0:
+        step = min(pos, 1 << 16)
+        pos -= step
+        f.seek(pos)
+        newline = f.read(step).rfind(b'\n')
+        if newline >= 0:
+          end = pos + newline + 1
+          break
+      if end < size:
+        print(f"Dropping a partial last line from {self.path}")
+        f.truncate(end)
+    return end > 0
+
+  def open(self, resume: bool):
+    if resume and self.path.exists() and self._truncate_partial_line():
+      self._file = open(self.path, 'a', encoding='utf-8')
+    else:
+      self._file = open(self.path, 'w', encoding='utf-8')
+      self._write({'batch': self.batch_name})
+
+  def _write(self, entry: Dict):
+    self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+    self._file.flush()
+    os.fsync(self._file.fileno())
+
+  def record(self, item_idx: int, path: List, body_key: str, enriched: Dict):
+    self._write({'item': item_idx, 'path': path, 'key': body_key, 'enriched_content': enriched})
+
+  def close(self):
+    if self._file is not None:
+      self._file.close()
+      self._file = None
+
+  def remove(self):
+    self.close()
+    self.path.unlink(missing_ok=True)
+
+# Estimated enrichment work of a case: a fixed per-request cost (prompt template and
+# reply) for every email with a body, plus the body tokens
+def item_cost(output_obj: Dict, per_email_tokens: int = 400) -> int:
+    return sum(per_email_tokens + estimate_tokens(email_obj['body']) for _, email_obj in iter_email_paths(output_obj))
+
+# Default batch size by estimated cost: about the work of the old 10-item batches
+DEFAULT_BATCH_COST = 20000
+
+SHARD_MANIFEST = 'shards.json'
+
+def claim_record(worker_id: str, token: str) -> str:
+    return json.dumps({'worker': worker_id, 'token': token, 'host': platform.node(), 'pid': os.getpid(), 'time': time.time()})
+
+def read_claim(claim_file: Path):
+    try:
+        return json.loads(claim_file.read_text())
+    except (OSError, ValueError):
+        return None # missing, or being written by a worker without hard links
+
+def create_claim(claim_file: Path, worker_id: str, token: str) -> bool:
+    """Create the claim file only if there is none, complete (temp file + os.link) so it is never read half-written."""
+    tmp_file = claim_file.with_name(f"{claim_file.name}.{token}.tmp")
+    tmp_file.write_text(claim_record(worker_id, token))
+    try:
+        os.link(tmp_file, claim_file)
+        return True
+    except FileExistsError:
+        return False
+    except OSError:
+        # no hard links on this file system: exclusive create, then write
+        try:
+            fd = os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        with os.fdopen(fd, 'w') as f:
+            f.write(claim_record(worker_id, token))
+        return True
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+def refresh_claim(claim_file: Path, worker_id: str, token: str):
+    tmp_file = claim_file.with_name(f"{claim_file.name}.{token}.tmp")
+    tmp_file.write_text(claim_record(worker_id, token))
+    os.replace(tmp_file, claim_file)
+
+def claim_is_dead(claim: Dict, stale_after: float) -> bool:
+    """A claim not refreshed for stale_after seconds, or made by a process of this host that no longer runs."""
+    if time.time() - claim.get('time', 0) >= stale_after:
+        return True
+    if claim.get('host') != platform.node() or not isinstance(claim.get('pid'), int):
+        return False
+    try:
+        os.kill(claim['pid'], 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        pass # exists, owned by another user
+    return False
+
+def claim_shard(claim_file: Path, worker_id: str, stale_after: float):
+    """
+    Atomically claim a shard; returns the claim's token, or None while another
+    live worker holds it. A dead claim (see claim_is_dead) or one with the same
+    worker_id is taken over by renaming it aside: only one worker's rename can
+    succeed, and if the file renamed is not the claim judged dead (a fresh claim
+    replaced it meanwhile) it is put back.
+    """
+    token = uuid.uuid4().hex
+    if create_claim(claim_file, worker_id, token):
+        return token
+    claim = read_claim(claim_file)
+    if claim is None or (claim.get('worker') != worker_id and not claim_is_dead(claim, stale_after)):
+        return None
+    aside = claim_file.with_name(f"{claim_file.name}.{token}.stale")
+    try:
+        os.rename(claim_file, aside)
+    except FileNotFoundError:
+        return None # another worker took it over first
+    if read_claim(aside) != claim:
+        try:
+            os.link(aside, claim_file)
+        except OSError:
+            pass # its owner sees the claim gone at its next heartbeat and stops
+        aside.unlink(missing_ok=True)
+        return None
+    aside.unlink(missing_ok=True)
+    return token if create_claim(claim_file, worker_id, token) else None
+
+class ShardClaimLost(Exception):
+  """Raised in a worker whose shard claim was taken over, so it stops before writing the shard's files."""
+
+class ClaimHeartbeat:
+  """
+  Keeps a shard claim fresh while its worker is busy: a background thread
+  rewrites the claim time every `interval` seconds, so other workers only take
+  the shard over once its worker has stopped refreshing it for stale_after.
+  If the claim is found gone or replaced, `lost` is set and the worker's
+  process_batch(abort=lost) stops with ShardClaimLost.
+  """
+
+  def __init__(self, claim_file: Path, worker_id: str, token: str, interval: float):
+    self.claim_file = claim_file
+    self.worker_id = worker_id
+    self.token = token
+    self.interval = interval
+    self.lost = threading.Event()
+    self._stop = threading.Event()
+    self._thread = threading.Thread(target=self._run, daemon=True)
+
+  def _run(self):
+    while not self._stop.wait(self.interval):
+      claim = read_claim(self.claim_file)
+      if claim is None or claim.get('token') != self.token:
+        print(f"[{self.worker_id}] Lost the claim on {self.claim_file.name}")
+        self.lost.set()
+        return
+      refresh_claim(self.claim_file, self.worker_id, self.token)
+
+  def __enter__(self):
+    self._thread.start()
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    self._stop.set()
+    self._thread.join()
+    return False
+
+def journal_path(output_file) -> Path:
+    output_file = Path(output_file)
+    return output_file.with_name(output_file.stem + '.journal.jsonl')
 
 # class to extract semantic entity using qwen api
 class QwenEntityExtractor:
 
-  def __init__(self, api_key: str, model:str):  
+  def __init__(self, api_key: str, model:str, concurrency:int = 8, requests_per_minute:float = 60,
+               tokens_per_minute:float = None, pack_token_budget:int = None, max_pack_size:int = 10,
+               cache_path:str = None, cache_max_mb:float = 1024, cache_errors:bool = False,
+               max_retries:int = 5, breaker_threshold:int = 5, breaker_cooldown:float = 30,
+               prefilter:EnrichmentPrefilter = None, chunk_tokens:int = None, dispatcher:LLMDispatcher = None,
+               reuse_max_bodies:int = 50000, base_url:str = OPENROUTER_URL):
     self.api_key = api_key
-    self.base_url = "https://openrouter.ai/api/v1/chat/completions"
+    self.base_url = base_url # chat completions endpoint used without a dispatcher
     self.model = model
-    self.rate_limit_delay = 1 # 1 second delay between each api requests
+    self.temperature = 0.3
+    self.max_tokens = 1000
+    # Up to `concurrency` requests in flight, kept under the per-minute request/token quotas
+    self.concurrency = concurrency
+    self.request_limiter = SyncTokenBucket(requests_per_minute / 60, capacity=max(1, requests_per_minute / 60))
+    self.token_limiter = SyncTokenBucket(tokens_per_minute / 60, capacity=tokens_per_minute) if tokens_per_minute else None
+    self.session = pooled_session(concurrency)
+    self.usage = Counter() # prompt/completion tokens reported by the API
+    self._usage_lock = threading.Lock()
+    # Successful extractions by body key, reused for repeated bodies; the least
+    # recently used are dropped past reuse_max_bodies so long runs stay bounded
+    self.reused_results = OrderedDict()
+    self.reuse_max_bodies = reuse_max_bodies
+    self.reused_calls = 0
+    self.api_calls = 0
+    # Packing: short bodies share one request of up to pack_token_budget prompt tokens
+    self.pack_token_budget = pack_token_budget
+    self.max_pack_size = max_pack_size
+    self.pack_tokens_per_email = 400 # completion budget per packed email
+    self.pack_fallbacks = 0
+    # Optional on-disk cache of parsed replies, so reruns only pay for prompts not answered before
+    self.response_cache = None
+    if cache_path:
+      self.response_cache = LLMResponseCache(cache_path, max_bytes=int(cache_max_mb * 1024 * 1024),
+                                             cache_errors=cache_errors)
+
+    # Retries with exponential backoff + jitter; a shared breaker pauses every worker when the provider is degraded
+    self.max_retries = max_retries
+    self.max_parse_retries = 1
+    self.backoff_base = 1.0
+    self.backoff_cap = 60.0
+    self.breaker = CircuitBreaker(breaker_threshold, breaker_cooldown)
+    self.error_counts = Counter() # failed attempts by kind
+    # Bodies the prefilter rejects get an empty enriched_content without an API call
+    self.prefilter = prefilter
+    self.prefiltered_calls = 0
+    # Bodies over chunk_tokens are split on paragraph boundaries, extracted per chunk and merged
+    self.chunk_tokens = chunk_tokens
+    self.chunked_bodies = 0
+    self.request_timeout = 30
+    # With a dispatcher, requests go to its pool of (key, model) endpoints, each with
+    # its own quotas; api_key and the limiters above are then unused
+    self.dispatcher = dispatcher
+
+  def chat_payload(self, prompt: str, max_tokens: int) -> Dict:
+    return {
+      "model": self.model,
+      "messages": [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+      ],
+      "temperature": self.temperature,
+      "max_tokens": max_tokens
+    }
+
+  def post_completion(self, payload: Dict, sent: List = None) -> Dict:
+    """
+    POST a chat completion through the shared session and rate limiters; returns the response JSON.
+    The payload actually sent (with the dispatched endpoint's model) is appended to sent, if given.
+    """
+    tokens = estimate_tokens(''.join(m['content'] for m in payload['messages'])) + payload.get('max_tokens', 0)
+    if self.dispatcher is None:
+      if sent is not None:
+        sent.append(payload)
+      return self.send_completion(payload, self.api_key, self.base_url, tokens)
+    endpoint = self.dispatcher.acquire(tokens)
+    payload = dict(payload, model=endpoint.model)
+    if sent is not None:
+      sent.append(payload)
+    try:
+      result = self.send_completion(payload, endpoint.api_key, endpoint.base_url)
+    except LLMError as e:
+      self.dispatcher.report_failure(endpoint, e)
+      raise
+    self.dispatcher.report_success(endpoint, result.get('usage'))
+    return result
+
+  def cache_models(self, payload: Dict) -> List[str]:
+    """Models whose cached reply can answer payload: with a dispatcher, any model of a usable endpoint."""
+    if self.dispatcher is None:
+      return [payload['model']]
+    return [endpoint.model for endpoint in self.dispatcher.endpoints if not endpoint.disabled]
+
+  def send_completion(self, payload: Dict, api_key: str, url: str, tokens: int = None) -> Dict:
+    """One HTTP request; failures are raised as classified LLMErrors. tokens, if given, is drawn from this extractor's limiters."""
+    if tokens is not None:
+      self.request_limiter.acquire()
+      if self.token_limiter is not None:
+        self.token_limiter.acquire(tokens)
+    headers = {
+      "Authorization": f"Bearer {api_key}",
+      "Content-Type": "application/json"
+    }
+    with self._usage_lock:
+      self.api_calls += 1
+    try:
+      response = self.session.post(url, headers=headers, json=payload, timeout=self.request_timeout)
+    except requests.Timeout as e:
+      raise LLMError('timeout', str(e))
+    except requests.ConnectionError as e:
+      raise LLMError('server', str(e))
+    if response.status_code >= 400:
+      raise LLMError(classify_status(response.status_code), f"HTTP {response.status_code}: {response.text[:200]}",
+                     retry_after_seconds(response))
+    try:
+      result = response.json()
+    except ValueError as e:
+      raise LLMError('server', f"invalid response body: {e}")
+    if not result.get('choices'):
+      # OpenRouter reports upstream failures as a 200 with an error object
+      error = result.get('error') or {}
+      code = error.get('code')
+      raise LLMError(classify_status(code) if isinstance(code, int) else 'server',
+                     error.get('message') or 'response has no choices')
+    with self._usage_lock:
+      self.usage.update({k: v for k, v in (result.get('usage') or {}).items() if isinstance(v, int)})
+    return result
+
+  def complete_json(self, payload: Dict):
+    """
+    Parsed JSON reply for a chat payload, from the response cache when possible.
+    Replies are cached under the model that actually produced them.
+    """
+    if self.response_cache is not None:
+      cached = self.response_cache.get(payload, self.cache_models(payload))
+      if cached is not None:
+        return cached
+    usage = None
+    parse_failures = 0
+    sent = []
+    for attempt in range(self.max_retries + 1):
+      self.breaker.wait()
+      try:
+        result = self.post_completion(payload, sent)
+        usage = result.get('usage')
+        try:
+          reply = parse_json_content(result['choices'][0]['message']['content'] or '')
+        except (ValueError, KeyError, TypeError) as e:
+          raise LLMError('parse', str(e))
+        if not isinstance(reply, dict):
+          raise LLMError('parse', f"expected a JSON object, got {type(reply).__name__}")
+        self.breaker.record_success()
+        break
+      except LLMError as e:
+        with self._usage_lock:
+          self.error_counts[e.kind] += 1
+        if e.kind in ('rate_limit', 'server', 'timeout'):
+          if self.dispatcher is None:
+            self.breaker.record_failure(e.retry_after)
+          else:
+            # One endpoint's failure only benches that endpoint; the breaker opens
+            # when the whole pool is cooling down
+            pool_cooldown = self.dispatcher.pool_cooldown()
+            if pool_cooldown > 0:
+              self.breaker.record_failure(pool_cooldown)
+        else:
+          parse_failures += e.kind == 'parse'
+        failover = self.dispatcher is not None and e.kind == 'auth' and self.dispatcher.usable_count() > 0
+        if not (e.retryable or failover) or attempt == self.max_retries or parse_failures > self.max_parse_retries:
+          if self.response_cache is not None and sent:
+            self.response_cache.put(sent[-1], str(e), usage, is_error=True)
+          raise
+        if self.dispatcher is not None and e.kind != 'parse':
+          continue # the next attempt fails over; acquire() waits for a healthy endpoint
+        # When the breaker opened, the next breaker.wait() already covers the pause
+        if e.retry_after is None:
+          time.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_cap))
+    if self.response_cache is not None:
+      self.response_cache.put(sent[-1], reply, usage)
+    return reply
 
   def extract_body_info(self, body_text: str, context: Dict = None) -> Dict[str, Any]:
+    if self.chunk_tokens and estimate_tokens(body_text) > self.chunk_tokens:
+      return self.extract_chunked(body_text, context)
+    return self.extract_single(body_text, context)
+
+  def extract_chunked(self, body_text: str, context: Dict = None) -> Dict[str, Any]:
+    """Map-reduce over a long body: chunks are extracted concurrently and merged into one enrichment."""
+    chunks = chunk_text(body_text, self.chunk_tokens * 4) # ~4 characters per token
+    with self._usage_lock:
+      self.chunked_bodies += 1
+    contexts = [dict(context or {}, part=f"{i + 1} of {len(chunks)} of a long email") for i in range(len(chunks))]
+    # A separate small pool, so chunk calls never wait on the batch pool that is running this one
+    with ThreadPoolExecutor(max_workers=min(len(chunks), self.concurrency)) as executor:
+      parts = list(executor.map(self.extract_single, chunks, contexts))
+    return merge_enrichments(parts)
+
+  def extract_single(self, body_text: str, context: Dict = None) -> Dict[str, Any]:
     context_str = ""
     if context:
       context_str = f"\nContext: {json.dumps(context, indent=2)}"
@@ -352,139 +1569,325 @@ class QwenEntityExtractor:
 
     Return ONLY the JSON object, no additional text or markdown formatting."""
 
-    headers = {
-      "Authorization": f"Bearer {self.api_key}",
-      "Content-Type": "application/json"
-    }
-
-    payload = {
-      "model": self.model,
-      "messages": [
-        {
-          "role": "system",
-          "content": "You are an expert at analyzing email content and extracting structured information. Always return valid JSON only."
-        },
-        {
-          "role": "user",
-          "content": prompt
-        }
-      ],
-      "temperature": 0.3,
-      "max_tokens": 1000
-    }
-
     try:
-      response = requests.post(self.base_url, headers=headers, json=payload, timeout=30)
-      response.raise_for_status()
-
-      result = response.json()
-      content = result['choices'][0]['message']['content']
-
-      # Clean up the response
-      content = content.strip()
-      if content.startswith('```json'):
-          content = content[7:]
-      if content.startswith('```'):
-          content = content[3:]
-      if content.endswith('```'):
-          content = content[:-3]
-
-      extracted_info = json.loads(content.strip())
+      extracted_info = self.complete_json(self.chat_payload(prompt, self.max_tokens))
       return extracted_info
 
+    except LLMError as e:
+      print(f"Error extracting information: {e}")
+      return empty_enrichment(str(e), e.kind)
     except Exception as e:
       print(f"Error extracting information: {e}")
-      return {
-        "decisions_made": [],
-        "concerns_raised": [],
-        "people_mentioned": [],
-        "locations_mentioned": [],
-        "events_mentioned": [],
-        "financial_mentions": [],
-        "error": str(e)
-      }
+      return empty_enrichment(str(e))
 
-  def process_email_object(self, email_obj: Dict) -> tuple:
-    api_calls = 0
-    if not email_obj or '@type' not in email_obj:
-      return email_obj, api_calls
+  def extract_packed(self, entries: List[tuple]) -> Dict[str, Dict]:
+    """
+    Extract several emails in one request. entries are (id, body_text, context);
+    returns id -> extraction. Emails missing from an unparsable or incomplete
+    reply are retried with single extract_body_info calls; when the provider
+    itself failed (throttled, down, timed out, bad key) every email gets the
+    error instead, so one failed pack never turns into N more requests.
+    """
+    emails = "\n\n".join(
+      f"=== Email id: {email_id} ===\nContext: {json.dumps(context)}\nEmail Body:\n{body_text}"
+      for email_id, body_text, context in entries
+    )
+    prompt = f"""Analyze each of the following {len(entries)} emails separately and extract structured information.
+
+    {emails}
+
+    For each email extract a JSON object with the following fields:
+    1. "decisions_made": Array of decisions or conclusions
+    2. "concerns_raised": Array of concerns, risks, or issues mentioned
+    3. "people_mentioned": Array of people mentioned (beyond sender/recipient)
+    4. "locations_mentioned": Array of geographic locations mentioned
+    5. "events_mentioned": Array of events mentioned
+    6. "financial_mentions": Any financial figures, costs, or budget items mentioned
+
+    Return ONLY one JSON object whose keys are the email ids and whose values are these objects, no additional text or markdown formatting."""
 
-    # Process if it's an email message
+    extracted = {}
+    try:
+      reply = self.complete_json(self.chat_payload(prompt, self.pack_tokens_per_email * len(entries)))
+      if isinstance(reply, dict):
+        for email_id, _, _ in entries:
+          if isinstance(reply.get(email_id), dict):
+            extracted[email_id] = reply[email_id]
+    except LLMError as e:
+      if e.kind in ('rate_limit', 'server', 'timeout', 'auth'):
+        print(f"Packed request failed: {e}")
+        return {email_id: empty_enrichment(str(e), e.kind) for email_id, _, _ in entries}
+      print(f"Packed request failed, falling back to single calls: {e}")
+    except Exception as e:
+      print(f"Packed request failed: {e}")
+      return {email_id: empty_enrichment(str(e)) for email_id, _, _ in entries}
+
+    for email_id, body_text, context in entries:
+      if email_id not in extracted:
+        with self._usage_lock:
+          self.pack_fallbacks += 1
+        extracted[email_id] = self.extract_body_info(body_text, context)
+    return extracted
+
+  def plan_packs(self, pending: Dict[str, List[Dict]]) -> List[List[str]]:
+    """
+    Group pending body keys into packs under pack_token_budget; long bodies get their
+    own request, and bodies over chunk_tokens always go alone to extract_chunked.
+    """
+    if not self.pack_token_budget:
+      return [[key] for key in pending]
+    packs, current, current_tokens = [], [], 0
+    for key, objs in pending.items():
+      body_tokens = estimate_tokens(objs[0]['body'])
+      tokens = body_tokens + 50 # plus id/context header
+      if tokens > self.pack_token_budget // 2 or (self.chunk_tokens and body_tokens > self.chunk_tokens):
+        packs.append([key])
+        continue
+      if current and (current_tokens + tokens > self.pack_token_budget or len(current) >= self.max_pack_size):
+        packs.append(current)
+        current, current_tokens = [], 0
+      current.append(key)
+      current_tokens += tokens
+    if current:
+      packs.append(current)
+    return packs
+
+  def extract_pack(self, pending: Dict[str, List[Dict]], pack: List[str]) -> Dict[str, Dict]:
+    """body key -> extraction for one planned pack."""
+    if len(pack) == 1:
+      objs = pending[pack[0]]
+      return {pack[0]: self.extract_body_info(objs[0]['body'], self.email_context(objs[0]))}
+    entries = [(f"e{i + 1}", pending[key][0]['body'], self.email_context(pending[key][0])) for i, key in enumerate(pack)]
+    extracted = self.extract_packed(entries)
+    return {key: extracted[f"e{i + 1}"] for i, key in enumerate(pack)}
+
+  def collect_email_objects(self, email_obj: Dict, found: List[Dict]) -> List[Dict]:
+    """Append every email object with a body in this email and its forwardedMessage chain."""
+    if not email_obj or '@type' not in email_obj:
+      return found
     if 'EmailMessage' in email_obj.get('@type', ''):
       body = email_obj.get('body', '')
-
       if body and len(body.strip()) > 0:
-        context = {
-            "sender": email_obj.get('sender', {}).get('name', 'Unknown'),
-            "date_sent": email_obj.get('dateSent', ''),
-            "subject": email_obj.get('subject', '')
-        }
-        extracted = self.extract_body_info(body, context)
-        email_obj['enriched_content'] = extracted
-        api_calls += 1
-
-        # Rate limiting
-        time.sleep(self.rate_limit_delay)
-
-    # Recursively process forwarded messages
+        found.append(email_obj)
     if 'forwardedMessage' in email_obj:
-      email_obj['forwardedMessage'], forwarded_calls = self.process_email_object(
-        email_obj['forwardedMessage']
-      )
-      api_calls += forwarded_calls
-
-    return email_obj, api_calls
+      self.collect_email_objects(email_obj['forwardedMessage'], found)
+    return found
+
+  def email_context(self, email_obj: Dict) -> Dict:
+    return {
+        "sender": email_obj.get('sender', {}).get('name', 'Unknown'),
+        "date_sent": email_obj.get('dateSent', ''),
+        "subject": email_obj.get('subject', '')
+    }
 
-  def split_into_batches(self, input_file: str, output_dir: str):
-    if input_file.endswith('.jsonl'):
-      with open(input_file, 'r', encoding='utf-8') as f:
-        data = [json.loads(line) for line in f]
-    else:
-      with open(input_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+  def enrich_emails(self, email_objs: List[Dict], on_done = None, abort: threading.Event = None) -> int:
+    """
+    Set enriched_content on each email object (in place), extracting each
+    unique body once (packed with others when pack_token_budget is set) with
+    up to self.concurrency requests in flight. on_done(email_obj), if given, is
+    called as each email gets its content, under a lock from the worker thread
+    that finished it, so a result is handed over even if this thread is
+    interrupted. On an exception (or KeyboardInterrupt) packs not yet sent are
+    cancelled and the ones in flight are still delivered before it propagates.
+    Once abort (if given) is set, nothing more is handed to on_done and
+    ShardClaimLost is raised.
+    Returns the number of API calls made.
+    """
+    calls_before = self.api_calls
+    pending = {} # body key -> email objects waiting for it
+    skipped = {} # body key -> prefilter decision
+    for email_obj in email_objs:
+      key = BodyStore.key(email_obj['body'])
+      cached = self.reused_results.get(key)
+      if cached is not None:
+        self.reused_results.move_to_end(key)
+      if self.prefilter is not None and cached is None:
+        if key not in skipped:
+          skipped[key] = not self.prefilter.should_enrich(email_obj['body'])
+        if skipped[key]:
+          enriched = empty_enrichment()
+          enriched['skipped'] = 'prefilter'
+          email_obj['enriched_content'] = enriched
+          if on_done is not None:
+            on_done(email_obj)
+          continue
+      if cached is not None:
+        email_obj['enriched_content'] = copy.deepcopy(cached)
+        self.reused_calls += 1
+        if on_done is not None:
+          on_done(email_obj)
+      else:
+        pending.setdefault(key, []).append(email_obj)
+    self.prefiltered_calls += sum(skipped.values())
+    if not pending:
+      return 0
+
+    packs = self.plan_packs(pending)
+    done = 0
+    deliver_lock = threading.Lock()
+    deliver_errors = []
+
+    def deliver(future):
+      nonlocal done
+      if future.cancelled() or future.exception() is not None or (abort is not None and abort.is_set()):
+        return
+      try:
+        with deliver_lock:
+          for key, extracted in future.result().items():
+            for i, email_obj in enumerate(pending[key]):
+              email_obj['enriched_content'] = extracted if i == 0 else copy.deepcopy(extracted)
+              if on_done is not None:
+                on_done(email_obj)
+            self.reused_calls += len(pending[key]) - 1
+            if not extracted.get('error'):
+              self.reused_results[key] = copy.deepcopy(extracted)
+              if len(self.reused_results) > self.reuse_max_bodies:
+                self.reused_results.popitem(last=False)
+            done += 1
+            if done % 25 == 0 or done == len(pending):
+              print(f"Enriched {done}/{len(pending)} unique bodies...")
+      except BaseException as e: # e.g. a failed journal write; re-raised below
+        deliver_errors.append(e)
+
+    executor = ThreadPoolExecutor(max_workers=self.concurrency)
+    try:
+      futures = [executor.submit(self.extract_pack, pending, pack) for pack in packs]
+      for future in futures:
+        future.add_done_callback(deliver)
+      for future in as_completed(futures):
+        future.result()
+        if deliver_errors:
+          raise deliver_errors[0]
+        if abort is not None and abort.is_set():
+          raise ShardClaimLost("shard claim lost while enriching")
+    except BaseException:
+      # Don't send what is still queued; what is in flight is paid for, so wait and deliver it
+      executor.shutdown(wait=True, cancel_futures=True)
+      raise
+    executor.shutdown(wait=True)
+    if deliver_errors:
+      raise deliver_errors[0]
+    return self.api_calls - calls_before
 
-    if not isinstance(data, list):
-      data = [data]
+  def process_email_object(self, email_obj: Dict) -> tuple:
+    api_calls = self.enrich_emails(self.collect_email_objects(email_obj, []))
+    return email_obj, api_calls
 
+  def split_into_batches(self, input_file: str, output_dir: str, batch_format: str = 'json',
+                         target_cost: int = DEFAULT_BATCH_COST, items_per_batch: int = 10):
+    """
+    Split the input into batch_NNN files; batch_format='msgpack' writes compact binary batches.
+    Batches are packed by estimated work (item_cost: emails and body tokens) up to
+    target_cost tokens; target_cost=None falls back to a fixed items_per_batch.
+    A manifest (shards.json) lists every batch with its item, email and cost totals.
+    """
     # Create output directory
     Path(output_dir).mkdir(exist_ok=True)
-    items_per_batch = 10 
-
-    print(f"\nBatch Planning:")
-    print(f"   Total items: {len(data)}")
-    print(f"   Items per batch: {items_per_batch}")
-    print(f"   Total batches needed: {(len(data) + items_per_batch - 1) // items_per_batch}")
 
+    # Stream records into batch files, holding one batch in memory at a time
     batch_files = []
-    for i in range(0, len(data), items_per_batch):
-      batch_num = (i // items_per_batch) + 1
-      batch = data[i:i+items_per_batch]
-      batch_filename = f"{output_dir}/batch_{batch_num:03d}.json"
-      with open(batch_filename, 'w', encoding='utf-8') as f:
-        json.dump(batch, f, ensure_ascii=False, indent=2)
-
+    manifest = []
+    total_items = 0
+    batch, batch_emails, batch_cost = [], 0, 0
+
+    def flush():
+      batch_num = len(batch_files) + 1
+      batch_filename = f"{output_dir}/batch_{batch_num:03d}.{batch_format}"
+      with RecordWriter(batch_filename) as writer:
+        for item in batch:
+          writer.write(item)
       batch_files.append(batch_filename)
-      
+      manifest.append({'file': Path(batch_filename).name, 'items': len(batch),
+                       'emails': batch_emails, 'cost': batch_cost})
+
+    for item, output_obj in iter_cases(input_file):
+      emails = sum(1 for _ in iter_email_paths(output_obj))
+      cost = item_cost(output_obj)
+      full = len(batch) >= items_per_batch if not target_cost else batch_cost + cost > target_cost
+      if batch and full:
+        flush()
+        batch, batch_emails, batch_cost = [], 0, 0
+      batch.append(item)
+      batch_emails += emails
+      batch_cost += cost
+      total_items += 1
+    if batch:
+      flush()
+
+    with open(Path(output_dir) / SHARD_MANIFEST, 'w', encoding='utf-8') as f:
+      json.dump({'target_cost': target_cost, 'shards': manifest}, f, indent=2)
+
+    costs = [shard['cost'] for shard in manifest] or [0]
+    print(f"\nBatch Planning:")
+    print(f"   Total items: {total_items}")
+    if target_cost:
+      print(f"   Target cost per batch: {target_cost} tokens (min {min(costs)}, max {max(costs)})")
+    else:
+      print(f"   Items per batch: {items_per_batch}")
+    print(f"   Total batches needed: {len(batch_files)}")
     print(f"\nCreated {len(batch_files)} batch files in '{output_dir}/' directory\n")
     return batch_files
 
-  def process_batch(self, batch_file: str, output_file: str):
-        """Process a single batch file"""
+  def process_shards(self, batch_dir: str, output_dir: str, worker_id: str = None, stale_after: float = 600):
+    """
+    Worker loop over the shard manifest written by split_into_batches. Any number
+    of workers (processes or machines sharing the folders) can run it at once:
+    each claims the next unclaimed, unfinished shard, largest first, so long
+    shards start early and workers finish at about the same time.
+    Claims are refreshed every stale_after / 3 seconds while a shard runs; one
+    left unrefreshed for stale_after (a dead worker elsewhere), or whose process
+    on this host has exited, is taken over and resumed from its journal.
+    Returns the API calls this worker made.
+    """
+    worker_id = worker_id or f"{platform.node()}-{os.getpid()}"
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    with open(Path(batch_dir) / SHARD_MANIFEST, 'r', encoding='utf-8') as f:
+      shards = sorted(json.load(f)['shards'], key=lambda shard: -shard['cost'])
+
+    total_calls, processed = 0, 0
+    for shard in shards:
+      output_file = Path(output_dir) / f"enriched_{shard['file']}"
+      # Finished: output written and its journal compacted away
+      if output_file.exists() and not journal_path(output_file).exists():
+        continue
+      claim_file = Path(output_dir) / f"{shard['file']}.claim"
+      token = claim_shard(claim_file, worker_id, stale_after)
+      if token is None:
+        continue
+      print(f"[{worker_id}] Processing {shard['file']} ({shard['items']} items, {shard['emails']} emails, cost {shard['cost']})")
+      try:
+        with ClaimHeartbeat(claim_file, worker_id, token, stale_after / 3) as heartbeat:
+          total_calls += self.process_batch(str(Path(batch_dir) / shard['file']), str(output_file), abort=heartbeat.lost)
+      except ShardClaimLost:
+        print(f"[{worker_id}] Stopped {shard['file']}: another worker took it over")
+        continue
+      if (read_claim(claim_file) or {}).get('token') == token:
+        claim_file.unlink(missing_ok=True)
+      processed += 1
+    print(f"[{worker_id}] No shards left; processed {processed}, {total_calls} API calls")
+    return total_calls
+
+  def process_batch(self, batch_file: str, output_file: str, resume: bool = True, abort: threading.Event = None):
+        """
+        Process a single batch file. Completed emails are journaled as they
+        finish; with resume=True a rerun after a crash only sends the rest.
+        If abort (set by process_shards' ClaimHeartbeat) is set, it stops with
+        ShardClaimLost without journaling more or writing the output.
+        """
 
         start_time = datetime.datetime.now()
+        reused_before = self.reused_calls
+        prefiltered_before = self.prefiltered_calls
+        chunked_before = self.chunked_bodies
 
-        with open(batch_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-
-        if not isinstance(data, list):
-            data = [data]
+        data = list(iter_records(batch_file))
 
         enriched_data = []
-        total_api_calls = 0
+        email_objs = [] # every email in the batch, enriched together below
+        locations = {} # id(email object) -> (item index, path in the case)
         total_items = len(data)
         
         for idx, item in enumerate(data, 1):
-            print(f"Processing item {idx}/{total_items} (Id: {item.get('email_id', 'N/A')})...")
 
             # Parse the output field if it's a string
             if 'output' in item and isinstance(item['output'], str):
@@ -492,144 +1895,183 @@ class QwenEntityExtractor:
                     output_obj = json.loads(item['output'])
                 except json.JSONDecodeError as e:
                     print(f"Error parsing output JSON: {e}")
-                    enriched_data.append(item)
+                    enriched_data.append((item, None))
                     continue
             else:
-                output_obj = item
-
-            # Process hasPart
-            has_part = output_obj.get('hasPart')
-            item_api_calls = 0
+                output_obj = item.get('output', item)
 
-            if has_part:
-                if isinstance(has_part, list):
-                    # Process array of emails
-                    for email_idx, email in enumerate(has_part):
-                        print(f"Processing email {email_idx + 1}/{len(has_part)}...")
-                        has_part[email_idx], calls = self.process_email_object(email)
-                        item_api_calls += calls
-                elif isinstance(has_part, dict):
-                    # Process single email
-                    output_obj['hasPart'], item_api_calls = self.process_email_object(has_part)
-
-            # Reconstruct the item
-            if 'output' in item and isinstance(item['output'], str):
-                item['output'] = json.dumps(output_obj, ensure_ascii=False, indent=2)
+            # Collect the emails of hasPart; their enriched_content is set in place
+            for path, email_obj in iter_email_paths(output_obj):
+                email_objs.append(email_obj)
+                locations[id(email_obj)] = (idx - 1, path)
 
-            enriched_data.append(item)
-            total_api_calls += item_api_calls
+            enriched_data.append((item, output_obj))
 
-        # Save enriched data
+        # Replay what an interrupted run already finished
+        journal = EnrichmentJournal(journal_path(output_file), Path(batch_file).name)
+        entries = journal.load() if resume else []
+        done = set()
+        for entry in entries:
+            try:
+                email_obj = get_at_path(enriched_data[entry['item']][1], entry['path'])
+            except (IndexError, KeyError, TypeError):
+                continue
+            if BodyStore.key(email_obj.get('body', '')) == entry['key']:
+                email_obj['enriched_content'] = entry['enriched_content']
+                done.add(id(email_obj))
+        if done:
+            print(f"Resuming: {len(done)} emails already enriched in an earlier run")
+        email_objs = [e for e in email_objs if id(e) not in done]
+
+        def record(email_obj):
+            enriched = email_obj['enriched_content']
+            if not enriched.get('error'):
+                item_idx, path = locations[id(email_obj)]
+                journal.record(item_idx, path, BodyStore.key(email_obj['body']), enriched)
+
+        journal.open(resume=bool(entries))
+        try:
+            print(f"Enriching {len(email_objs)} emails from {total_items} items...")
+            total_api_calls = self.enrich_emails(email_objs, on_done=record, abort=abort)
+        finally:
+            journal.close()
+        if abort is not None and abort.is_set():
+            raise ShardClaimLost(f"shard claim lost before saving {output_file}")
+
+        # Save enriched data (the item is reconstructed in the output file's format)
         print(f"\nSaving enriched data to {output_file}...")
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(enriched_data, f, ensure_ascii=False, indent=2)
+        with RecordWriter(output_file) as writer:
+            for item, output_obj in enriched_data:
+                writer.write(item, output_obj)
+        failures = batch_failures(output_file, enriched_data)
+        write_failure_index(output_file, failures)
+        journal.remove() # compacted into output_file
 
         end_time = datetime.datetime.now()
         duration = (end_time - start_time).total_seconds()
 
         print(f"\nBATCH COMPLETE!")
         print(f"   Time taken: {duration/3600:.2f} hours ({duration/60:.1f} minutes)")
+        print(f"   API calls: {total_api_calls}")
+        print(f"   Failed emails: {len(failures)}")
+        print(f"   Repeated bodies reused: {self.reused_calls - reused_before}")
+        if self.chunked_bodies > chunked_before:
+            print(f"   Long bodies extracted in chunks: {self.chunked_bodies - chunked_before}")
+        if self.prefilter is not None:
+            print(f"   Calls saved by prefilter: {self.prefiltered_calls - prefiltered_before}")
+        if self.response_cache is not None:
+            print(f"   Response cache: {self.response_cache.hits} hits, {self.response_cache.misses} misses")
+        if self.error_counts:
+            print(f"   Failed attempts by kind: {dict(self.error_counts)} (breaker trips: {self.breaker.trips})")
+        if self.dispatcher is not None:
+            print(f"   Endpoints: {self.dispatcher.summary()}")
 
         return total_api_calls
 
 # class to re-process failed batches
 class reprocessFailedBatch:
-  def __init__(self,api_key):
-    self.api_key2 = api_key2
+  def __init__(self,api_key,model:str = None,cache_path:str = None,dispatcher:LLMDispatcher = None,
+               base_url:str = OPENROUTER_URL):
+    self.api_key = api_key
+    self.base_url = base_url
+    self.model = model or os.getenv('QWEN_MODEL')
+    # Point at the cache used for the first run so items that succeeded are not paid for again
+    self.cache_path = cache_path
+    self.dispatcher = dispatcher # optional pool of (key, model) endpoints
   
   # find out the failed batch
   def find_error_inBatches(self,enriched_folder: str):
+    """
+    Names of enriched batch files with failed emails. Uses the failure index
+    process_batch writes next to each batch; batches written before the index
+    existed are scanned instead.
+    """
     errors_files = []   
-    enriched_path = Path(enriched_folder)    
-    batch_files = sorted(f for f in enriched_path.glob("enriched_batch_*.json") if not str(f).endswith("_failed.json"))    
-    print(f"Scanning {len(batch_files)} enriched batch files for errors...\n")    
+    batch_files = list_enriched_batches(enriched_folder)
+    print(f"Checking {len(batch_files)} enriched batch files for errors...\n")    
     for batch_file in batch_files:
-      batch_has_error = False 
-      with open(batch_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)        
-      for item in data:
-        if 'output' in item and isinstance(item['output'], str):
-            try:
-                output_obj = json.loads(item['output'])
-            except:
-                output_obj = item
-        else:
-            output_obj = item.get('output', item)
-        
-        # Check hasPart for errors
-        has_part = output_obj.get('hasPart')                    
-        if has_part:
-          if isinstance(has_part, list):
-            for sub_item in has_part:
-              enriched = sub_item.get('enriched_content', {})
-              if isinstance(enriched, dict) and 'error' in enriched and enriched['error']:
-                  batch_has_error = True
-                  break  # Break inner loop
-          elif isinstance(has_part, dict):
-            enriched = has_part.get('enriched_content', {})
-            if isinstance(enriched, dict) and 'error' in enriched and enriched['error']:
-                batch_has_error = True
-        if batch_has_error:
-          break  # no need to check further, this batch has at least one failed index
+      if failure_index_path(batch_file).exists():
+        batch_has_error = bool(read_failure_index(batch_file))
+      else:
+        batch_has_error = bool(self.index_failures(batch_file))
       if batch_has_error:
         errors_files.append(batch_file.name)
         print(f"{batch_file.name} - Has errors")
     return errors_files  
 
+  def index_failures(self,batch_file):
+    """Scan an enriched batch without a failure index and write one."""
+    failures = batch_failures(batch_file, iter_cases(batch_file))
+    write_failure_index(batch_file, failures)
+    return failures
+
   def reprocess_failed_batches(self,batch_dir:str,enriched_dir:str):
+    """
+    Re-enrich only the emails listed in each batch's failure index and patch
+    them into the enriched file in place. batch_dir (the original, un-enriched
+    batches) is no longer needed and only kept for existing callers.
+    """
     errors = self.find_error_inBatches(f"{enriched_dir}")
     if not errors:
       print("No errors found to preprocess!")
       return None
 
-    reprocessor = QwenEntityExtractor(api_key=api_key2)
+    reprocessor = QwenEntityExtractor(api_key=self.api_key, model=self.model, cache_path=self.cache_path,
+                                      dispatcher=self.dispatcher, base_url=self.base_url)
+    total_calls = 0
     for failed_filename in errors:
-      failed_file_path = f"{enriched_dir}/{failed_filename}"
-      batch_num = failed_filename.split("_")[-1].split(".")[0] #extracting batch number
-      print(f"\nRe-processing batch {batch_num}")
-      # Renaming old failed enriched file
-      failed_backup = failed_file_path.replace(".json", "_failed.json")
-      os.rename(failed_file_path, failed_backup)
-      # Getting original batch file for reprocessing
-      input_batch = f"{batch_dir}/batch_{batch_num}.json"
-      # Output new enriched file
-      output_batch = f"{enriched_dir}/enriched_batch_{batch_num}.json"
-      # Re-run the extractor
-      calls = reprocessor.process_batch(
-        batch_file=input_batch,
-        output_file=output_batch
-      )
-      print(f"Completed reprocessing batch {batch_num}")
+      enriched_file = Path(enriched_dir) / failed_filename
+      failures = read_failure_index(enriched_file)
+      print(f"\nRe-processing {len(failures)} failed emails in {failed_filename}")
+      cases = list(iter_cases(enriched_file))
+      email_objs = []
+      for entry in failures:
+        email_obj = get_at_path(cases[entry['item']][1], entry['path'])
+        email_obj.pop('enriched_content', None)
+        email_objs.append(email_obj)
+      total_calls += reprocessor.enrich_emails(email_objs)
+
+      # Rewrite the batch with the patched cases, then the index with what still fails
+      with RecordWriter(enriched_file) as writer:
+        for item, output_obj in cases:
+          writer.write(item, output_obj)
+      remaining = batch_failures(enriched_file, cases)
+      write_failure_index(enriched_file, remaining)
+      print(f"Completed {failed_filename}: {len(failures) - len(remaining)} fixed, {len(remaining)} still failing")
+    return total_calls
+
+# list enriched (enriched_batch_* or processed_batch_*) batch files (.json or .msgpack), skipping *_failed backups
+def list_enriched_batches(enriched_folder: str):
+    enriched_path = Path(enriched_folder)
+    return sorted(
+        f for prefix in ("enriched_batch_", "processed_batch_") for suffix in (".json", ".msgpack")
+        for f in enriched_path.glob(f"{prefix}*{suffix}") if not f.stem.endswith("_failed")
+    )
 
 # function to merge batch class into single jsonl file
-def merge_batches_to_jsonl(enriched_folder: str, output_file: str): 
-    enriched_path = Path(enriched_folder)
-    batch_files = sorted(f for f in enriched_path.glob("enriched_batch_*.json") if not str(f).endswith("_failed.json"))
+def merge_batches_to_jsonl(enriched_folder: str, output_file: str, return_data: bool = False,
+                           index_dir: str = None, top_k: int = None): 
+    """
+    Stream every enriched batch into one output file; returns the number of items
+    written, or the items themselves with return_data=True.
+    A .msgpack output_file keeps the cases decoded for the Neo4j import.
+    With index_dir, the back-references of incremental cross-reference runs are
+    applied on the way (capped at top_k, by default the one the runs used).
+    """
+    data = [] if return_data else None
+    batch_files = list_enriched_batches(enriched_folder)
+    deltas = BackReferenceDeltas(index_dir, top_k) if index_dir else None
     
     print(f"Found {len(batch_files)} batch files to merge\n")
-    all_items = []    
-    for batch_file in batch_files:        
-        with open(batch_file, 'r', encoding='utf-8') as f:
-            batch_data = json.load(f)        
-        all_items.extend(batch_data)
-      
-    with open(output_file, 'w', encoding='utf-8') as f:
-        for item in all_items:
-            json_line = json.dumps(item, ensure_ascii=False)
-            f.write(json_line + '\n')    
-    return all_items
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+    with RecordWriter(output_file) as writer:
+        for batch_file in batch_files:
+            if deltas is None:
+                cases = ((item, None) for item in iter_records(batch_file))
+            else:
+                cases = iter_cases(batch_file)
+            for item, output_obj in cases:
+                patched = deltas is not None and deltas.apply_to_case(item.get('email_id'), output_obj)
+                writer.write(item, output_obj if patched else None)
+                if return_data:
+                    data.append(item)
+    return data if return_data else writer.count
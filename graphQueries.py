@@ -1,5 +1,8 @@
 from neo4j import GraphDatabase
-import json, time
+import json, time, os, csv, hashlib, heapq, zlib, multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from recordStream import is_msgpack, iter_records
 from typing import Any, Dict, List, Union
 
 
@@ -67,6 +70,28 @@ def setup_constraints(uri, user, password):
         FOR (c:Concern)
         REQUIRE c.text IS UNIQUE
         """,
+        """
+        CREATE CONSTRAINT rxnormdrug_name IF NOT EXISTS
+        FOR (r:RxNormDrug)
+        REQUIRE r.name IS UNIQUE
+        """,
+        """
+        CREATE CONSTRAINT location_name IF NOT EXISTS
+        FOR (l:Location)
+        REQUIRE l.name IS UNIQUE
+        """,
+        # Events and financials are CREATEd per email by upsert_enriched_content_for_email
+        # but MERGEd on text by the batched import, so index rather than constrain
+        """
+        CREATE INDEX event_text IF NOT EXISTS
+        FOR (ev:Event)
+        ON (ev.text)
+        """,
+        """
+        CREATE INDEX financial_text IF NOT EXISTS
+        FOR (f:Financial)
+        ON (f.text)
+        """,
 
         # FinancialMention – there are two flavors, so we use two constraints:
         # one for simple text mentions, one for (description, figure, currency)
@@ -469,85 +494,136 @@ def upsert_email_recursive(tx, case_id: str, email_obj: Dict[str, Any], parent_e
 
 # ----------------- Main import with logging & error handling ----------------- #
 
+def parse_case_line(line_no: int, line: Union[str, Dict[str, Any]], stats: Dict[str, int]):
+    """
+    Decode one enriched JSONL line (or an already-unpacked .msgpack record)
+    into its case object.
+
+    Blank lines, broken wrappers and missing/invalid 'output' fields are logged,
+    counted in stats['skipped_lines'] and returned as None.
+    """
+    if isinstance(line, dict):
+        wrapper = line
+    else:
+        line = line.strip()
+        if not line:
+            stats["skipped_lines"] += 1
+            return None
+
+        try:
+            wrapper = json.loads(line)
+        except json.JSONDecodeError as e:
+            print(f"[WARN] Skipping line {line_no}: invalid JSON wrapper ({e})")
+            stats["skipped_lines"] += 1
+            return None
+
+    output_raw = wrapper.get("output")
+    if not output_raw:
+        print(f"[WARN] Skipping line {line_no}: no 'output' field")
+        stats["skipped_lines"] += 1
+        return None
+
+    if isinstance(output_raw, dict):
+        return output_raw
+    try:
+        return json.loads(output_raw)
+    except json.JSONDecodeError:
+        print(f"[WARN] Skipping line {line_no}: invalid 'output' JSON")
+        stats["skipped_lines"] += 1
+        return None
+
+
+def iter_numbered_lines(jsonl_path: str):
+    """Yield (line_no, line) from a JSONL file, or (record_no, record) from a .msgpack file."""
+    if is_msgpack(jsonl_path):
+        yield from enumerate(iter_records(jsonl_path), start=1)
+        return
+    with open(jsonl_path, "r", encoding="utf-8") as f:
+        yield from enumerate(f, start=1)
+
+
+def iter_case_objects(jsonl_path: str, stats: Dict[str, int]):
+    """Stream (line_no, case_obj) pairs out of an enriched JSONL (or .msgpack) file."""
+    for line_no, line in iter_numbered_lines(jsonl_path):
+        stats["total_lines"] += 1
+        case_obj = parse_case_line(line_no, line, stats)
+        if case_obj is not None:
+            yield line_no, case_obj
+
+
+def print_import_summary(stats: Dict[str, int], start_time: float):
+    print("\n=== Import summary ===")
+    print(f"Total lines read:     {stats['total_lines']}")
+    print(f"Successful cases:     {stats['success_cases']}")
+    print(f"Failed cases:         {stats['failed_cases']}")
+    print(f"Skipped lines:        {stats['skipped_lines']}")
+    if "unchanged_cases" in stats:
+        print(f"Unchanged cases:      {stats['unchanged_cases']}")
+    print('Runtime (s):          ', time.time() - start_time)
+
+
 def import_jsonl_to_neo4j(
     jsonl_path: str,
     uri: str,
     user: str,
     password: str,
     log_every: int = 25,
+    skip_unchanged: bool = False,
 ):
     """
     Import JSONL case/email schemas into Neo4j with:
       - progress logging every `log_every` lines
       - per-line try/except so a bad record doesn't kill the whole run
+      - with `skip_unchanged`, cases whose content hash matches Case.content_hash
+        are skipped and changed cases have their stale child edges replaced
     """
     driver = GraphDatabase.driver(uri, auth=(user, password))
 
-    total_lines = 0
-    success_cases = 0
-    skipped_lines = 0
-    failed_cases = 0
+    stats = {"total_lines": 0, "success_cases": 0, "skipped_lines": 0, "failed_cases": 0}
+    start_time = time.time()
 
     with driver.session() as session:
-        with open(jsonl_path, "r", encoding="utf-8") as f:
-            start_time = time.time()
-            for line_no, line in enumerate(f, start=1):
-                total_lines += 1
-                line = line.strip()
-                if not line:
-                    skipped_lines += 1
-                    continue
-
-                # Progress log
-                if line_no % log_every == 0:
-                    print(f"[INFO] Processing line {line_no}... (success={success_cases}, failed={failed_cases}, skipped={skipped_lines})")
-                    print('\t took', time.time() - start_time, 'seconds')
-
-                try:
-                    wrapper = json.loads(line)
-                except json.JSONDecodeError as e:
-                    print(f"[WARN] Skipping line {line_no}: invalid JSON wrapper ({e})")
-                    skipped_lines += 1
+        known_hashes = None
+        if skip_unchanged:
+            known_hashes = session.execute_read(load_case_hashes)
+            stats["unchanged_cases"] = 0
+
+        for line_no, case_obj in iter_case_objects(jsonl_path, stats):
+            # Progress log
+            if line_no % log_every == 0:
+                print(f"[INFO] Processing line {line_no}... (success={stats['success_cases']}, failed={stats['failed_cases']}, skipped={stats['skipped_lines']})")
+                print('\t took', time.time() - start_time, 'seconds')
+
+            case_id = case_obj.get("identifier")
+
+            content_hash = None
+            if known_hashes is not None and case_id:
+                content_hash = case_content_hash(case_obj)
+                if known_hashes.get(case_id) == content_hash:
+                    stats["unchanged_cases"] += 1
                     continue
 
-                output_raw = wrapper.get("output")
-                if not output_raw:
-                    print(f"[WARN] Skipping line {line_no}: no 'output' field")
-                    skipped_lines += 1
-                    continue
-
-                try:
-                    case_obj = json.loads(output_raw)
-                except json.JSONDecodeError:
-                    if isinstance(output_raw, dict):
-                        case_obj = output_raw
-                    else:
-                        print(f"[WARN] Skipping line {line_no}: invalid 'output' JSON")
-                        skipped_lines += 1
-                        continue
-
-                case_id = case_obj.get("identifier")
+            # Wrap the write in try/except so a single bad case doesn't kill everything
+            try:
+                def work(tx):
+                    if content_hash and case_id in known_hashes:
+                        clear_case_children(tx, [case_id], case_email_ids(case_obj))
+                    upsert_case(tx, case_obj)
+                    if content_hash:
+                        set_case_hashes(tx, {case_id: content_hash})
 
-                # Wrap the write in try/except so a single bad case doesn't kill everything
-                try:
-                    def work(tx):
-                        upsert_case(tx, case_obj)
+                session.execute_write(work)
+                stats["success_cases"] += 1
+                if content_hash:
+                    known_hashes[case_id] = content_hash
 
-                    session.execute_write(work)
-                    success_cases += 1
-
-                except Exception as e:
-                    failed_cases += 1
-                    print(f"[ERROR] Failed to import case on line {line_no} (case_id={case_id!r}): {type(e).__name__}: {e}")
+            except Exception as e:
+                stats["failed_cases"] += 1
+                print(f"[ERROR] Failed to import case on line {line_no} (case_id={case_id!r}): {type(e).__name__}: {e}")
 
     driver.close()
 
-    print("\n=== Import summary ===")
-    print(f"Total lines read:     {total_lines}")
-    print(f"Successful cases:     {success_cases}")
-    print(f"Failed cases:         {failed_cases}")
-    print(f"Skipped lines:        {skipped_lines}")
-    print('Runtime (s):          ', time.time() - start_time)
+    print_import_summary(stats, start_time)
 
 
 
@@ -896,3 +972,1059 @@ def upsert_email_recursive(tx, case_id: str, email_obj: Dict[str, Any], parent_e
                     target_email_id=cid,
                     similarity_score=score,
                 )
+
+
+# ================== BATCHED UNWIND IMPORT ==================
+#
+# The upsert_* helpers above send one tx.run per node and per relationship.
+# The flatten_* helpers below walk a case with the same mapping rules, but only
+# collect rows into a GraphBatch; write_graph_batch then sends one
+# UNWIND ... MERGE statement per label and per relationship type.
+
+# Label -> property used as the MERGE key
+NODE_KEYS = {
+    "Case": "identifier",
+    "Email": "identifier",
+    "Person": "key",
+    "Organization": "name",
+    "Document": "name",
+    "Place": "name",
+    "TopicEntity": "name",
+    "RxNormDrug": "name",
+    "Location": "name",
+    "Decision": "text",
+    "Concern": "text",
+    "Event": "text",
+    "Financial": "text",
+}
+
+# Labels whose properties are only filled in when still missing
+# (mirrors the coalesce() SETs in upsert_rxnorm_drug_for_email / enriched locations)
+COALESCE_NODE_STATEMENTS = {
+    "RxNormDrug": """
+        UNWIND $rows AS row
+        MERGE (n:RxNormDrug {name: row.key})
+        SET
+          n.rxnorm_id = coalesce(n.rxnorm_id, row.props.rxnorm_id),
+          n.source    = coalesce(n.source, row.props.source)
+        """,
+    "Location": """
+        UNWIND $rows AS row
+        MERGE (n:Location {name: row.key})
+        SET n.source = coalesce(n.source, row.props.source)
+        """,
+}
+
+# Enriched-content list fields -> (label, relationship type)
+ENRICHED_TEXT_FIELDS = [
+    ("decisions_made",     "Decision",  "HAS_DECISION"),
+    ("concerns_raised",    "Concern",   "HAS_CONCERN"),
+    ("events_mentioned",   "Event",     "HAS_EVENT"),
+    ("financial_mentions", "Financial", "HAS_FINANCIAL"),
+]
+
+
+class GraphBatch:
+    """
+    Node and relationship rows for a window of cases, deduplicated by key.
+
+    Repeated SETs on the same node collapse into one props dict (last value wins,
+    like sequential tx.run calls); labels in COALESCE_NODE_STATEMENTS keep the
+    first non-null value instead.
+    """
+
+    def __init__(self):
+        self.nodes: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self.rels: Dict[tuple, Dict[tuple, Dict[str, Any]]] = {}
+        self.case_count = 0
+        # Manifest bookkeeping (see flatten_changed_case)
+        self.case_hashes: Dict[str, str] = {}
+        self.stale_case_ids: List[str] = []
+        self.stale_email_ids: List[str] = [] # emails the new versions of stale cases still have
+
+    def add_node(self, label: str, key: str, props: Dict[str, Any] = None):
+        existing = self.nodes.setdefault(label, {}).setdefault(key, {})
+        for prop, value in (props or {}).items():
+            if label in COALESCE_NODE_STATEMENTS:
+                if existing.get(prop) is None:
+                    existing[prop] = value
+            else:
+                existing[prop] = value
+
+    def add_rel(self, rel_type: str, start_label: str, start_key: str,
+                end_label: str, end_key: str, props: Dict[str, Any] = None):
+        group = self.rels.setdefault((rel_type, start_label, end_label), {})
+        group.setdefault((start_key, end_key), {}).update(props or {})
+
+    def merge(self, other: "GraphBatch"):
+        for label, rows in other.nodes.items():
+            for key, props in rows.items():
+                self.add_node(label, key, props)
+        for (rel_type, start_label, end_label), rows in other.rels.items():
+            for (start_key, end_key), props in rows.items():
+                self.add_rel(rel_type, start_label, start_key, end_label, end_key, props)
+        self.case_count += other.case_count
+        self.case_hashes.update(other.case_hashes)
+        self.stale_case_ids.extend(other.stale_case_ids)
+        self.stale_email_ids.extend(other.stale_email_ids)
+
+    def is_empty(self) -> bool:
+        return not self.nodes and not self.rels
+
+
+def flatten_case(batch: GraphBatch, case_obj: Dict[str, Any]):
+    """Batched counterpart of upsert_case."""
+    case_id = case_obj.get("identifier")
+    if not case_id:
+        return
+
+    batch.add_node("Case", case_id, {
+        "semantic_type": case_obj.get("semantic_type"),
+        "legalStatus": case_obj.get("legalStatus"),
+        "dateFiled": case_obj.get("dateFiled"),
+        "confidentialityNotice": case_obj.get("confidentialityNotice"),
+        "language": case_obj.get("language"),
+    })
+    batch.case_count += 1
+
+    # Case-level mentions
+    for mention in case_obj.get("mentions") or []:
+        if isinstance(mention, dict) and mention.get("name"):
+            label = "Place" if mention.get("@type") == "gpe" else "TopicEntity"
+            batch.add_node(label, mention.get("name"), {
+                "semantic_type": mention.get("semantic_type"),
+                "identifier": mention.get("identifier"),
+            })
+            batch.add_rel("CASE_MENTIONS", "Case", case_id, label, mention.get("name"))
+
+    # hasPart emails
+    for email_obj in ensure_list(case_obj.get("hasPart")):
+        if isinstance(email_obj, dict):
+            flatten_email_recursive(batch, case_id, email_obj, parent_email_id=None)
+
+
+def flatten_person(batch: GraphBatch, person: Dict[str, Any]) -> str:
+    """Batched counterpart of upsert_person / upsert_org_for_person."""
+    if not person:
+        return None
+
+    name = person.get("name") or "Unknown"
+    email_addr = person.get("email")
+    key = email_addr or name
+
+    batch.add_node("Person", key, {
+        "name": name,
+        "email": email_addr,
+        "semantic_type": person.get("semantic_type"),
+    })
+
+    org = person.get("affiliation")
+    if isinstance(org, dict) and org.get("name"):
+        org_name = org.get("name")
+        batch.add_node("Organization", org_name, {
+            "semantic_type": org.get("semantic_type"),
+            "role": org.get("role"),
+        })
+        batch.add_rel("AFFILIATED_WITH", "Person", key, "Organization", org_name)
+
+        parent = org.get("parentOrganization")
+        if isinstance(parent, dict) and parent.get("name"):
+            batch.add_node("Organization", parent.get("name"), {
+                "semantic_type": parent.get("semantic_type"),
+                "role": parent.get("role"),
+            })
+            batch.add_rel("SUBSIDIARY_OF", "Organization", org_name, "Organization", parent.get("name"))
+
+    return key
+
+
+def flatten_rxnorm_drug(batch: GraphBatch, email_id: str, drug):
+    """Batched counterpart of upsert_rxnorm_drug_for_email."""
+    if isinstance(drug, str):
+        name = drug.strip()
+        rxcui = None
+        source = None
+    elif isinstance(drug, dict):
+        name = (drug.get("name") or drug.get("drug_name") or drug.get("id") or "").strip()
+        rxcui = drug.get("rxcui") or drug.get("rxnorm_id")
+        source = drug.get("source") or drug.get("origin") or "RxNorm"
+    else:
+        return
+
+    if not name:
+        return
+
+    batch.add_node("RxNormDrug", name, {"rxnorm_id": rxcui, "source": source})
+    batch.add_rel("EMAIL_MENTIONS_DRUG", "Email", email_id, "RxNormDrug", name)
+
+
+def flatten_enriched_content(batch: GraphBatch, email_id: str, enriched: Dict[str, Any]):
+    """Batched counterpart of upsert_enriched_content_for_email.
+
+    Text nodes are MERGEd on text rather than CREATEd per email, which matches
+    the uniqueness constraints in setup_constraints and lets rows be deduplicated.
+    """
+    for field, label, rel_type in ENRICHED_TEXT_FIELDS:
+        for item in enriched.get(field) or []:
+            if item is None:
+                continue
+            if isinstance(item, dict):
+                text = (item.get("text") or item.get("value") or "").strip()
+                source = item.get("source")
+            else:
+                text = str(item).strip()
+                source = None
+            if not text:
+                continue
+            batch.add_node(label, text, {"source": source})
+            batch.add_rel(rel_type, "Email", email_id, label, text)
+
+    # Locations
+    for loc in enriched.get("locations_mentioned") or []:
+        if loc is None:
+            continue
+        if isinstance(loc, dict):
+            name = (loc.get("name") or "").strip()
+            source = loc.get("source")
+        else:
+            name = str(loc).strip()
+            source = None
+        if not name:
+            continue
+        batch.add_node("Location", name, {"source": source})
+        batch.add_rel("EMAIL_MENTIONS_LOCATION", "Email", email_id, "Location", name)
+
+    # People mentioned
+    for pm in enriched.get("people_mentioned") or []:
+        if pm is None:
+            continue
+        if isinstance(pm, dict):
+            name = (pm.get("name") or "").strip()
+            email_addr = pm.get("email") or None
+        else:
+            name = str(pm).strip()
+            email_addr = None
+        if not name:
+            continue
+        person_key = flatten_person(batch, {"name": name, "email": email_addr, "semantic_type": "Person"})
+        if person_key:
+            batch.add_rel("MENTIONS_PERSON_ENRICHED", "Email", email_id, "Person", person_key)
+
+
+def flatten_email_recursive(batch: GraphBatch, case_id: str, email_obj: Dict[str, Any], parent_email_id: str = None):
+    """Batched counterpart of upsert_email_recursive (the override version)."""
+    if not email_obj:
+        return
+
+    email_id = email_obj.get("identifier") or email_obj.get("id")
+    if not email_id:
+        email_id = f"{email_obj.get('subject', 'Unknown')}|{email_obj.get('dateSent', '')}"
+
+    batch.add_node("Email", email_id, {
+        "semantic_type": email_obj.get("semantic_type"),
+        "subject": email_obj.get("subject"),
+        "dateSent": email_obj.get("dateSent"),
+        "importance": email_obj.get("importance"),
+        "body": email_obj.get("body"),
+    })
+
+    if case_id:
+        batch.add_rel("HAS_EMAIL", "Case", case_id, "Email", email_id)
+
+    if parent_email_id:
+        batch.add_rel("FORWARDED_MESSAGE", "Email", parent_email_id, "Email", email_id)
+
+    # Sender
+    sender = email_obj.get("sender")
+    if isinstance(sender, dict):
+        sender_key = flatten_person(batch, sender)
+        if sender_key:
+            batch.add_rel("SENT", "Person", sender_key, "Email", email_id)
+
+    # Recipients
+    for rcpt in email_obj.get("recipient") or []:
+        if isinstance(rcpt, dict):
+            rcpt_key = flatten_person(batch, rcpt)
+            if rcpt_key:
+                batch.add_rel("SENT_TO", "Email", email_id, "Person", rcpt_key)
+
+    # Mentions
+    for mention in email_obj.get("mentions") or []:
+        if isinstance(mention, dict) and mention.get("name"):
+            if mention.get("@type") == "gpe":
+                label, rel_type = "Place", "EMAIL_MENTIONS_PLACE"
+            else:
+                label, rel_type = "TopicEntity", "EMAIL_MENTIONS_TOPIC"
+            batch.add_node(label, mention.get("name"), {
+                "semantic_type": mention.get("semantic_type"),
+                "identifier": mention.get("identifier"),
+                "role": mention.get("role"),
+            })
+            batch.add_rel(rel_type, "Email", email_id, label, mention.get("name"))
+
+    # Attachments
+    for att in email_obj.get("attachments") or []:
+        if isinstance(att, dict) and att.get("name"):
+            batch.add_node("Document", att.get("name"), {
+                "semantic_type": att.get("semantic_type"),
+                "fileFormat": att.get("fileFormat"),
+                "description": att.get("description"),
+            })
+            batch.add_rel("HAS_ATTACHMENT", "Email", email_id, "Document", att.get("name"))
+            if case_id:
+                batch.add_rel("CASE_HAS_DOCUMENT", "Case", case_id, "Document", att.get("name"))
+
+    # RxNorm drugs
+    for drug in email_obj.get("drugsRXnorm") or []:
+        flatten_rxnorm_drug(batch, email_id, drug)
+
+    # Enriched content
+    enriched = email_obj.get("enriched_content") or {}
+    if enriched:
+        flatten_enriched_content(batch, email_id, enriched)
+
+    # Forwarded / nested emails
+    fwd = email_obj.get("forwardedMessage")
+    if isinstance(fwd, dict):
+        flatten_email_recursive(batch, case_id, fwd, parent_email_id=email_id)
+    elif isinstance(fwd, list):
+        for child in fwd:
+            if isinstance(child, dict):
+                flatten_email_recursive(batch, case_id, child, parent_email_id=email_id)
+
+    # mentionsEmail -> cross-reference edges
+    for me in email_obj.get("mentionsEmail") or []:
+        if isinstance(me, dict) and me.get("identifier"):
+            batch.add_node("Email", me.get("identifier"))
+            batch.add_rel("REFERS_TO_EMAIL", "Email", email_id, "Email", me.get("identifier"),
+                          {"similarity_score": None})
+
+    # crossRefInfo.crossRefEmails -> cross-reference edges with scores
+    cross = email_obj.get("crossRefInfo") or {}
+    for cref in cross.get("crossRefEmails") or []:
+        if isinstance(cref, dict) and cref.get("cid"):
+            batch.add_node("Email", cref.get("cid"))
+            batch.add_rel("REFERS_TO_EMAIL", "Email", email_id, "Email", cref.get("cid"),
+                          {"similarity_score": cref.get("score")})
+
+
+def graph_batch_statements(batch: GraphBatch):
+    """
+    Yield (cypher, rows) pairs for a GraphBatch: all node labels first, then all
+    relationship types, so every MATCH in the relationship pass finds its nodes.
+    """
+    for label, rows in batch.nodes.items():
+        if label in COALESCE_NODE_STATEMENTS:
+            cypher = COALESCE_NODE_STATEMENTS[label]
+        else:
+            cypher = f"""
+            UNWIND $rows AS row
+            MERGE (n:{label} {{{NODE_KEYS[label]}: row.key}})
+            SET n += row.props
+            """
+        yield cypher.strip(), [{"key": key, "props": props} for key, props in rows.items()]
+
+    for (rel_type, start_label, end_label), rows in batch.rels.items():
+        cypher = f"""
+        UNWIND $rows AS row
+        MATCH (a:{start_label} {{{NODE_KEYS[start_label]}: row.start}})
+        MATCH (b:{end_label} {{{NODE_KEYS[end_label]}: row.end}})
+        MERGE (a)-[r:{rel_type}]->(b)
+        SET r += row.props
+        """
+        yield cypher.strip(), [{"start": s, "end": e, "props": props} for (s, e), props in rows.items()]
+
+
+def write_graph_batch(tx, batch: GraphBatch):
+    """Write a GraphBatch with one UNWIND statement per label / relationship type."""
+    if batch.stale_case_ids:
+        clear_case_children(tx, batch.stale_case_ids, batch.stale_email_ids)
+    for cypher, rows in graph_batch_statements(batch):
+        tx.run(cypher, rows=rows).consume()
+    if batch.case_hashes:
+        set_case_hashes(tx, batch.case_hashes)
+
+
+# ----------------- Content-hash manifest ----------------- #
+#
+# Each imported Case stores a hash of its JSON in c.content_hash. Re-imports
+# with skip_unchanged=True load those hashes once, skip cases whose hash is the
+# same, and clear the child edges of changed cases before writing them again.
+
+# Edges written from an Email by the upsert/flatten helpers
+EMAIL_CHILD_REL_TYPES = [
+    "SENT_TO", "EMAIL_MENTIONS_PLACE", "EMAIL_MENTIONS_TOPIC", "HAS_ATTACHMENT",
+    "EMAIL_MENTIONS_DRUG", "HAS_DECISION", "HAS_CONCERN", "HAS_EVENT", "HAS_FINANCIAL",
+    "EMAIL_MENTIONS_LOCATION", "MENTIONS_PERSON_ENRICHED", "FORWARDED_MESSAGE", "REFERS_TO_EMAIL",
+]
+
+# Edges to the Decision/Concern/Event/Financial text nodes; a node no email
+# outside the re-imported cases points to is deleted with them
+ENRICHED_TEXT_REL_TYPES = ["HAS_DECISION", "HAS_CONCERN", "HAS_EVENT", "HAS_FINANCIAL"]
+
+
+def case_content_hash(case_obj: Dict[str, Any]) -> str:
+    payload = json.dumps(case_obj, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def load_case_hashes(tx) -> Dict[str, str]:
+    """Return {case identifier: content_hash} for every Case imported with a hash."""
+    result = tx.run(
+        """
+        MATCH (c:Case)
+        WHERE c.content_hash IS NOT NULL
+        RETURN c.identifier AS identifier, c.content_hash AS content_hash
+        """.strip()
+    )
+    return {record["identifier"]: record["content_hash"] for record in result}
+
+
+def set_case_hashes(tx, case_hashes: Dict[str, str]):
+    tx.run(
+        """
+        UNWIND $rows AS row
+        MATCH (c:Case {identifier: row.identifier})
+        SET c.content_hash = row.content_hash
+        """.strip(),
+        rows=[{"identifier": k, "content_hash": v} for k, v in case_hashes.items()],
+    ).consume()
+
+
+def case_email_ids(case_obj: Dict[str, Any]) -> List[str]:
+    """Identifiers of every Email (forwards included) the import links to this case."""
+    batch = GraphBatch()
+    flatten_case(batch, case_obj)
+    return [email_id for _, email_id in batch.rels.get(("HAS_EMAIL", "Case", "Email"), {})]
+
+
+def clear_case_children(tx, case_ids: List[str], kept_email_ids: List[str] = None):
+    """
+    Delete the edges a previous import of these cases wrote, so the new version
+    of each case replaces them instead of adding to them.
+
+    An email is owned when every Case linking to it is being cleared, so two
+    re-imported cases sharing an email both drop its edges. Emails that also
+    belong to an untouched Case keep their edges; only the HAS_EMAIL link from
+    these cases is dropped for them. Owned emails not in kept_email_ids (the
+    emails the new versions still have) are deleted, and so are the Decision,
+    Concern, Event and Financial nodes only owned emails referenced, so edited
+    cases don't leave orphans behind. kept_email_ids=None keeps every email.
+    """
+    owned_emails = """
+        UNWIND $case_ids AS case_id
+        MATCH (:Case {identifier: case_id})-[:HAS_EMAIL]->(e:Email)
+        WITH DISTINCT e
+        WHERE all(owner IN [(c:Case)-[:HAS_EMAIL]->(e) | c.identifier] WHERE owner IN $case_ids)
+        """.strip()
+    tx.run(
+        f"""
+        {owned_emails}
+        WITH collect(e) AS emails
+        UNWIND emails AS e
+        MATCH (e)-[r]->(n) WHERE type(r) IN $text_rel_types
+        WITH DISTINCT n, emails
+        WHERE NOT EXISTS {{ MATCH (other)-[r2]->(n) WHERE type(r2) IN $text_rel_types AND NOT other IN emails }}
+        DETACH DELETE n
+        """.strip(),
+        case_ids=case_ids,
+        text_rel_types=ENRICHED_TEXT_REL_TYPES,
+    ).consume()
+    for pattern in ("MATCH (e)-[r]->() WHERE type(r) IN $rel_types", "MATCH (:Person)-[r:SENT]->(e)"):
+        tx.run(
+            f"{owned_emails}\n{pattern}\nDELETE r",
+            case_ids=case_ids,
+            rel_types=EMAIL_CHILD_REL_TYPES,
+        ).consume()
+    if kept_email_ids is not None:
+        tx.run(
+            f"{owned_emails}\nWITH e WHERE NOT e.identifier IN $kept_email_ids\nDETACH DELETE e",
+            case_ids=case_ids,
+            kept_email_ids=list(kept_email_ids),
+        ).consume()
+    tx.run(
+        """
+        UNWIND $case_ids AS case_id
+        MATCH (c:Case {identifier: case_id})-[r:HAS_EMAIL|CASE_MENTIONS|CASE_HAS_DOCUMENT]->()
+        DELETE r
+        """.strip(),
+        case_ids=case_ids,
+    ).consume()
+
+
+def flatten_changed_case(batch: GraphBatch, case_obj: Dict[str, Any], known_hashes: Dict[str, str] = None) -> bool:
+    """
+    flatten_case, but return False without flattening when the case's content
+    hash matches `known_hashes`. Changed cases record their hash on the batch,
+    and previously imported ones are queued for clear_case_children.
+    With known_hashes=None this is plain flatten_case.
+    """
+    case_id = case_obj.get("identifier")
+    if known_hashes is None or not case_id:
+        flatten_case(batch, case_obj)
+        return True
+
+    content_hash = case_content_hash(case_obj)
+    if known_hashes.get(case_id) == content_hash:
+        return False
+
+    flatten_case(batch, case_obj)
+    if case_id in known_hashes:
+        batch.stale_case_ids.append(case_id)
+        batch.stale_email_ids.extend(
+            email_id for case, email_id in batch.rels.get(("HAS_EMAIL", "Case", "Email"), {}) if case == case_id
+        )
+    batch.case_hashes[case_id] = content_hash
+    return True
+
+
+def import_jsonl_to_neo4j_batched(
+    jsonl_path: str,
+    uri: str,
+    user: str,
+    password: str,
+    batch_size: int = 200,
+    log_every: int = 25,
+    skip_unchanged: bool = False,
+):
+    """
+    Bulk variant of import_jsonl_to_neo4j.
+
+    Cases are flattened `batch_size` at a time into a GraphBatch and written in a
+    single transaction, so round trips per window are O(label types) instead of
+    O(entities). If a window fails, its cases are retried one by one so a single
+    bad record is still isolated and reported. `skip_unchanged` works as in
+    import_jsonl_to_neo4j.
+    """
+    driver = GraphDatabase.driver(uri, auth=(user, password))
+
+    stats = {"total_lines": 0, "success_cases": 0, "skipped_lines": 0, "failed_cases": 0}
+    start_time = time.time()
+    windows_written = 0
+    known_hashes = None
+
+    def flush(session, window):
+        batch = GraphBatch()
+        for _, case_obj in window:
+            if not flatten_changed_case(batch, case_obj, known_hashes):
+                stats["unchanged_cases"] += 1
+        if batch.is_empty():
+            return
+        try:
+            session.execute_write(write_graph_batch, batch)
+            stats["success_cases"] += batch.case_count
+            if known_hashes is not None:
+                known_hashes.update(batch.case_hashes)
+            return
+        except Exception as e:
+            print(f"[WARN] Batch of {len(window)} cases failed ({type(e).__name__}: {e}); retrying case by case")
+
+        for line_no, case_obj in window:
+            single = GraphBatch()
+            if not flatten_changed_case(single, case_obj, known_hashes) or single.is_empty():
+                continue
+            try:
+                session.execute_write(write_graph_batch, single)
+                stats["success_cases"] += 1
+                if known_hashes is not None:
+                    known_hashes.update(single.case_hashes)
+            except Exception as e:
+                stats["failed_cases"] += 1
+                print(f"[ERROR] Failed to import case on line {line_no} (case_id={case_obj.get('identifier')!r}): {type(e).__name__}: {e}")
+
+    with driver.session() as session:
+        if skip_unchanged:
+            known_hashes = session.execute_read(load_case_hashes)
+            stats["unchanged_cases"] = 0
+
+        window = []
+        for line_no, case_obj in iter_case_objects(jsonl_path, stats):
+            window.append((line_no, case_obj))
+            if len(window) >= batch_size:
+                flush(session, window)
+                window = []
+                windows_written += 1
+                if windows_written % log_every == 0:
+                    print(f"[INFO] Processed line {line_no}... (success={stats['success_cases']}, failed={stats['failed_cases']}, skipped={stats['skipped_lines']})")
+                    print('\t took', time.time() - start_time, 'seconds')
+        if window:
+            flush(session, window)
+
+    driver.close()
+
+    print_import_summary(stats, start_time)
+
+
+# ================== PARALLEL IMPORT ==================
+#
+# Worker processes parse and flatten chunks of lines; a pool of writer threads
+# (one session each) commits the result. In the node phase every (label, key)
+# is written by exactly one writer. Creating a relationship locks both of its
+# endpoints, and almost every relationship has a Case or Email endpoint, so
+# relationships are partitioned by thread: all the edges of a Case, its Emails
+# and their forwards go to one writer in a single phase, and no two writers
+# lock the same Case or Email. Entity nodes shared across threads (a frequent
+# sender, a common drug) can still be locked by several writers; rows are
+# written in key order to keep lock order consistent, and the driver retries
+# the rare deadlock. Cross-references and Person/Organization links follow in
+# a second phase, partitioned by connected component.
+
+
+# Case hashes from the manifest, set once per worker process by _init_flatten_worker
+_WORKER_KNOWN_HASHES = None
+
+
+def _init_flatten_worker(known_hashes):
+    global _WORKER_KNOWN_HASHES
+    _WORKER_KNOWN_HASHES = known_hashes
+
+
+def flatten_lines(chunk):
+    """
+    Worker-process entry point: parse and flatten a list of (line_no, line).
+
+    Returns (GraphBatch, stats) where stats holds total_lines / skipped_lines /
+    unchanged_cases.
+    """
+    stats = {"total_lines": 0, "skipped_lines": 0, "unchanged_cases": 0}
+    batch = GraphBatch()
+    for line_no, line in chunk:
+        stats["total_lines"] += 1
+        case_obj = parse_case_line(line_no, line, stats)
+        if case_obj is not None and not flatten_changed_case(batch, case_obj, _WORKER_KNOWN_HASHES):
+            stats["unchanged_cases"] += 1
+    return batch, stats
+
+
+def _partition_of(label: str, key: str, partitions: int) -> int:
+    return zlib.crc32(f"{label}\x00{key}".encode("utf-8")) % partitions
+
+
+# Case/Email nodes anchor a relationship to its thread; cross-references join
+# threads, so they are not used to build the components
+ANCHOR_LABELS = ("Case", "Email")
+CROSS_THREAD_REL_TYPES = ("REFERS_TO_EMAIL",)
+
+
+def _union_find():
+    parent = {}
+
+    def find(node):
+        root = node
+        while parent.setdefault(root, root) != root:
+            root = parent[root]
+        while parent[node] != root:
+            parent[node], node = root, parent[node]
+        return root
+
+    def union(a, b):
+        a, b = find(a), find(b)
+        if a != b:
+            parent[a] = b
+
+    return find, union
+
+
+def _assign_components(components: Dict[Any, List[tuple]], partitions: int) -> List[GraphBatch]:
+    """One GraphBatch per writer; components (lists of rows), largest first, go to the least loaded writer."""
+    parts = [GraphBatch() for _ in range(partitions)]
+    loads = [(0, i) for i in range(partitions)]
+    for rows in sorted(components.values(), key=len, reverse=True):
+        load, i = heapq.heappop(loads)
+        for (rel_type, start_label, end_label), start_key, end_key, props in rows:
+            parts[i].add_rel(rel_type, start_label, start_key, end_label, end_key, props)
+        heapq.heappush(loads, (load + len(rows), i))
+
+    # A fixed row order makes writers take the locks of shared nodes in the same order
+    for part in parts:
+        for group_key, rows in part.rels.items():
+            part.rels[group_key] = dict(sorted(rows.items(), key=lambda kv: (str(kv[0][0]), str(kv[0][1]))))
+    return parts
+
+
+def _partition_components(rows: List[tuple], partitions: int) -> List[GraphBatch]:
+    """Partition rows so each connected component (through any endpoint) is on one writer."""
+    find, union = _union_find()
+    for (rel_type, start_label, end_label), start_key, end_key, _ in rows:
+        union((start_label, start_key), (end_label, end_key))
+    components = {}
+    for row in rows:
+        (rel_type, start_label, end_label), start_key, _, _ = row
+        components.setdefault(find((start_label, start_key)), []).append(row)
+    return _assign_components(components, partitions)
+
+
+def _partition_threads(rels: Dict[tuple, Dict[tuple, Dict[str, Any]]], partitions: int):
+    """
+    Partition relationship rows by the Case/Email thread they hang off.
+    Returns (thread parts, leftover rows): rows anchored in one thread are
+    grouped with the rest of that thread; cross-thread and unanchored rows
+    (cross-references, Person/Organization links) are left over.
+    """
+    find, union = _union_find()
+    for (rel_type, start_label, end_label), rows in rels.items():
+        if start_label in ANCHOR_LABELS and end_label in ANCHOR_LABELS and rel_type not in CROSS_THREAD_REL_TYPES:
+            for start_key, end_key in rows:
+                union((start_label, start_key), (end_label, end_key))
+
+    threads, leftover = {}, []
+    for group_key, rows in rels.items():
+        rel_type, start_label, end_label = group_key
+        for (start_key, end_key), props in rows.items():
+            row = (group_key, start_key, end_key, props)
+            anchors = {find((label, key)) for label, key in ((start_label, start_key), (end_label, end_key))
+                       if label in ANCHOR_LABELS}
+            if len(anchors) == 1:
+                threads.setdefault(anchors.pop(), []).append(row)
+            else:
+                leftover.append(row)
+    return _assign_components(threads, partitions), leftover
+
+
+def partition_graph_batches(batches: List[GraphBatch], partitions: int):
+    """
+    Split flattened batches into `partitions` node batches and a list of
+    relationship phases of `partitions` batches each.
+
+    Nodes are partitioned by (label, key). The first relationship phase holds
+    every row anchored in a single Case/Email thread, with each thread on one
+    writer; the second holds cross-thread and unanchored rows, with each of
+    their connected components on one writer. Phases must be written one
+    after another.
+    """
+    node_parts = [GraphBatch() for _ in range(partitions)]
+    wave = GraphBatch()
+    for batch in batches:
+        for label, rows in batch.nodes.items():
+            for key, props in rows.items():
+                node_parts[_partition_of(label, key, partitions)].add_node(label, key, props)
+        for (rel_type, start_label, end_label), rows in batch.rels.items():
+            for (start_key, end_key), props in rows.items():
+                wave.add_rel(rel_type, start_label, start_key, end_label, end_key, props)
+
+    thread_parts, leftover = _partition_threads(wave.rels, partitions)
+    rel_phases = [thread_parts]
+    if leftover:
+        rel_phases.append(_partition_components(leftover, partitions))
+    return node_parts, rel_phases
+
+
+def write_graph_batch_in_session(driver, batch: GraphBatch):
+    """
+    Write a GraphBatch in its own session. execute_write already retries
+    deadlocks and other transient errors with backoff, for up to the driver's
+    max_transaction_retry_time.
+    """
+    with driver.session() as session:
+        session.execute_write(write_graph_batch, batch)
+
+
+def _read_line_chunks(jsonl_path: str, chunk_size: int):
+    numbered = iter_numbered_lines(jsonl_path)
+    while True:
+        chunk = list(islice(numbered, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def import_jsonl_to_neo4j_parallel(
+    jsonl_path: str,
+    uri: str,
+    user: str,
+    password: str,
+    workers: int = None,
+    writers: int = 4,
+    batch_size: int = 200,
+    max_retry_time: float = 30.0,
+    skip_unchanged: bool = False,
+):
+    """
+    Parallel variant of import_jsonl_to_neo4j_batched.
+
+    `workers` processes (default: all cores) parse and flatten `batch_size`-line
+    chunks. Each wave of chunks is partitioned across `writers` concurrent
+    sessions: first all node partitions, then the relationship phases of
+    partition_graph_batches one after another.
+    Deadlocks between writers are retried by the driver for up to
+    `max_retry_time` seconds per transaction.
+    If a wave still fails after retries, its chunks are written one at a time and
+    any chunk that keeps failing is counted as failed. With `skip_unchanged`,
+    stale edges of changed cases are cleared before a wave's node phase and
+    their hashes recorded after its relationship phase.
+    """
+    workers = workers or os.cpu_count() or 1
+    driver = GraphDatabase.driver(
+        uri, auth=(user, password), max_connection_pool_size=max(writers, 1) + 1,
+        max_transaction_retry_time=max_retry_time,
+    )
+
+    stats = {"total_lines": 0, "success_cases": 0, "skipped_lines": 0, "failed_cases": 0}
+    start_time = time.time()
+    chunks = _read_line_chunks(jsonl_path, batch_size)
+    waves = 0
+
+    known_hashes = None
+    if skip_unchanged:
+        with driver.session() as session:
+            known_hashes = session.execute_read(load_case_hashes)
+        stats["unchanged_cases"] = 0
+
+    with multiprocessing.Pool(workers, initializer=_init_flatten_worker, initargs=(known_hashes,)) as pool, \
+            ThreadPoolExecutor(max_workers=writers) as executor:
+        while True:
+            # Bounded read-ahead: one wave is a couple of chunks per worker
+            wave_chunks = list(islice(chunks, workers * 2))
+            if not wave_chunks:
+                break
+
+            results = pool.map(flatten_lines, wave_chunks)
+            batches = []
+            for batch, chunk_stats in results:
+                stats["total_lines"] += chunk_stats["total_lines"]
+                stats["skipped_lines"] += chunk_stats["skipped_lines"]
+                if known_hashes is not None:
+                    stats["unchanged_cases"] += chunk_stats["unchanged_cases"]
+                if not batch.is_empty():
+                    batches.append(batch)
+
+            node_parts, rel_phases = partition_graph_batches(batches, writers)
+            manifest = GraphBatch()
+            for batch in batches:
+                manifest.stale_case_ids.extend(batch.stale_case_ids)
+                manifest.stale_email_ids.extend(batch.stale_email_ids)
+            try:
+                if manifest.stale_case_ids:
+                    write_graph_batch_in_session(driver, manifest)
+                for parts in [node_parts, *rel_phases]:
+                    futures = [
+                        executor.submit(write_graph_batch_in_session, driver, part)
+                        for part in parts if not part.is_empty()
+                    ]
+                    for future in futures:
+                        future.result()
+                manifest.stale_case_ids, manifest.stale_email_ids = [], []
+                for batch in batches:
+                    manifest.case_hashes.update(batch.case_hashes)
+                if manifest.case_hashes:
+                    write_graph_batch_in_session(driver, manifest)
+                stats["success_cases"] += sum(b.case_count for b in batches)
+            except Exception as e:
+                print(f"[WARN] Wave {waves + 1} failed ({type(e).__name__}: {e}); writing its chunks one at a time")
+                for batch in batches:
+                    try:
+                        write_graph_batch_in_session(driver, batch)
+                        stats["success_cases"] += batch.case_count
+                    except Exception as chunk_error:
+                        stats["failed_cases"] += batch.case_count
+                        print(f"[ERROR] Failed to import a chunk of {batch.case_count} cases: {type(chunk_error).__name__}: {chunk_error}")
+
+            waves += 1
+            print(f"[INFO] Wave {waves} done (lines={stats['total_lines']}, success={stats['success_cases']}, failed={stats['failed_cases']}, skipped={stats['skipped_lines']})")
+            print('\t took', time.time() - start_time, 'seconds')
+
+    driver.close()
+
+    print_import_summary(stats, start_time)
+
+
+# ================== OFFLINE BULK CSV EXPORT (neo4j-admin) ==================
+#
+# For a fresh database, skip transactions entirely: flatten the JSONL with the
+# same GraphBatch rules and write deduplicated node/relationship CSVs for
+#   neo4j-admin database import full --multiline-fields=true ...
+# Each label gets its own ID space, keyed by the same property MERGE uses.
+# Cases are flattened one at a time and streamed into one CSV per label and
+# relationship type; only the keys already written are kept in memory. A first
+# pass over the file collects each CSV's columns and types for its header.
+# Case nodes carry content_hash, so a skip_unchanged import can follow the load.
+
+ARRAY_DELIMITER = ";"
+
+
+def _csv_value_kind(value) -> str:
+    if isinstance(value, (list, tuple)):
+        return "list"
+    if isinstance(value, bool):
+        return "bool"
+    if isinstance(value, int):
+        return "int"
+    if isinstance(value, float):
+        return "float"
+    return "other"
+
+
+def _csv_column_type(kinds) -> str:
+    """Pick a neo4j-admin header type for one property column from the kinds of its non-null values."""
+    if "list" in kinds:
+        return "string[]"
+    if kinds and kinds <= {"bool"}:
+        return "boolean"
+    if kinds and kinds <= {"int"}:
+        return "long"
+    if kinds and kinds <= {"int", "float"}:
+        return "float"
+    return "string"
+
+
+def _csv_value(value, col_type: str):
+    if value is None:
+        return ""
+    if col_type == "string[]":
+        items = value if isinstance(value, (list, tuple)) else [value]
+        return ARRAY_DELIMITER.join(str(v) for v in items if v is not None)
+    if col_type == "boolean":
+        return "true" if value else "false"
+    if col_type == "string" and isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return value
+
+
+class GraphCsvWriter:
+    """
+    Streams GraphBatch rows into neo4j-admin import CSVs.
+
+    observe() every batch first, so each file's columns and types are known;
+    then write() the same batches inside `with writer:`. A node or relationship
+    is written once, the first time it is seen with any property set (a node
+    that only ever appears as a bare reference is written at the end), so
+    later duplicates are dropped like --skip-duplicate-nodes would.
+    """
+
+    def __init__(self, output_dir: str):
+        self.output_dir = output_dir
+        self.columns: Dict[tuple, Dict[str, set]] = {} # file key -> column -> value kinds
+        self.written = {"nodes": [], "relationships": []}
+        self._files = {}
+        self._seen: Dict[tuple, set] = {}
+        self._bare: Dict[tuple, set] = {}
+
+    def observe(self, batch: GraphBatch):
+        for label, rows in batch.nodes.items():
+            self._observe_rows(("node", label), rows.values())
+        for group_key, rows in batch.rels.items():
+            self._observe_rows(("rel",) + group_key, rows.values())
+
+    def _observe_rows(self, file_key: tuple, rows):
+        columns = self.columns.setdefault(file_key, {})
+        for props in rows:
+            for name, value in props.items():
+                kinds = columns.setdefault(name, set())
+                if value is not None:
+                    kinds.add(_csv_value_kind(value))
+
+    def __enter__(self):
+        os.makedirs(self.output_dir, exist_ok=True)
+        for file_key, columns in self.columns.items():
+            typed = [(name, _csv_column_type(kinds)) for name, kinds in columns.items()]
+            header = [name if col_type == "string" else f"{name}:{col_type}" for name, col_type in typed]
+            if file_key[0] == "node":
+                label = file_key[1]
+                path = os.path.join(self.output_dir, f"nodes_{label}.csv")
+                header = [f"{NODE_KEYS[label]}:ID({label})"] + header + [":LABEL"]
+                self.written["nodes"].append(path)
+            else:
+                _, rel_type, start_label, end_label = file_key
+                path = os.path.join(self.output_dir, f"rels_{rel_type}_{start_label}_{end_label}.csv")
+                header = [f":START_ID({start_label})", f":END_ID({end_label})", ":TYPE"] + header
+                self.written["relationships"].append(path)
+            f = open(path, "w", encoding="utf-8", newline="")
+            writer = csv.writer(f)
+            writer.writerow(header)
+            self._files[file_key] = (f, writer, typed)
+        return self
+
+    def write(self, batch: GraphBatch):
+        for label, rows in batch.nodes.items():
+            for key, props in rows.items():
+                self._write_row(("node", label), key, props)
+        for group_key, rows in batch.rels.items():
+            for key, props in rows.items():
+                self._write_row(("rel",) + group_key, key, props)
+
+    def _write_row(self, file_key: tuple, key, props: Dict[str, Any]):
+        seen = self._seen.setdefault(file_key, set())
+        if key in seen:
+            return
+        if all(value is None for value in props.values()):
+            self._bare.setdefault(file_key, set()).add(key)
+            return
+        seen.add(key)
+        self._bare.get(file_key, set()).discard(key)
+        _, writer, typed = self._files[file_key]
+        values = [_csv_value(props.get(name), col_type) for name, col_type in typed]
+        if file_key[0] == "node":
+            writer.writerow([key] + values + [file_key[1]])
+        else:
+            writer.writerow([key[0], key[1], file_key[1]] + values)
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            for file_key, keys in self._bare.items():
+                for key in sorted(keys, key=str):
+                    self._write_bare(file_key, key)
+        for f, _, _ in self._files.values():
+            f.close()
+        return False
+
+    def _write_bare(self, file_key: tuple, key):
+        _, writer, typed = self._files[file_key]
+        blanks = [""] * len(typed)
+        if file_key[0] == "node":
+            writer.writerow([key] + blanks + [file_key[1]])
+        else:
+            writer.writerow([key[0], key[1], file_key[1]] + blanks)
+
+
+def write_graph_batch_csv(batch: GraphBatch, output_dir: str) -> Dict[str, List[str]]:
+    """
+    Write a GraphBatch as neo4j-admin import CSVs.
+
+    Returns {"nodes": [...], "relationships": [...]} with the paths written.
+    """
+    csv_writer = GraphCsvWriter(output_dir)
+    csv_writer.observe(batch)
+    with csv_writer:
+        csv_writer.write(batch)
+    return csv_writer.written
+
+
+def _flatten_case_for_export(case_obj: Dict[str, Any]) -> GraphBatch:
+    batch = GraphBatch()
+    flatten_case(batch, case_obj)
+    if case_obj.get("identifier"):
+        batch.add_node("Case", case_obj["identifier"], {"content_hash": case_content_hash(case_obj)})
+    return batch
+
+
+def export_jsonl_to_neo4j_csv(jsonl_path: str, output_dir: str, database: str = "neo4j"):
+    """
+    Walk an enriched JSONL file with the import mapping rules and write
+    deduplicated node/relationship CSVs for an offline `neo4j-admin` load.
+
+    The file is read twice (columns first, then the rows), one case at a time.
+    Prints the matching `neo4j-admin database import full` command. Run
+    setup_constraints once the database has been started.
+    """
+    stats = {"total_lines": 0, "success_cases": 0, "skipped_lines": 0, "failed_cases": 0}
+    start_time = time.time()
+
+    csv_writer = GraphCsvWriter(output_dir)
+    for _, case_obj in iter_case_objects(jsonl_path, dict(stats)):
+        csv_writer.observe(_flatten_case_for_export(case_obj))
+    with csv_writer:
+        for _, case_obj in iter_case_objects(jsonl_path, stats):
+            batch = _flatten_case_for_export(case_obj)
+            csv_writer.write(batch)
+            stats["success_cases"] += batch.case_count
+    written = csv_writer.written
+
+    args = [f"neo4j-admin database import full {database}", "--multiline-fields=true",
+            f"--array-delimiter='{ARRAY_DELIMITER}'"]
+    args += [f"--nodes={path}" for path in written["nodes"]]
+    args += [f"--relationships={path}" for path in written["relationships"]]
+    print("\n=== neo4j-admin command ===")
+    print(" \\\n  ".join(args))
+
+    print_import_summary(stats, start_time)
+    return written
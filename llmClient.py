@@ -0,0 +1,295 @@
+######  helpers around the LLM enrichment requests (emailProcessor.QwenEntityExtractor) ######
+
+import hashlib, json, random, sqlite3, threading, time
+from pathlib import Path
+from typing import Any, Dict, List
+
+from asyncPool import SyncTokenBucket
+
+
+class CachedError(Exception):
+    """Raised for a cached failed response when the cache is configured to replay errors."""
+
+
+def prompt_hash(messages) -> str:
+    return hashlib.sha256(json.dumps(messages, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+class LLMResponseCache:
+    """
+    On-disk SQLite cache of parsed LLM replies keyed by (model, temperature,
+    prompt hash), with the token usage of the original call. Once the stored
+    replies exceed max_bytes the least recently used ones are evicted.
+
+    Failed calls are only stored when cache_errors=True; with cache_errors=False
+    any error entries already on disk are ignored, so those prompts are sent again.
+    """
+
+    def __init__(self, path: str, max_bytes: int = 1 << 30, cache_errors: bool = False):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.cache_errors = cache_errors
+        self.hits = 0
+        self.misses = 0
+        self.saved_tokens = 0
+        self._lock = threading.Lock() # shared by the enrichment worker threads
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript("""
+          CREATE TABLE IF NOT EXISTS responses (
+            model TEXT, temperature REAL, prompt_hash TEXT, reply TEXT, usage TEXT,
+            is_error INTEGER, size INTEGER, created_at REAL, last_used REAL,
+            PRIMARY KEY (model, temperature, prompt_hash));
+          CREATE INDEX IF NOT EXISTS responses_last_used ON responses(last_used);
+        """)
+        self.conn.commit()
+        # Bytes of stored replies, summed once here and kept up to date by put() and _evict()
+        self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def key(payload: Dict[str, Any]) -> tuple:
+        return payload['model'], float(payload.get('temperature', 0)), prompt_hash(payload['messages'])
+
+    def get(self, payload: Dict[str, Any], models: List[str] = None):
+        """
+        Cached parsed reply for a chat payload, or None. Raises CachedError for a replayed error.
+        models, if given, accepts a reply from any of those models (e.g. every model of a
+        dispatcher pool) instead of only payload['model']; successful replies win over errors.
+        """
+        _, temperature, phash = self.key(payload)
+        models = list(dict.fromkeys(models or [payload['model']]))
+        with self._lock:
+            row = self.conn.execute(
+                f"SELECT reply, usage, is_error, model FROM responses WHERE model IN ({', '.join('?' * len(models))}) "
+                "AND temperature = ? AND prompt_hash = ? ORDER BY is_error ASC, last_used DESC LIMIT 1",
+                (*models, temperature, phash)).fetchone()
+            if row is None or (row[2] and not self.cache_errors):
+                self.misses += 1
+                return None
+            self.conn.execute(
+                "UPDATE responses SET last_used = ? WHERE model = ? AND temperature = ? AND prompt_hash = ?",
+                (time.time(), row[3], temperature, phash))
+            self.conn.commit()
+            self.hits += 1
+            self.saved_tokens += sum(v for v in json.loads(row[1]).values() if isinstance(v, int))
+        if row[2]:
+            raise CachedError(json.loads(row[0]))
+        return json.loads(row[0])
+
+    def put(self, payload: Dict[str, Any], reply, usage: Dict[str, Any] = None, is_error: bool = False):
+        if is_error and not self.cache_errors:
+            return
+        reply_json = json.dumps(reply, ensure_ascii=False)
+        size = len(reply_json.encode('utf-8'))
+        key = self.key(payload)
+        now = time.time()
+        with self._lock:
+            replaced = self.conn.execute(
+                "SELECT size FROM responses WHERE model = ? AND temperature = ? AND prompt_hash = ?", key).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (*key, reply_json, json.dumps(usage or {}), int(is_error), size, now, now))
+            self.total_bytes += size - (replaced[0] if replaced else 0)
+            if self.total_bytes > self.max_bytes:
+                self._evict()
+            self.conn.commit()
+
+    def _evict(self):
+        excess = self.total_bytes - self.max_bytes
+        victims = []
+        for model, temperature, phash, size in self.conn.execute(
+                "SELECT model, temperature, prompt_hash, size FROM responses ORDER BY last_used ASC"):
+            victims.append((model, temperature, phash))
+            excess -= size
+            self.total_bytes -= size
+            if excess <= 0:
+                break
+        self.conn.executemany(
+            "DELETE FROM responses WHERE model = ? AND temperature = ? AND prompt_hash = ?", victims)
+
+    def close(self):
+        with self._lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+######  error classification, retries and circuit breaker ######
+
+# Error kinds worth retrying; 'client' (other 4xx: bad key, bad request) is not
+RETRYABLE_KINDS = ('rate_limit', 'server', 'timeout', 'parse')
+
+
+class LLMError(Exception):
+    """A failed LLM request, classified by kind: rate_limit, server, timeout, parse, auth or client."""
+
+    def __init__(self, kind: str, message: str, retry_after: float = None):
+        super().__init__(f"[{kind}] {message}")
+        self.kind = kind
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self) -> bool:
+        return self.kind in RETRYABLE_KINDS
+
+
+def classify_status(status_code: int) -> str:
+    if status_code == 429:
+        return 'rate_limit'
+    if status_code in (401, 402, 403):
+        return 'auth' # bad key, no credits or model not allowed for this key
+    if status_code >= 500 or status_code in (408, 409):
+        return 'server'
+    return 'client'
+
+
+class CircuitBreaker:
+    """
+    Shared by all worker threads. After failure_threshold consecutive
+    rate-limit/server/timeout failures (or a Retry-After from the provider) the
+    circuit opens and every worker waits in wait() until the cooldown ends.
+    With an LLMDispatcher, failures only count once every endpoint is cooling down.
+    After the cooldown a success closes the circuit, while one more failure
+    reopens it straight away.
+    """
+
+    def __init__(self, failure_threshold: int = 5, cooldown: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.trips = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        while True:
+            with self._lock:
+                remaining = self.open_until - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+
+    def record_failure(self, retry_after: float = None):
+        with self._lock:
+            self.failures += 1
+            pause = None
+            if self.failures >= self.failure_threshold:
+                pause = self.cooldown
+                # stay one failure short of tripping: the next probe decides
+                self.failures = self.failure_threshold - 1
+            if retry_after:
+                pause = max(pause or 0, retry_after)
+            if pause:
+                until = time.monotonic() + pause
+                if until > self.open_until:
+                    if self.open_until <= time.monotonic():
+                        self.trips += 1
+                        print(f"Provider degraded, pausing all workers for {pause:.0f}s")
+                    self.open_until = until
+
+
+######  multi-key / multi-model dispatcher ######
+
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+
+class LLMEndpoint:
+    """One (API key, model) pair with its own quotas and health."""
+
+    def __init__(self, api_key: str, model: str, requests_per_minute: float = 60, tokens_per_minute: float = None,
+                 weight: float = 1.0, base_url: str = OPENROUTER_URL, name: str = None):
+        self.api_key = api_key
+        self.model = model
+        self.base_url = base_url
+        self.weight = weight
+        self.name = name or f"{model}/...{api_key[-4:] if api_key else ''}"
+        self.request_limiter = SyncTokenBucket(requests_per_minute / 60, capacity=max(1, requests_per_minute / 60))
+        self.token_limiter = SyncTokenBucket(tokens_per_minute / 60, capacity=tokens_per_minute) if tokens_per_minute else None
+        self.failures = 0 # consecutive
+        self.cooldown_until = 0.0
+        self.disabled = False # key rejected: out of the pool for this run
+        self.stats = {'calls': 0, 'errors': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+
+    def wait_time(self, tokens: int) -> float:
+        wait = max(self.cooldown_until - time.monotonic(), self.request_limiter.wait_time())
+        if self.token_limiter is not None:
+            wait = max(wait, self.token_limiter.wait_time(tokens))
+        return wait
+
+
+class LLMDispatcher:
+    """
+    Spreads requests over a pool of LLMEndpoints so total throughput is roughly
+    the sum of their quotas. acquire() picks, among endpoints that are healthy
+    and have request/token budget right now, one at random in proportion to its
+    weight, and blocks until one is available. Throttled endpoints cool down
+    for their Retry-After (or an exponential backoff) and the next attempt fails
+    over to another one; endpoints that keep failing are benched for
+    server_cooldown, and endpoints whose key is rejected are dropped.
+    """
+
+    def __init__(self, endpoints: List[LLMEndpoint], failure_threshold: int = 3, server_cooldown: float = 30.0):
+        if not endpoints:
+            raise ValueError("LLMDispatcher needs at least one endpoint")
+        self.endpoints = endpoints
+        self.failure_threshold = failure_threshold
+        self.server_cooldown = server_cooldown
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, configs: List[Dict[str, Any]], **kwargs):
+        """Build from dicts of LLMEndpoint arguments, e.g. [{'api_key': ..., 'model': ..., 'requests_per_minute': 20}]."""
+        return cls([LLMEndpoint(**config) for config in configs], **kwargs)
+
+    def acquire(self, tokens: int) -> LLMEndpoint:
+        while True:
+            with self._lock:
+                waits = [(endpoint.wait_time(tokens), endpoint) for endpoint in self.endpoints if not endpoint.disabled]
+                if not waits:
+                    raise LLMError('auth', "every endpoint in the pool rejected its API key")
+                ready = [endpoint for wait, endpoint in waits if wait <= 0]
+                if ready:
+                    endpoint = random.choices(ready, weights=[e.weight for e in ready])[0]
+                    endpoint.request_limiter.try_acquire()
+                    if endpoint.token_limiter is not None:
+                        endpoint.token_limiter.try_acquire(tokens)
+                    endpoint.stats['calls'] += 1
+                    return endpoint
+                pause = min(wait for wait, _ in waits)
+            time.sleep(min(max(pause, 0.01), 5.0))
+
+    def report_success(self, endpoint: LLMEndpoint, usage: Dict[str, Any] = None):
+        with self._lock:
+            endpoint.failures = 0
+            for key in ('prompt_tokens', 'completion_tokens'):
+                if isinstance((usage or {}).get(key), int):
+                    endpoint.stats[key] += usage[key]
+
+    def report_failure(self, endpoint: LLMEndpoint, error: 'LLMError'):
+        with self._lock:
+            endpoint.stats['errors'] += 1
+            endpoint.failures += 1
+            cooldown = 0.0
+            if error.kind == 'rate_limit':
+                cooldown = error.retry_after if error.retry_after is not None else min(60.0, 2.0 ** endpoint.failures)
+            elif error.kind == 'auth' and not endpoint.disabled:
+                endpoint.disabled = True
+                print(f"Endpoint {endpoint.name} rejected ({error}); removed from the pool")
+            elif error.kind in ('server', 'timeout') and endpoint.failures >= self.failure_threshold:
+                cooldown = self.server_cooldown
+            if cooldown:
+                endpoint.cooldown_until = max(endpoint.cooldown_until, time.monotonic() + cooldown)
+
+    def usable_count(self) -> int:
+        return sum(1 for endpoint in self.endpoints if not endpoint.disabled)
+
+    def pool_cooldown(self) -> float:
+        """Seconds until some usable endpoint is out of its cooldown; 0 while one is healthy."""
+        with self._lock:
+            remaining = [endpoint.cooldown_until - time.monotonic() for endpoint in self.endpoints if not endpoint.disabled]
+        return max(0.0, min(remaining, default=0.0))
+
+    def summary(self) -> str:
+        return ', '.join(f"{e.name}: {e.stats['calls']} calls, {e.stats['errors']} errors" for e in self.endpoints)
@@ -0,0 +1,196 @@
+######  shared streaming reader/writer for the pipeline's JSON/JSONL files ######
+#
+# Every stage stores a case as {"email_id": ..., "output": "<case JSON string>"}.
+# iter_cases() streams those records one at a time and decodes the nested
+# 'output' once; encode_output() puts a modified case back. orjson is used
+# when installed, and ijson (if installed) streams large .json arrays; without
+# it a .json array is loaded whole, with a warning.
+#
+# Files ending in .msgpack are a compact binary alternative between stages:
+# records are packed back to back with 'output' stored as the decoded case
+# (no JSON string inside JSON, no indent whitespace). Needs `pip install msgpack`.
+
+import json, os, warnings
+from pathlib import Path
+from typing import Any, Dict, Iterator, Tuple
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def is_msgpack(path) -> bool:
+    return str(path).endswith('.msgpack')
+
+
+def _require_msgpack():
+    if msgpack is None:
+        raise ImportError("msgpack is required for .msgpack files: pip install msgpack")
+
+
+def loads(text):
+    """json.loads with the fast backend when available."""
+    if orjson is not None:
+        return orjson.loads(text)
+    return json.loads(text)
+
+
+def dumps_line(obj) -> str:
+    """Single-line encoding without ASCII escaping, for .jsonl records."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode('utf-8')
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def dumps_output(obj) -> str:
+    """Encoding used for the nested 'output' string: json.dumps(obj, ensure_ascii=False, indent=2)."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2).decode('utf-8')
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False, indent=2)
+
+
+def iter_records(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Lazily yield the records of a .jsonl file (one per line), a .msgpack file
+    or a .json file (array items, or the single top-level object).
+    """
+    if is_msgpack(path):
+        _require_msgpack()
+        with open(path, 'rb') as f:
+            yield from msgpack.Unpacker(f, raw=False)
+        return
+
+    if str(path).endswith('.jsonl'):
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    yield loads(line)
+        return
+
+    with open(path, 'rb') as f:
+        first = f.read(1)
+        while first and first.isspace():
+            first = f.read(1)
+        f.seek(0)
+        if first == b'[':
+            if ijson is not None:
+                yield from ijson.items(f, 'item', use_float=True)
+                return
+            warnings.warn(f"ijson is not installed: loading all of {path} into memory "
+                          "(pip install ijson, or use .jsonl/.msgpack)", RuntimeWarning, stacklevel=2)
+        data = loads(f.read())
+    if isinstance(data, list):
+        yield from data
+    else:
+        yield data
+
+
+def decode_output(item: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Return the case object of a record: the parsed 'output' string, the
+    'output' dict itself, or the record when it has no usable 'output'.
+    """
+    output = item.get('output', item)
+    if isinstance(output, str):
+        try:
+            return loads(output)
+        except ValueError:
+            return item
+    return output
+
+
+def encode_output(item: Dict[str, Any], output_obj: Dict[str, Any]):
+    """Write a modified case object back into a record whose 'output' is a string."""
+    if isinstance(item.get('output'), str):
+        item['output'] = dumps_output(output_obj)
+
+
+def iter_cases(path: str) -> Iterator[Tuple[Dict[str, Any], Dict[str, Any]]]:
+    """Yield (record, case object) pairs, decoding each nested 'output' once."""
+    for item in iter_records(path):
+        yield item, decode_output(item)
+
+
+class RecordWriter:
+    """
+    Streaming writer matching the stages' existing output formats: one compact
+    line per record for .jsonl, packed records for .msgpack, an indent=2 JSON
+    array for anything else.
+
+    Pass output_obj to write() when the case was modified; it is encoded into
+    'output' as the target format needs. A decoded 'output' (as read from
+    .msgpack) is serialized back to a JSON string for .jsonl and .json.
+
+    Records go to a temporary file next to path that replaces it only when the
+    writer closes without an error, so a stage may stream its input from the
+    same path it writes, and an interrupted run never leaves a partial file.
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        self.tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        self.count = 0
+        self._file = None
+        self._packer = None
+
+    def __enter__(self):
+        Path(self.path).parent.mkdir(parents=True, exist_ok=True)
+        if is_msgpack(self.path):
+            _require_msgpack()
+            self._file = open(self.tmp_path, 'wb')
+            self._packer = msgpack.Packer(use_bin_type=True)
+            return self
+        self._file = open(self.tmp_path, 'w', encoding='utf-8')
+        if not self.path.endswith('.jsonl'):
+            self._file.write('[')
+        return self
+
+    def write(self, item: Dict[str, Any], output_obj: Dict[str, Any] = None):
+        if self._packer is not None:
+            if 'output' in item:
+                if output_obj is None:
+                    output_obj = decode_output(item)
+                if output_obj is not item:
+                    item = {**item, 'output': output_obj}
+            self._file.write(self._packer.pack(item))
+            self.count += 1
+            return
+
+        if output_obj is not None:
+            encode_output(item, output_obj)
+        if isinstance(item.get('output'), (dict, list)):
+            # read from .msgpack: text formats keep 'output' as a JSON string
+            item = {**item, 'output': dumps_output(item['output'] if output_obj is None else output_obj)}
+        if self.path.endswith('.jsonl'):
+            self._file.write(dumps_line(item) + '\n')
+        else:
+            item_json = json.dumps(item, ensure_ascii=False, indent=2).replace('\n', '\n  ')
+            self._file.write((',\n  ' if self.count else '\n  ') + item_json)
+        self.count += 1
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None and self._packer is None and not self.path.endswith('.jsonl'):
+            self._file.write('\n]' if self.count else ']')
+        self._file.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        else:
+            os.remove(self.tmp_path)
+        return False
@@ -0,0 +1,497 @@
+######  RxNorm lookup helpers used by emailProcessor.extractRXnormDrugs ######
+
+import asyncio, re, sqlite3, time, zlib, difflib
+from pathlib import Path
+
+import numpy as np
+
+import requests
+
+from asyncPool import TokenBucket, BlockingPool, pooled_session, retry_after_seconds, backoff_delay
+
+# Returned by the cache when it has no (fresh) entry; None is a cached negative result
+MISS = object()
+
+
+def normalize_term(term: str) -> str:
+    return re.sub(r'\s+', ' ', term).strip().lower()
+
+
+class RxNormCache:
+  """
+  On-disk SQLite cache for RxNav lookups: normalized term -> rxcui and
+  rxcui -> drug name. Negative results (no match) are cached too. Entries older
+  than ttl_seconds are treated as missing, and once a table holds more than
+  max_entries rows the least recently used ones are evicted in bulk, down to
+  evict_to of max_entries. Writes are committed every commit_every inserts and
+  on commit()/close().
+  """
+
+  def __init__(self, path: str, ttl_seconds: float = 30 * 24 * 3600, max_entries: int = 500000,
+               evict_to: float = 0.9, commit_every: int = 1000):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    self.path = path
+    self.ttl_seconds = ttl_seconds
+    self.max_entries = max_entries
+    self.evict_to = evict_to
+    self.commit_every = commit_every
+    self._uncommitted = 0
+    self.hits = 0
+    self.misses = 0
+    # Used from one thread at a time, but that may be run_async's worker thread
+    self.conn = sqlite3.connect(path, check_same_thread=False)
+    self.conn.executescript("""
+      CREATE TABLE IF NOT EXISTS term_rxcui (
+        term TEXT PRIMARY KEY, rxcui TEXT, fetched_at REAL, last_used REAL);
+      CREATE TABLE IF NOT EXISTS rxcui_name (
+        rxcui TEXT PRIMARY KEY, name TEXT, fetched_at REAL, last_used REAL);
+      CREATE INDEX IF NOT EXISTS term_rxcui_last_used ON term_rxcui(last_used);
+      CREATE INDEX IF NOT EXISTS rxcui_name_last_used ON rxcui_name(last_used);
+    """)
+    self.conn.commit()
+    # Upper bound on each table's rows (replacing an existing key also counts); recounted before evicting
+    self._counts = {table: self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                    for table in ("term_rxcui", "rxcui_name")}
+
+  def _get(self, table: str, key_col: str, value_col: str, key: str):
+    row = self.conn.execute(
+      f"SELECT {value_col}, fetched_at FROM {table} WHERE {key_col} = ?", (key,)
+    ).fetchone()
+    now = time.time()
+    if row is None or now - row[1] > self.ttl_seconds:
+      self.misses += 1
+      return MISS
+    self.conn.execute(f"UPDATE {table} SET last_used = ? WHERE {key_col} = ?", (now, key))
+    self.hits += 1
+    return row[0]
+
+  def _set(self, table: str, key_col: str, value_col: str, key: str, value):
+    now = time.time()
+    self.conn.execute(
+      f"INSERT OR REPLACE INTO {table} ({key_col}, {value_col}, fetched_at, last_used) VALUES (?, ?, ?, ?)",
+      (key, value, now, now),
+    )
+    self._counts[table] += 1
+    if self._counts[table] > self.max_entries:
+      count = self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+      if count > self.max_entries:
+        self.conn.execute(
+          f"DELETE FROM {table} WHERE {key_col} IN "
+          f"(SELECT {key_col} FROM {table} ORDER BY last_used ASC LIMIT ?)",
+          (count - int(self.max_entries * self.evict_to),),
+        )
+        count = int(self.max_entries * self.evict_to)
+      self._counts[table] = count
+    self._uncommitted += 1
+    if self._uncommitted >= self.commit_every:
+      self.commit()
+
+  def get_rxcui(self, term: str):
+    return self._get("term_rxcui", "term", "rxcui", normalize_term(term))
+
+  def set_rxcui(self, term: str, rxcui):
+    self._set("term_rxcui", "term", "rxcui", normalize_term(term), rxcui)
+
+  def get_name(self, rxcui: str):
+    return self._get("rxcui_name", "rxcui", "name", str(rxcui))
+
+  def set_name(self, rxcui: str, name):
+    self._set("rxcui_name", "rxcui", "name", str(rxcui), name)
+
+  def commit(self):
+    self.conn.commit()
+    self._uncommitted = 0
+
+  def close(self):
+    self.commit()
+    self.conn.close()
+
+
+# RxNav's published limit is 20 requests per second per IP address
+RXNAV_BASE_URL = "https://rxnav.nlm.nih.gov/REST"
+RXNAV_RATE_LIMIT = 20
+
+
+class RxNavClient:
+  """
+  Concurrent RxNav client. Each term runs approximateTerm -> rxcui properties
+  as one pipeline, up to `concurrency` terms in flight over a pooled keep-alive
+  session, with every request drawn from a shared token bucket (`rate` per second).
+  429/5xx responses and connection errors are retried with exponential backoff,
+  honouring Retry-After. An optional RxNormCache is consulted before the network.
+  """
+
+  def __init__(self, base_url: str = RXNAV_BASE_URL, cache: RxNormCache = None, concurrency: int = 8,
+               rate: float = RXNAV_RATE_LIMIT, max_retries: int = 4, timeout: float = 30):
+    self.base_url = base_url
+    self.cache = cache
+    self.concurrency = concurrency
+    self.rate = rate
+    self.max_retries = max_retries
+    self.timeout = timeout
+    self.requests = 0
+    self.errors = 0
+
+  async def _get_json(self, path: str, params: dict = None):
+    url = f"{self.base_url}/{path}"
+    for attempt in range(self.max_retries + 1):
+      await self._bucket.acquire()
+      response = None
+      try:
+        self.requests += 1
+        response = await self._pool.run(self._session.get, url, params=params, timeout=self.timeout)
+        if response.status_code != 429 and response.status_code < 500:
+          response.raise_for_status()
+          return response.json()
+      except (requests.ConnectionError, requests.Timeout):
+        pass
+      if attempt == self.max_retries:
+        break
+      delay = retry_after_seconds(response)
+      await asyncio.sleep(delay if delay is not None else backoff_delay(attempt))
+    if response is not None:
+      response.raise_for_status()
+    raise requests.ConnectionError(f"RxNav request failed after {self.max_retries + 1} attempts: {url}")
+
+  async def fetch_rxcui(self, term: str):
+    result = await self._get_json("approximateTerm.json", {"term": term, "maxEntries": 1})
+    candidates = (result.get("approximateGroup") or {}).get("candidate") or []
+    return candidates[0].get("rxcui") if candidates else None
+
+  async def fetch_drug_name(self, rxcui: str):
+    result = await self._get_json(f"rxcui/{rxcui}/properties.json")
+    return (result.get("properties") or {}).get("name")
+
+  async def rxcui_for(self, term: str):
+    if self.cache is not None:
+      rxcui = self.cache.get_rxcui(term)
+      if rxcui is not MISS:
+        return rxcui
+    rxcui = await self.fetch_rxcui(term)
+    if self.cache is not None:
+      self.cache.set_rxcui(term, rxcui)
+    return rxcui
+
+  async def name_for(self, rxcui: str):
+    # Many terms share an rxcui: the first caller fetches, the rest await the same task
+    task = self._names.get(rxcui)
+    if task is None:
+      task = asyncio.ensure_future(self._fetch_name_cached(rxcui))
+      self._names[rxcui] = task
+    return await task
+
+  async def _fetch_name_cached(self, rxcui: str):
+    if self.cache is not None:
+      name = self.cache.get_name(rxcui)
+      if name is not MISS:
+        return name
+    name = await self.fetch_drug_name(rxcui)
+    if self.cache is not None:
+      self.cache.set_name(rxcui, name)
+    return name
+
+  async def resolve(self, term: str):
+    """(rxcui, name) for a term; (None, None) on no match or after retries are exhausted."""
+    async with self._slots:
+      try:
+        rxcui = await self.rxcui_for(term)
+        if not rxcui:
+          return None, None
+        return rxcui, await self.name_for(rxcui)
+      except Exception:
+        self.errors += 1 # never cached, so the next run retries it
+        return None, None
+
+  async def resolve_terms(self, terms) -> dict:
+    """term -> drug name for every term RxNav can resolve."""
+    # No burst allowance: requests are spaced evenly so no 1s window exceeds the limit
+    self._bucket = TokenBucket(self.rate, capacity=1)
+    self._slots = asyncio.Semaphore(self.concurrency)
+    self._names = {}
+    self._session = pooled_session(self.concurrency)
+    self._pool = BlockingPool(self.concurrency)
+    terms = list(terms)
+    try:
+      results = await asyncio.gather(*(self.resolve(term) for term in terms))
+    finally:
+      self._pool.close()
+      self._session.close()
+      if self.cache is not None:
+        self.cache.commit()
+    return {term: name for term, (rxcui, name) in zip(terms, results) if name}
+
+
+######  Offline resolver built from the RxNorm RRF release ######
+#
+# build_rxnorm_index() reads RXNCONSO.RRF once and writes flat numpy files
+# into an index directory; OfflineRxNormResolver memory-maps them, so loading
+# is instant and only the pages a lookup touches are read from disk.
+
+# RXNCONSO.RRF columns (pipe-delimited)
+RRF_RXCUI, RRF_LAT, RRF_SAB, RRF_TTY, RRF_STR, RRF_SUPPRESS = 0, 1, 11, 12, 14, 16
+# Term types of extra RXNORM atoms of a concept (synonyms, prescribable names)
+SYNONYM_TTYS = {'SY', 'TMSY', 'PSN'}
+TRIGRAM_BUCKETS = 1 << 20
+
+
+def loose_normalize(term: str) -> str:
+    """Lowercase, punctuation to spaces, whitespace collapsed: 'Acetaminophen/Codeine' -> 'acetaminophen codeine'."""
+    return re.sub(r'[^0-9a-z]+', ' ', term.lower()).strip()
+
+
+def trigram_buckets(text: str) -> np.ndarray:
+    padded = f"  {text} "
+    return np.unique(np.array(
+        [zlib.crc32(padded[i:i + 3].encode('utf-8')) % TRIGRAM_BUCKETS for i in range(len(padded) - 2)],
+        dtype=np.int64))
+
+
+def save_strings(index_dir: Path, name: str, strings):
+    """Write strings as one utf-8 blob plus an offsets array."""
+    encoded = [s.encode('utf-8') for s in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    (index_dir / f"{name}.bin").write_bytes(b''.join(encoded))
+    np.save(index_dir / f"{name}_offsets.npy", offsets)
+
+
+class StringTable:
+  """Strings in a memory-mapped utf-8 blob; sorted tables also carry a parallel int64 value array."""
+
+  def __init__(self, blob, offsets, values=None):
+    self.blob = blob
+    self.offsets = offsets
+    self.values = values
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def key(self, i: int) -> str:
+    return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+  def find(self, key: str):
+    """Index of key via binary search over a sorted table, None if absent."""
+    lo, hi = 0, len(self)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      if self.key(mid) < key:
+        lo = mid + 1
+      else:
+        hi = mid
+    if lo < len(self) and self.key(lo) == key:
+      return lo
+    return None
+
+  @staticmethod
+  def save(index_dir: Path, name: str, mapping: dict):
+    """Save a str -> int mapping as a sorted table; returns the sorted keys."""
+    keys = sorted(mapping)
+    save_strings(index_dir, name, keys)
+    np.save(index_dir / f"{name}_values.npy", np.array([mapping[k] for k in keys], dtype=np.int64))
+    return keys
+
+  @classmethod
+  def load(cls, index_dir: Path, name: str):
+    blob_path = index_dir / f"{name}.bin"
+    blob = np.memmap(blob_path, dtype=np.uint8, mode='r') if blob_path.stat().st_size else np.zeros(0, np.uint8)
+    values_path = index_dir / f"{name}_values.npy"
+    values = np.load(values_path, mmap_mode='r') if values_path.exists() else None
+    return cls(blob, np.load(index_dir / f"{name}_offsets.npy", mmap_mode='r'), values)
+
+
+def build_rxnorm_index(rrf_path: str, index_dir: str, sabs=None):
+    """
+    Build the offline index from RXNCONSO.RRF (English, non-suppressed rows).
+    sabs optionally restricts the source vocabularies, e.g. {'RXNORM', 'MTHSPL'}.
+
+    Writes sorted tables lowercased string -> rxcui ('exact'), loosely
+    normalized string -> rxcui ('loose') and rxcui -> row of 'name_text'
+    ('names'), plus a trigram index (CSR over hashed buckets) of 'loose'.
+    """
+    index_dir = Path(index_dir)
+    index_dir.mkdir(parents=True, exist_ok=True)
+    exact, loose, names = {}, {}, {}
+    with open(rrf_path, 'r', encoding='utf-8') as f:
+      for line in f:
+        cols = line.rstrip('\n').split('|')
+        if len(cols) <= RRF_SUPPRESS or cols[RRF_LAT] != 'ENG' or cols[RRF_SUPPRESS] not in ('N', ''):
+          continue
+        if sabs and cols[RRF_SAB] not in sabs:
+          continue
+        rxcui, text, from_rxnorm = int(cols[RRF_RXCUI]), cols[RRF_STR], cols[RRF_SAB] == 'RXNORM'
+        # Strings from the RXNORM source win when several concepts share one string
+        rank = (not from_rxnorm, rxcui)
+        for table, key in ((exact, normalize_term(text)), (loose, loose_normalize(text))):
+          if key and (key not in table or rank < table[key][0]):
+            table[key] = (rank, rxcui)
+        # RxNav's properties name is the RXNORM atom of the concept's own term type,
+        # not its SY/TMSY/PSN synonyms; the string order only breaks remaining ties
+        name_rank = (not from_rxnorm, cols[RRF_TTY] in SYNONYM_TTYS, text)
+        if rxcui not in names or name_rank < names[rxcui][0]:
+          names[rxcui] = (name_rank, text)
+
+    StringTable.save(index_dir, 'exact', {k: v[1] for k, v in exact.items()})
+    loose_keys = StringTable.save(index_dir, 'loose', {k: v[1] for k, v in loose.items()})
+    name_rxcuis = list(names)
+    StringTable.save(index_dir, 'names', {str(r): i for i, r in enumerate(name_rxcuis)})
+    save_strings(index_dir, 'name_text', [names[r][1] for r in name_rxcuis])
+
+    # Trigram postings: bucket -> ids of 'loose' strings containing a trigram in that bucket
+    buckets = [trigram_buckets(k) for k in loose_keys]
+    counts = np.array([len(b) for b in buckets], dtype=np.int32)
+    all_buckets = np.concatenate(buckets) if buckets else np.zeros(0, np.int64)
+    all_ids = np.repeat(np.arange(len(loose_keys), dtype=np.int32), counts)
+    order = np.argsort(all_buckets, kind='stable')
+    indptr = np.zeros(TRIGRAM_BUCKETS + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(all_buckets, minlength=TRIGRAM_BUCKETS))
+    np.save(index_dir / "trigram_indptr.npy", indptr)
+    np.save(index_dir / "trigram_ids.npy", all_ids[order])
+    np.save(index_dir / "trigram_counts.npy", counts)
+    print(f"RxNorm index: {len(exact)} strings, {len(loose_keys)} normalized, {len(names)} concepts -> {index_dir}")
+
+
+class OfflineRxNormResolver:
+  """
+  Drop-in replacement for the RxNav lookups, served from a build_rxnorm_index()
+  directory. rxnorm_match tries the lowercased string, then the loosely
+  normalized string, then the closest trigram candidate whose similarity
+  (difflib ratio) is at least min_similarity.
+  """
+
+  def __init__(self, index_dir: str, min_similarity: float = 0.8, max_candidates: int = 50):
+    index_dir = Path(index_dir)
+    self.exact = StringTable.load(index_dir, 'exact')
+    self.loose = StringTable.load(index_dir, 'loose')
+    self.names = StringTable.load(index_dir, 'names')
+    self.name_text = StringTable.load(index_dir, 'name_text')
+    self.trigram_indptr = np.load(index_dir / "trigram_indptr.npy", mmap_mode='r')
+    self.trigram_ids = np.load(index_dir / "trigram_ids.npy", mmap_mode='r')
+    self.trigram_counts = np.load(index_dir / "trigram_counts.npy", mmap_mode='r')
+    self.min_similarity = min_similarity
+    self.max_candidates = max_candidates
+
+  def approximate_match(self, key: str):
+    """(rxcui, similarity) of the closest 'loose' string, None if nothing is similar enough."""
+    query = trigram_buckets(key)
+    if not len(query):
+      return None
+    postings = [self.trigram_ids[self.trigram_indptr[b]:self.trigram_indptr[b + 1]] for b in query]
+    ids, shared = np.unique(np.concatenate(postings), return_counts=True)
+    if not len(ids):
+      return None
+    # Shortlist by trigram Dice coefficient, then rerank on the actual strings
+    dice = 2 * shared / (len(query) + self.trigram_counts[ids])
+    shortlist = ids[np.argsort(-dice, kind='stable')[:self.max_candidates]]
+    best, best_score = None, self.min_similarity
+    for i in shortlist:
+      score = difflib.SequenceMatcher(None, key, self.loose.key(i)).ratio()
+      if score >= best_score:
+        best, best_score = i, score
+    if best is None:
+      return None
+    return int(self.loose.values[best]), best_score
+
+  def rxnorm_match(self, term: str):
+    """RXCUI (as a string, like RxNav) for a term, None if there is no match."""
+    i = self.exact.find(normalize_term(term))
+    if i is not None:
+      return str(self.exact.values[i])
+    key = loose_normalize(term)
+    if not key:
+      return None
+    i = self.loose.find(key)
+    if i is not None:
+      return str(self.loose.values[i])
+    match = self.approximate_match(key)
+    return str(match[0]) if match else None
+
+  def get_drug_name_from_rxcui(self, rxcui):
+    i = self.names.find(str(rxcui))
+    if i is None:
+      return None
+    return self.name_text.key(int(self.names.values[i]))
+
+  def resolve_terms(self, terms) -> dict:
+    """term -> drug name, same shape as RxNavClient.resolve_terms."""
+    term_to_drugs = {}
+    for term in terms:
+      rxcui = self.rxnorm_match(term)
+      name = self.get_drug_name_from_rxcui(rxcui) if rxcui else None
+      if name:
+        term_to_drugs[term] = name
+    return term_to_drugs
+
+
+######  Dictionary drug mention matcher ######
+
+# Term types kept by DrugDictionary.from_rrf: ingredients, brand names and synonyms
+DICTIONARY_TTYS = {'IN', 'PIN', 'MIN', 'BN', 'SY', 'TMSY'}
+_WORD = re.compile(r'[0-9A-Za-z]+')
+
+
+class DrugDictionary:
+  """
+  Word-level trie over drug names: one left-to-right pass over a body finds
+  every dictionary term, taking the longest match at each position (so
+  'acetaminophen codeine' wins over 'acetaminophen'). Terms are compared
+  after loose_normalize, so case and punctuation do not matter; returned
+  spans are the original text.
+  """
+
+  def __init__(self, terms=(), min_length: int = 3):
+    self.root = {}
+    self.size = 0
+    self.max_words = 0
+    self.min_length = min_length
+    for term in terms:
+      self.add(term)
+
+  def add(self, term: str):
+    words = loose_normalize(term).split()
+    if not words or len(' '.join(words)) < self.min_length:
+      return
+    node = self.root
+    for word in words:
+      node = node.setdefault(word, {})
+    if None not in node:
+      node[None] = term
+      self.size += 1
+    self.max_words = max(self.max_words, len(words))
+
+  @classmethod
+  def from_rrf(cls, rrf_path: str, ttys=DICTIONARY_TTYS, sabs=None, min_length: int = 3):
+    """Build from RXNCONSO.RRF rows of the given term types (TTY) and sources."""
+    dictionary = cls(min_length=min_length)
+    with open(rrf_path, 'r', encoding='utf-8') as f:
+      for line in f:
+        cols = line.rstrip('\n').split('|')
+        if len(cols) <= RRF_SUPPRESS or cols[RRF_LAT] != 'ENG' or cols[RRF_SUPPRESS] not in ('N', ''):
+          continue
+        if (ttys and cols[RRF_TTY] not in ttys) or (sabs and cols[RRF_SAB] not in sabs):
+          continue
+        dictionary.add(cols[RRF_STR])
+    return dictionary
+
+  def find_spans(self, text: str):
+    """Non-overlapping (start, end, text) spans of dictionary terms, left to right."""
+    words = [(m.start(), m.end(), m.group().lower()) for m in _WORD.finditer(text)]
+    spans = []
+    i = 0
+    while i < len(words):
+      node, longest = self.root, None
+      for j in range(i, min(len(words), i + self.max_words)):
+        node = node.get(words[j][2])
+        if node is None:
+          break
+        if None in node:
+          longest = j
+      if longest is None:
+        i += 1
+        continue
+      start, end = words[i][0], words[longest][1]
+      spans.append((start, end, text[start:end]))
+      i = longest + 1
+    return spans
+
+  def has_match(self, text: str) -> bool:
+    return bool(self.find_spans(text))
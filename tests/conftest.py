@@ -0,0 +1,24 @@
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+# The modules live flat at the repository root
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture
+def neo4j_server():
+    """
+    (uri, user, password) of a disposable Neo4j for integration tests, from
+    NEO4J_TEST_URI / NEO4J_TEST_USER / NEO4J_TEST_PASS. The database is wiped.
+    """
+    uri = os.getenv("NEO4J_TEST_URI")
+    if not uri:
+        pytest.skip("NEO4J_TEST_URI is not set")
+    neo4j = pytest.importorskip("neo4j")
+    auth = (os.getenv("NEO4J_TEST_USER", "neo4j"), os.getenv("NEO4J_TEST_PASS", "neo4j"))
+    with neo4j.GraphDatabase.driver(uri, auth=auth) as driver:
+        driver.execute_query("MATCH (n) DETACH DELETE n")
+    return (uri, *auth)
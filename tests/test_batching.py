@@ -0,0 +1,106 @@
+"""Cost-balanced batch splitting and shard claims for the enrichment stage."""
+
+import json
+import os
+import time
+
+from emailProcessor import (DEFAULT_BATCH_COST, SHARD_MANIFEST, ClaimHeartbeat, QwenEntityExtractor, claim_record,
+                            claim_shard, read_claim)
+
+
+def write_cases(path, sizes, body: str = "Body {i}.{j} " * 50):
+    with open(path, "w", encoding="utf-8") as f:
+        for i, emails in enumerate(sizes):
+            case = {"@type": "Thread", "hasPart": [{"@type": "EmailMessage", "body": body.format(i=i, j=j)}
+                                                   for j in range(emails)]}
+            f.write(json.dumps({"email_id": str(i), "output": json.dumps(case)}) + "\n")
+
+
+def test_batches_are_balanced_by_cost_by_default(tmp_path):
+    # a few huge threads among many one-email cases
+    write_cases(tmp_path / "cases.jsonl", [1] * 60 + [30] * 3 + [1] * 60)
+    extractor = QwenEntityExtractor("key", "model")
+
+    extractor.split_into_batches(str(tmp_path / "cases.jsonl"), str(tmp_path / "batches"))
+
+    manifest = json.loads((tmp_path / "batches" / SHARD_MANIFEST).read_text())
+    assert manifest["target_cost"] == DEFAULT_BATCH_COST
+    shards = manifest["shards"]
+    assert sum(shard["items"] for shard in shards) == 123
+    # only a single item may exceed the target on its own
+    assert all(shard["cost"] <= DEFAULT_BATCH_COST or shard["items"] == 1 for shard in shards)
+    assert len({shard["items"] for shard in shards}) > 1
+
+
+def test_fixed_item_batches_without_target_cost(tmp_path):
+    write_cases(tmp_path / "cases.jsonl", [1] * 25)
+    extractor = QwenEntityExtractor("key", "model")
+
+    extractor.split_into_batches(str(tmp_path / "cases.jsonl"), str(tmp_path / "batches"), target_cost=None)
+
+    shards = json.loads((tmp_path / "batches" / SHARD_MANIFEST).read_text())["shards"]
+    assert [shard["items"] for shard in shards] == [10, 10, 5]
+
+
+def write_claim(claim_file, worker_id, age: float = 0):
+    claim = json.loads(claim_record(worker_id, "their-token"))
+    claim["time"] -= age
+    claim_file.write_text(json.dumps(claim))
+
+
+def test_live_claims_are_kept_and_dead_ones_taken_over(tmp_path):
+    claim_file = tmp_path / "batch_001.msgpack.claim"
+    token = claim_shard(claim_file, "w1", stale_after=60)
+    assert token and read_claim(claim_file)["token"] == token
+
+    assert claim_shard(claim_file, "w2", stale_after=60) is None
+    # a restarted worker with the same id resumes its own shard
+    assert claim_shard(claim_file, "w1", stale_after=60) not in (None, token)
+
+    write_claim(claim_file, "w1", age=120) # not refreshed for stale_after
+    token = claim_shard(claim_file, "w2", stale_after=60)
+    assert read_claim(claim_file)["worker"] == "w2" and read_claim(claim_file)["token"] == token
+
+    claim = json.loads(claim_record("w3", "their-token"))
+    claim["pid"] = 2 ** 22 + 1 # above pid_max: no such process on this host
+    claim_file.write_text(json.dumps(claim))
+    assert claim_shard(claim_file, "w2", stale_after=60) is not None
+    assert list(tmp_path.iterdir()) == [claim_file] # no temp or renamed-aside files left
+
+
+def test_heartbeat_refreshes_the_claim_until_it_is_taken(tmp_path):
+    claim_file = tmp_path / "batch_001.msgpack.claim"
+    token = claim_shard(claim_file, "w1", stale_after=60)
+    claimed_at = read_claim(claim_file)["time"]
+
+    with ClaimHeartbeat(claim_file, "w1", token, interval=0.05) as heartbeat:
+        time.sleep(0.2)
+        assert read_claim(claim_file)["time"] > claimed_at
+        assert not heartbeat.lost.is_set()
+        write_claim(claim_file, "w2") # taken over after a missed refresh
+        assert heartbeat.lost.wait(1)
+    assert read_claim(claim_file)["worker"] == "w2"
+
+
+def test_workers_skip_live_claims_and_finished_shards(tmp_path):
+    # bodies without text need no API calls, so the workers only exercise the claims
+    write_cases(tmp_path / "cases.jsonl", [1] * 3, body=" ")
+    batches, output = tmp_path / "batches", tmp_path / "enriched"
+    extractor = QwenEntityExtractor("key", "model")
+    extractor.split_into_batches(str(tmp_path / "cases.jsonl"), str(batches), batch_format="msgpack",
+                                 target_cost=None, items_per_batch=1)
+    output.mkdir()
+    write_claim(output / "batch_001.msgpack.claim", "w2") # live: this process
+    write_claim(output / "batch_002.msgpack.claim", "w3", age=3600) # its worker died an hour ago
+
+    extractor.process_shards(str(batches), str(output), worker_id="w1", stale_after=60)
+
+    assert sorted(os.listdir(output)) == ["batch_001.msgpack.claim",
+                                          "enriched_batch_002.failures.jsonl", "enriched_batch_002.msgpack",
+                                          "enriched_batch_003.failures.jsonl", "enriched_batch_003.msgpack"]
+    finished = (output / "enriched_batch_002.msgpack").stat().st_mtime_ns
+
+    (output / "batch_001.msgpack.claim").unlink() # w2 gave up
+    extractor.process_shards(str(batches), str(output), worker_id="w1", stale_after=60)
+    assert (output / "enriched_batch_001.msgpack").exists()
+    assert (output / "enriched_batch_002.msgpack").stat().st_mtime_ns == finished
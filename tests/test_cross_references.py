@@ -0,0 +1,154 @@
+"""Sparse cross-references match the original dense cosine-similarity loop."""
+
+import json
+import random
+
+import pytest
+
+pytest.importorskip("sklearn")
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.metrics.pairwise import cosine_similarity
+
+from emailProcessor import _round_scores, add_cross_references_emailIds, extract_all_bodies
+from recordStream import iter_cases
+
+WORDS = ("shipment order pharmacy oxycodone hydrocodone suspicious distributor threshold "
+         "report review audit customer volume dea compliance monitor").split()
+
+
+def write_corpus(path, count: int = 60, seed: int = 7):
+    rng = random.Random(seed)
+    bodies = [" ".join(rng.choices(WORDS, k=12)) for _ in range(count // 3)]
+    with open(path, "w", encoding="utf-8") as f:
+        for i in range(count):
+            # Reused bodies give exact score ties, forwarded bodies exercise the joins
+            email = {"@type": "EmailMessage", "body": rng.choice(bodies)}
+            if i % 4 == 0:
+                email["forwardedMessage"] = {"@type": "EmailMessage", "body": rng.choice(bodies)}
+            case = {"@type": "Thread", "hasPart": email}
+            f.write(json.dumps({"email_id": f"e{i}", "output": json.dumps(case, indent=2)}) + "\n")
+
+
+def dense_cross_references(path, similarity_threshold: float):
+    texts, ids = [], []
+    for item, case in iter_cases(path):
+        texts.append(" ".join(extract_all_bodies(case["hasPart"])))
+        ids.append(item["email_id"])
+    sim = cosine_similarity(TfidfVectorizer(stop_words="english", lowercase=True).fit_transform(texts))
+    refs = {}
+    for i in range(len(ids)):
+        cross_refs = [{"cid": ids[j], "score": round(float(sim[i, j]), 4)}
+                      for j in range(len(ids)) if i != j and sim[i, j] > similarity_threshold]
+        cross_refs.sort(key=lambda x: x["score"], reverse=True)
+        refs[ids[i]] = cross_refs
+    return refs
+
+
+@pytest.mark.parametrize("block_size, n_jobs", [(1000, 1), (7, 3)])
+def test_sparse_matches_dense_baseline(tmp_path, block_size, n_jobs):
+    corpus = tmp_path / "cases.jsonl"
+    write_corpus(corpus)
+    expected = dense_cross_references(corpus, 0.6)
+
+    _, refs = add_cross_references_emailIds(str(corpus), str(tmp_path / "out.jsonl"), 0.6,
+                                            block_size=block_size, n_jobs=n_jobs)
+    assert refs == expected
+    for item, case in iter_cases(tmp_path / "out.jsonl"):
+        assert case["hasPart"]["crossRefInfo"]["crossRefEmails"] == expected[item["email_id"]]
+
+    _, top = add_cross_references_emailIds(str(corpus), str(tmp_path / "top.jsonl"), 0.6, top_k=3,
+                                           block_size=block_size, n_jobs=n_jobs)
+    assert top == {cid: cross_refs[:3] for cid, cross_refs in expected.items()}
+
+
+def test_sparse_scores_match_dense_at_threshold_boundary(tmp_path):
+    corpus = tmp_path / "cases.jsonl"
+    write_corpus(corpus)
+    scores = sorted({ref["score"] for refs in dense_cross_references(corpus, 0.0).values() for ref in refs})
+    # Thresholds equal to rounded scores: pairs on either side of the cut must agree
+    for threshold in scores[len(scores) // 4::len(scores) // 4]:
+        expected = dense_cross_references(corpus, threshold)
+        _, refs = add_cross_references_emailIds(str(corpus), str(tmp_path / "out.jsonl"), threshold)
+        assert refs == expected
+
+
+def test_scores_round_like_python_round():
+    np = pytest.importorskip("numpy")
+    # 0.12345 is stored just above the half step; np.round alone gives 0.1234
+    vals = np.array([0.12345, 0.30005, 0.99995, 0.5, 0.123449999, 0.71235])
+    assert _round_scores(vals).tolist() == [round(v, 4) for v in vals.tolist()]
+
+
+def test_oversized_lsh_bucket_is_not_expanded_into_all_pairs():
+    np = pytest.importorskip("numpy")
+    from emailProcessor import lsh_candidate_pairs, minhash_signatures
+
+    # 2000 copies of one disclaimer land in the same bucket of every band
+    disclaimer = "this message is confidential and intended only for the addressee".split()
+    signatures = minhash_signatures([disclaimer] * 2000 + [["unrelated", "words"]], num_perm=32)
+
+    assert len(lsh_candidate_pairs(signatures, bands=8, max_bucket_size=1000000)) == 2000 * 1999 // 2
+    pairs = lsh_candidate_pairs(signatures, bands=8, max_bucket_size=11)
+    assert len(pairs) < 2000 * 10
+    assert np.bincount(pairs.ravel(), minlength=2001).max() <= 10
+    assert (pairs[:, 0] < pairs[:, 1]).all()
+
+
+def write_items(path, bodies: dict):
+    with open(path, "w", encoding="utf-8") as f:
+        for email_id, body in bodies.items():
+            case = {"@type": "Thread", "hasPart": {"@type": "EmailMessage", "body": body}}
+            f.write(json.dumps({"email_id": email_id, "output": json.dumps(case)}) + "\n")
+
+
+def cross_refs(path):
+    return {item["email_id"]: [ref["cid"] for ref in (case["hasPart"].get("crossRefInfo") or {}).get("crossRefEmails", [])]
+            for item, case in iter_cases(path)}
+
+
+def test_incremental_run_appends_deltas_and_sidecar_back_references(tmp_path):
+    from emailProcessor import CrossReferenceIndex, add_cross_references_incremental, apply_cross_reference_deltas
+
+    index_dir = tmp_path / "index"
+    write_items(tmp_path / "base.jsonl", {
+        "a1": "oxycodone shipment pharmacy order review",
+        "a2": "oxycodone shipment pharmacy order audit",
+        "a3": "budget meeting travel expense report",
+        "a4": "budget meeting travel expense claim",
+    })
+    add_cross_references_emailIds(str(tmp_path / "base.jsonl"), str(tmp_path / "base_out.jsonl"), 0.3,
+                                  top_k=2, index_dir=str(index_dir))
+    assert cross_refs(tmp_path / "base_out.jsonl")["a4"] == ["a3"]
+    base_matrix = (index_dir / "matrix.npz").read_bytes()
+    base_output = (tmp_path / "base_out.jsonl").read_bytes()
+
+    # b1 matches a1/a2; a3 is re-ingested with pharmacy content, so a4's ref to it goes stale
+    write_items(tmp_path / "new.jsonl", {
+        "b1": "oxycodone shipment pharmacy order review",
+        "a3": "oxycodone pharmacy order audit review",
+    })
+    new_refs, back_refs = add_cross_references_incremental(str(tmp_path / "new.jsonl"), str(tmp_path / "new_out.jsonl"),
+                                                           str(index_dir), 0.3, top_k=2)
+
+    assert (index_dir / "matrix.npz").read_bytes() == base_matrix
+    assert (tmp_path / "base_out.jsonl").read_bytes() == base_output
+    assert sorted(p.name for p in index_dir.glob("*_0001*")) == ["backrefs_0001.json", "delta_0001.ids.json",
+                                                                 "delta_0001.npz"]
+    assert set(back_refs) <= {"a1", "a2"}
+
+    assert apply_cross_reference_deltas(str(tmp_path / "base_out.jsonl"), str(tmp_path / "patched.jsonl"),
+                                        str(index_dir)) > 0
+    patched = cross_refs(tmp_path / "patched.jsonl")
+    assert "a3" not in patched["a4"]
+    assert patched["a1"][0] == "b1" # identical body
+    assert "a3" in patched["a2"] # the new a3 matches; top_k=2 pushes out the weaker ref
+    assert all(len(refs) <= 2 for refs in patched.values())
+    # applying again gives the same result
+    apply_cross_reference_deltas(str(tmp_path / "patched.jsonl"), str(tmp_path / "again.jsonl"), str(index_dir))
+    assert cross_refs(tmp_path / "again.jsonl") == patched
+
+    index = CrossReferenceIndex.load(str(index_dir))
+    assert len(index.ids) == 6 and int(index.live_rows().sum()) == 5
+    index.save()
+    assert not list(index_dir.glob("delta_*")) and not list(index_dir.glob("backrefs_*"))
+    assert sorted(CrossReferenceIndex.load(str(index_dir)).ids) == ["a1", "a2", "a3", "a4", "b1"]
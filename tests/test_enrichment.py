@@ -0,0 +1,379 @@
+"""QwenEntityExtractor's concurrent, rate-limited enrichment against a local stand-in for OpenRouter."""
+
+import json
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from emailProcessor import (EnrichmentPrefilter, QwenEntityExtractor, ShardClaimLost, journal_path,
+                            read_failure_index, reprocessFailedBatch)
+from recordStream import RecordWriter, iter_cases
+from llmClient import LLMDispatcher
+
+
+class FakeOpenRouter:
+    def __init__(self, delay: float = 0.05, throttle_first: int = 0, retry_after: str = "0",
+                 reject_bodies=(), on_call=None, reject_key: bool = False):
+        self.delay = delay
+        self.throttle_first = throttle_first
+        self.retry_after = retry_after
+        self.reject_bodies = set(reject_bodies) # bodies answered with a 400
+        self.on_call = on_call # called with the call number as each request arrives
+        self.reject_key = reject_key # answer every request with a 401
+        self.calls = 0
+        self.in_flight = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                with fake.lock:
+                    fake.calls += 1
+                    throttled = fake.calls <= fake.throttle_first
+                    fake.in_flight += 1
+                    fake.peak = max(fake.peak, fake.in_flight)
+                    call = fake.calls
+                if fake.on_call is not None:
+                    fake.on_call(call)
+                time.sleep(fake.delay)
+                with fake.lock:
+                    fake.in_flight -= 1
+                if fake.reject_key:
+                    return self.reply(401, {"error": {"message": "invalid API key"}})
+                if throttled:
+                    return self.reply(429, {"error": {"message": "rate limited"}}, {"Retry-After": fake.retry_after})
+                body = re.search(r"Email Body:\s*\n\s*(.*?)\n", payload["messages"][-1]["content"]).group(1)
+                if body.strip() in fake.reject_bodies:
+                    return self.reply(400, {"error": {"message": "bad request"}})
+                content = {"decisions_made": [body.strip()], "concerns_raised": [], "people_mentioned": [],
+                           "locations_mentioned": [], "events_mentioned": [], "financial_mentions": []}
+                self.reply(200, {"choices": [{"message": {"content": json.dumps(content)}}],
+                                 "usage": {"prompt_tokens": 100, "completion_tokens": 20}})
+
+            def reply(self, status, body, headers=None):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+@pytest.fixture
+def openrouter():
+    def start(**kwargs):
+        fake = FakeOpenRouter(**kwargs)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), fake.handler())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return fake, f"http://127.0.0.1:{server.server_port}/api/v1/chat/completions"
+
+    servers = []
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def emails(count: int):
+    return [{"@type": "EmailMessage", "body": f"Please review shipment report number {i}."} for i in range(count)]
+
+
+def write_batch(path, cases: int, emails_per_case: int = 2):
+    with RecordWriter(path) as writer:
+        for i in range(cases):
+            parts = emails(cases * emails_per_case)[i * emails_per_case:(i + 1) * emails_per_case]
+            writer.write({"email_id": f"case{i}", "output": {"@type": "Thread", "hasPart": parts}})
+
+
+def enriched_bodies(path):
+    return {email["body"]: email["enriched_content"] for _, case in iter_cases(path) for email in case["hasPart"]}
+
+
+def test_enrichment_is_concurrent_and_rate_limited(openrouter):
+    fake, url = openrouter()
+    extractor = QwenEntityExtractor("key", "model", concurrency=4, requests_per_minute=1200, base_url=url)
+    email_objs = emails(40)
+
+    start = time.monotonic()
+    assert extractor.enrich_emails(email_objs) == 40
+    elapsed = time.monotonic() - start
+
+    for email_obj in email_objs:
+        assert email_obj["enriched_content"]["decisions_made"] == [email_obj["body"]]
+    assert 2 <= fake.peak <= 4
+    # 20 requests/s with a burst of 20: the other 20 requests need at least ~1s
+    assert elapsed >= 0.9
+
+
+def test_throttled_requests_are_retried(openrouter):
+    fake, url = openrouter(throttle_first=2)
+    extractor = QwenEntityExtractor("key", "model", concurrency=1, requests_per_minute=6000, base_url=url)
+    email_objs = emails(3)
+
+    extractor.enrich_emails(email_objs)
+
+    assert all(not e["enriched_content"].get("error") for e in email_objs)
+    assert extractor.error_counts["rate_limit"] == 2
+    assert fake.calls == 5
+
+
+def test_cached_replies_are_not_sent_again(openrouter, tmp_path):
+    fake, url = openrouter()
+    cache_path = str(tmp_path / "responses.sqlite")
+    QwenEntityExtractor("key", "model", base_url=url, cache_path=cache_path).enrich_emails(emails(5))
+    assert fake.calls == 5
+
+    rerun = QwenEntityExtractor("key", "model", base_url=url, cache_path=cache_path)
+    email_objs = emails(5)
+    assert rerun.enrich_emails(email_objs) == 0
+    assert rerun.response_cache.hits == 5
+    assert email_objs[0]["enriched_content"]["decisions_made"] == [email_objs[0]["body"]]
+
+
+def test_throttled_pack_is_not_split_into_single_calls(openrouter):
+    fake, url = openrouter(throttle_first=100)
+    extractor = QwenEntityExtractor("key", "model", requests_per_minute=6000, base_url=url,
+                                    pack_token_budget=2000, max_retries=0)
+    email_objs = emails(4)
+
+    extractor.enrich_emails(email_objs)
+
+    assert fake.calls == 1
+    assert all(e["enriched_content"]["error_type"] == "rate_limit" for e in email_objs)
+    assert extractor.pack_fallbacks == 0
+
+
+def test_pack_reply_without_email_ids_falls_back_to_single_calls(openrouter):
+    fake, url = openrouter()
+    extractor = QwenEntityExtractor("key", "model", requests_per_minute=6000, base_url=url, pack_token_budget=2000)
+    email_objs = emails(4)
+
+    extractor.enrich_emails(email_objs)
+
+    assert fake.calls == 5
+    assert extractor.pack_fallbacks == 4
+    assert all(e["enriched_content"]["decisions_made"] == [e["body"]] for e in email_objs)
+
+
+def test_body_over_chunk_tokens_is_chunked_not_packed(openrouter):
+    fake, url = openrouter()
+    extractor = QwenEntityExtractor("key", "model", requests_per_minute=6000, base_url=url,
+                                    pack_token_budget=4000, chunk_tokens=40)
+    long_body = "\n\n".join(f"Paragraph {i} about the suspicious order review." for i in range(8))
+    email_objs = emails(3) + [{"@type": "EmailMessage", "body": long_body}]
+
+    pending = {str(i): [e] for i, e in enumerate(email_objs)}
+    assert ["3"] in extractor.plan_packs(pending)
+
+    extractor.enrich_emails(email_objs)
+    assert extractor.chunked_bodies == 1
+    assert not email_objs[3]["enriched_content"].get("error")
+
+
+def test_throttled_endpoint_fails_over_without_pausing_the_pool(openrouter):
+    throttled, throttled_url = openrouter(throttle_first=1000, retry_after="30")
+    healthy, healthy_url = openrouter()
+    dispatcher = LLMDispatcher.from_config([
+        {"api_key": "a", "model": "m1", "requests_per_minute": 6000, "base_url": throttled_url},
+        {"api_key": "b", "model": "m2", "requests_per_minute": 6000, "base_url": healthy_url},
+    ])
+    extractor = QwenEntityExtractor("key", "model", dispatcher=dispatcher, breaker_threshold=1, breaker_cooldown=30)
+    email_objs = emails(6)
+
+    start = time.monotonic()
+    extractor.enrich_emails(email_objs)
+
+    assert time.monotonic() - start < 10
+    assert extractor.breaker.trips == 0
+    assert all(not e["enriched_content"].get("error") for e in email_objs)
+    assert healthy.calls == 6
+
+
+def test_repeated_and_quoted_bodies_are_enriched_once(openrouter):
+    fake, url = openrouter()
+    extractor = QwenEntityExtractor("key", "model", requests_per_minute=6000, base_url=url)
+    body = "Please hold the Ohio order pending review."
+    email_objs = [{"@type": "EmailMessage", "body": body},
+                  {"@type": "EmailMessage", "body": f"> {body}"},
+                  {"@type": "EmailMessage", "body": ">>  Please hold the Ohio   order pending review."}]
+
+    assert extractor.enrich_emails(email_objs) == 1
+    assert extractor.reused_calls == 2
+    assert all(e["enriched_content"]["decisions_made"] == [body] for e in email_objs)
+    # copies are independent, so editing one email's content leaves the others alone
+    email_objs[1]["enriched_content"]["decisions_made"].append("edited")
+    assert email_objs[2]["enriched_content"]["decisions_made"] == [body]
+
+    # a later batch quoting the same message reuses the result without a call
+    forwarded = [{"@type": "EmailMessage", "body": f"> {body}"}]
+    assert extractor.enrich_emails(forwarded) == 0
+    assert fake.calls == 1
+    assert forwarded[0]["enriched_content"]["decisions_made"] == [body]
+
+
+def test_reused_results_are_bounded(openrouter):
+    fake, url = openrouter()
+    extractor = QwenEntityExtractor("key", "model", requests_per_minute=6000, base_url=url, reuse_max_bodies=2,
+                                    concurrency=1)
+
+    extractor.enrich_emails(emails(3))
+    assert len(extractor.reused_results) == 2
+
+    # body 0 was the least recently used, so it is sent again; body 2 is still held
+    assert extractor.enrich_emails(emails(3)[2:]) == 0
+    assert extractor.enrich_emails(emails(1)) == 1
+    assert fake.calls == 4
+
+
+def test_only_failed_emails_are_reprocessed(openrouter, tmp_path):
+    rejected = {"Please review shipment report number 1.", "Please review shipment report number 4."}
+    fake, url = openrouter(reject_bodies=rejected)
+    (tmp_path / "batches").mkdir()
+    (tmp_path / "enriched").mkdir()
+    batch_file = tmp_path / "batches" / "batch_001.msgpack"
+    enriched_file = tmp_path / "enriched" / "processed_batch_001.msgpack"
+    write_batch(batch_file, 3)
+
+    extractor = QwenEntityExtractor("key", "model", requests_per_minute=6000, base_url=url)
+    assert extractor.process_batch(str(batch_file), str(enriched_file)) == 6
+
+    failures = read_failure_index(enriched_file)
+    assert [(f["email_id"], f["path"], f["error_type"]) for f in failures] == [
+        ("case0", ["hasPart", 1], "client"), ("case2", ["hasPart", 0], "client")]
+
+    reprocessor = reprocessFailedBatch("key", model="model", base_url=url)
+    fake.reject_bodies = {"Please review shipment report number 4."}
+    assert reprocessor.reprocess_failed_batches(str(tmp_path / "batches"), str(tmp_path / "enriched")) == 2
+    assert [f["email_id"] for f in read_failure_index(enriched_file)] == ["case2"]
+
+    fake.reject_bodies = set()
+    assert reprocessor.reprocess_failed_batches(str(tmp_path / "batches"), str(tmp_path / "enriched")) == 1
+    assert read_failure_index(enriched_file) == []
+    assert reprocessor.find_error_inBatches(str(tmp_path / "enriched")) == []
+    assert fake.calls == 9
+    for body, enriched in enriched_bodies(enriched_file).items():
+        assert enriched["decisions_made"] == [body]
+
+
+def test_interrupted_batch_resumes_from_its_journal(openrouter, tmp_path):
+    interrupted = threading.Event()
+    fake, url = openrouter(on_call=lambda call: call == 3 and interrupted.set())
+    batch_file = tmp_path / "batch_001.msgpack"
+    output_file = tmp_path / "enriched_batch_001.msgpack"
+    write_batch(batch_file, 3)
+
+    # stopped while the third email is in flight: its reply is dropped, not journaled
+    extractor = QwenEntityExtractor("key", "model", concurrency=1, requests_per_minute=6000, base_url=url)
+    with pytest.raises(ShardClaimLost):
+        extractor.process_batch(str(batch_file), str(output_file), abort=interrupted)
+    assert not output_file.exists()
+    with open(journal_path(output_file), "a", encoding="utf-8") as f:
+        f.write('{"item": 2, "pa') # torn by the crash
+
+    # a request already picked up when the abort lands is still sent, but not journaled
+    assert fake.calls in (3, 4)
+
+    restarted = QwenEntityExtractor("key", "model", concurrency=1, requests_per_minute=6000, base_url=url)
+    assert restarted.process_batch(str(batch_file), str(output_file)) == 4
+    assert not journal_path(output_file).exists()
+    for body, enriched in enriched_bodies(output_file).items():
+        assert enriched["decisions_made"] == [body]
+
+
+def test_journal_of_another_batch_is_ignored(openrouter, tmp_path):
+    fake, url = openrouter()
+    write_batch(tmp_path / "batch_001.msgpack", 1)
+    output_file = tmp_path / "enriched_batch_001.msgpack"
+    journal_path(output_file).write_text('{"batch": "batch_002.msgpack"}\n{"item": 0, "path": ["hasPart", 0], '
+                                         '"key": "x", "enriched_content": {}}\n')
+
+    extractor = QwenEntityExtractor("key", "model", requests_per_minute=6000, base_url=url)
+    assert extractor.process_batch(str(tmp_path / "batch_001.msgpack"), str(output_file)) == 2
+
+
+def test_prefilter_skips_bodies_without_content(openrouter):
+    fake, url = openrouter()
+    extractor = QwenEntityExtractor("key", "model", requests_per_minute=6000, base_url=url,
+                                    prefilter=EnrichmentPrefilter())
+    skipped = ["Thanks!", "Ok, got it. Thanks", "I am out of the office until Monday with limited access to email.",
+               "> Please review shipment report number 1.\nThanks, will do"]
+    kept = ["The DEA meeting approved the opioid sales plan for 2 million doses.",
+            " ".join(["word"] * 60)] # long bodies are always sent
+    email_objs = [{"@type": "EmailMessage", "body": body} for body in skipped + kept + ["Thanks!"]]
+
+    assert extractor.enrich_emails(email_objs) == 2
+    assert fake.calls == 2
+    assert extractor.prefiltered_calls == 4 # a repeated body is only counted once
+    for email_obj in email_objs[:4] + email_objs[-1:]:
+        assert email_obj["enriched_content"]["skipped"] == "prefilter"
+        assert email_obj["enriched_content"]["decisions_made"] == []
+    for email_obj in email_objs[4:6]:
+        assert email_obj["enriched_content"]["decisions_made"] == [email_obj["body"]]
+
+
+def test_prefilter_weights_are_learned_from_enriched_batches(tmp_path):
+    enriched_file = tmp_path / "enriched_batch_001.msgpack"
+    with RecordWriter(enriched_file) as writer:
+        for i in range(20):
+            substantive = i % 2 == 0
+            body = f"Budget meeting {i} decided on the launch plan." if substantive else f"Sounds good {i}, thanks."
+            content = {"decisions_made": [body] if substantive else []}
+            writer.write({"email_id": str(i), "output": {"@type": "Thread", "hasPart": [
+                {"@type": "EmailMessage", "body": body, "enriched_content": content}]}})
+
+    prefilter = EnrichmentPrefilter(min_words=1).fit_from_enriched([enriched_file])
+
+    assert prefilter.weights["keywords"] > 0
+    assert prefilter.should_enrich("Budget meeting 99 decided on the launch plan.")
+    assert not prefilter.should_enrich("Sounds good 99, thanks.")
+
+
+def test_rejected_key_is_dropped_from_the_pool(openrouter):
+    rejected, rejected_url = openrouter(reject_key=True)
+    healthy, healthy_url = openrouter()
+    dispatcher = LLMDispatcher.from_config([
+        {"api_key": "a", "model": "m1", "requests_per_minute": 6000, "base_url": rejected_url, "weight": 100},
+        {"api_key": "b", "model": "m2", "requests_per_minute": 6000, "base_url": healthy_url},
+    ])
+    extractor = QwenEntityExtractor("key", "model", dispatcher=dispatcher, concurrency=1)
+    email_objs = emails(6)
+
+    extractor.enrich_emails(email_objs)
+
+    assert all(not e["enriched_content"].get("error") for e in email_objs)
+    assert rejected.calls == 1
+    assert healthy.calls == 6
+    assert dispatcher.usable_count() == 1
+    assert extractor.breaker.trips == 0
+
+
+def test_every_key_rejected_fails_fast(openrouter):
+    rejected, rejected_url = openrouter(reject_key=True)
+    dispatcher = LLMDispatcher.from_config([
+        {"api_key": key, "model": "m1", "requests_per_minute": 6000, "base_url": rejected_url} for key in "ab"])
+    extractor = QwenEntityExtractor("key", "model", dispatcher=dispatcher, concurrency=1)
+    email_objs = emails(3)
+
+    start = time.monotonic()
+    extractor.enrich_emails(email_objs)
+
+    assert time.monotonic() - start < 5
+    assert rejected.calls == 2
+    assert dispatcher.usable_count() == 0
+    assert all(e["enriched_content"]["error_type"] == "auth" for e in email_objs)
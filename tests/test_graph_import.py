@@ -0,0 +1,149 @@
+"""Flattening, partitioning and manifest bookkeeping of the batched Neo4j import."""
+
+import csv
+import json
+
+import pytest
+
+pytest.importorskip("neo4j")
+from graphQueries import (GraphBatch, case_content_hash, case_email_ids, export_jsonl_to_neo4j_csv, flatten_case,
+                          flatten_changed_case, partition_graph_batches)
+
+
+def case(case_id: str, emails: int, refer_to: str = None, sender: str = "Shared Sender"):
+    parts = []
+    for i in range(emails):
+        email = {"identifier": f"{case_id}-e{i}", "body": "text",
+                 "sender": {"name": sender, "email": "sender@example.com"},
+                 "enriched_content": {"decisions_made": ["hold the order"]},
+                 "forwardedMessage": {"identifier": f"{case_id}-e{i}-fwd", "body": "older"}}
+        if refer_to:
+            email["crossRefInfo"] = {"crossRefEmails": [{"cid": refer_to, "score": 0.5}]}
+        parts.append(email)
+    return {"identifier": case_id, "hasPart": parts}
+
+
+def rows(batch: GraphBatch):
+    return {(group, start, end) for group, group_rows in batch.rels.items() for start, end in group_rows}
+
+
+def test_relationships_are_partitioned_by_thread_in_two_phases():
+    batches = []
+    for i in range(12):
+        batch = GraphBatch()
+        flatten_case(batch, case(f"c{i}", emails=3, refer_to="c0-e0" if i else None))
+        batches.append(batch)
+
+    node_parts, rel_phases = partition_graph_batches(batches, 4)
+
+    assert len(rel_phases) == 2
+    threads, cross = rel_phases
+    assert sum(1 for part in threads if not part.is_empty()) == 4
+    # each Case/Email is locked by a single writer of the thread phase
+    for label in ("Case", "Email"):
+        owners = {}
+        for i, part in enumerate(threads):
+            for (rel_type, start_label, end_label), part_rows in part.rels.items():
+                for start, end in part_rows:
+                    for node_label, key in ((start_label, start), (end_label, end)):
+                        if node_label == label:
+                            assert owners.setdefault(key, i) == i
+    # cross-references wait for the second phase; nothing is lost or duplicated
+    assert all(group[0] == "REFERS_TO_EMAIL" for part in cross for group in part.rels)
+    expected = set().union(*(rows(batch) for batch in batches))
+    written = [row for phase in rel_phases for part in phase for row in rows(part)]
+    assert len(written) == len(expected) and set(written) == expected
+
+
+def write_jsonl(path, cases):
+    with open(path, "w", encoding="utf-8") as f:
+        for case_obj in cases:
+            f.write(json.dumps({"output": json.dumps(case_obj)}) + "\n")
+
+
+def read_csv(path):
+    with open(path, encoding="utf-8", newline="") as f:
+        return list(csv.reader(f))
+
+
+def test_csv_export_streams_deduplicated_rows_with_case_hashes(tmp_path):
+    # c0 refers to c1-e0 before c1 itself is read: the real Email row must win
+    cases = [case("c0", emails=2, refer_to="c1-e0"), case("c1", emails=2), case("c0", emails=2, refer_to="c1-e0")]
+    write_jsonl(tmp_path / "cases.jsonl", cases)
+
+    written = export_jsonl_to_neo4j_csv(str(tmp_path / "cases.jsonl"), str(tmp_path / "csv"))
+
+    header, *case_rows = read_csv(tmp_path / "csv" / "nodes_Case.csv")
+    assert "content_hash" in header
+    hashes = {row[0]: row[header.index("content_hash")] for row in case_rows}
+    assert hashes == {"c0": case_content_hash(cases[0]), "c1": case_content_hash(cases[1])}
+
+    header, *email_rows = read_csv(tmp_path / "csv" / "nodes_Email.csv")
+    ids = [row[0] for row in email_rows]
+    assert len(ids) == len(set(ids)) == 8
+    assert dict(zip(ids, email_rows))["c1-e0"][header.index("body")] == "text"
+
+    header, *ref_rows = read_csv(tmp_path / "csv" / "rels_REFERS_TO_EMAIL_Email_Email.csv")
+    assert header[:3] == [":START_ID(Email)", ":END_ID(Email)", ":TYPE"]
+    assert "similarity_score:float" in header
+    assert len(ref_rows) == 2
+    assert all(path.startswith(str(tmp_path)) for paths in written.values() for path in paths)
+
+
+def test_stale_cases_record_the_emails_their_new_version_keeps():
+    old, new = case("c0", emails=3), case("c0", emails=1)
+    known = {"c0": case_content_hash(old)}
+
+    batch = GraphBatch()
+    assert flatten_changed_case(batch, new, known)
+
+    assert batch.stale_case_ids == ["c0"]
+    assert sorted(batch.stale_email_ids) == ["c0-e0", "c0-e0-fwd"]
+    assert sorted(case_email_ids(new)) == ["c0-e0", "c0-e0-fwd"]
+    assert not flatten_changed_case(GraphBatch(), old, known)
+
+
+def graph_counts(server):
+    from neo4j import GraphDatabase
+
+    uri, user, password = server
+    with GraphDatabase.driver(uri, auth=(user, password)) as driver:
+        records, _, _ = driver.execute_query(
+            """
+            MATCH (e:Email)
+            OPTIONAL MATCH (e)-[r:HAS_DECISION]->()
+            OPTIONAL MATCH (:Person)-[s:SENT]->(e)
+            RETURN e.identifier AS email, count(DISTINCT r) AS decisions, count(DISTINCT s) AS senders
+            """
+        )
+        decisions, _, _ = driver.execute_query("MATCH (d:Decision) RETURN d.text AS text")
+    return {r["email"]: (r["decisions"], r["senders"]) for r in records}, {r["text"] for r in decisions}
+
+
+@pytest.mark.parametrize("importer", ["import_jsonl_to_neo4j", "import_jsonl_to_neo4j_batched"])
+def test_reimport_replaces_shared_and_removed_emails(neo4j_server, tmp_path, importer):
+    import graphQueries
+
+    def run(cases):
+        write_jsonl(tmp_path / "cases.jsonl", cases)
+        getattr(graphQueries, importer)(str(tmp_path / "cases.jsonl"), *neo4j_server, skip_unchanged=True)
+
+    def shared_thread(case_id, decision, emails=2):
+        case_obj = case(case_id, emails=emails)
+        case_obj["hasPart"].append({"identifier": "shared", "body": "text",
+                                    "sender": {"name": "Shared Sender", "email": "sender@example.com"},
+                                    "enriched_content": {"decisions_made": [decision]}})
+        for email in case_obj["hasPart"]:
+            email["enriched_content"] = {"decisions_made": [decision]}
+        return case_obj
+
+    run([shared_thread("a", "ship"), shared_thread("b", "ship")])
+    # both cases change: the shared email is owned by the pair and must be replaced, not added to;
+    # case a also drops its second email
+    run([shared_thread("a", "hold", emails=1), shared_thread("b", "hold")])
+
+    emails, decisions = graph_counts(neo4j_server)
+    assert emails["shared"] == (1, 1)
+    assert "a-e1" not in emails and "a-e1-fwd" not in emails
+    assert decisions == {"hold"}
+    assert all(counts == (1, 1) for email, counts in emails.items() if not email.endswith("-fwd"))
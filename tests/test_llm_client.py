@@ -0,0 +1,65 @@
+"""LLMResponseCache: keying, LRU eviction and error replay."""
+
+import pytest
+
+from llmClient import CachedError, LLMResponseCache
+
+
+def payload(prompt: str, model: str = "m1", temperature: float = 0.1):
+    return {"model": model, "temperature": temperature, "messages": [{"role": "user", "content": prompt}]}
+
+
+def test_replies_are_keyed_by_model_temperature_and_prompt(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / "cache.sqlite"))
+    cache.put(payload("a"), {"answer": 1}, {"prompt_tokens": 10, "completion_tokens": 5})
+
+    assert cache.get(payload("a")) == {"answer": 1}
+    assert cache.get(payload("b")) is None
+    assert cache.get(payload("a", model="m2")) is None
+    assert cache.get(payload("a", temperature=0.7)) is None
+    # any model of a dispatcher pool may answer
+    assert cache.get(payload("a", model="m2"), models=["m2", "m1"]) == {"answer": 1}
+    assert (cache.hits, cache.misses, cache.saved_tokens) == (2, 3, 30)
+
+
+def test_replies_survive_reopening(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = LLMResponseCache(path)
+    cache.put(payload("a"), ["x"])
+    cache.close()
+
+    reopened = LLMResponseCache(path)
+    assert reopened.get(payload("a")) == ["x"]
+    assert reopened.total_bytes == len('["x"]')
+
+
+def test_least_recently_used_replies_are_evicted(tmp_path):
+    cache = LLMResponseCache(str(tmp_path / "cache.sqlite"), max_bytes=25)
+    for prompt in "abc":
+        cache.put(payload(prompt), prompt * 8) # 10 bytes each as JSON
+    # 30 bytes > 25: the oldest reply goes
+    assert cache.get(payload("a")) is None
+    assert cache.total_bytes == 20
+
+    cache.get(payload("b")) # now c is the least recently used
+    cache.put(payload("d"), "d" * 8)
+    assert cache.get(payload("c")) is None
+    assert cache.get(payload("b")) == "b" * 8
+    assert cache.get(payload("d")) == "d" * 8
+
+
+def test_errors_are_only_replayed_when_configured(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    cache = LLMResponseCache(path)
+    cache.put(payload("a"), "HTTP 400", is_error=True)
+    assert cache.get(payload("a")) is None
+    cache.close()
+
+    replaying = LLMResponseCache(path, cache_errors=True)
+    replaying.put(payload("a"), "HTTP 400", is_error=True)
+    with pytest.raises(CachedError):
+        replaying.get(payload("a"))
+    replaying.close()
+
+    # error entries already on disk are ignored once cache_errors is off again
+    assert LLMResponseCache(path).get(payload("a")) is None
@@ -0,0 +1,57 @@
+"""RecordWriter keeps the 'output' JSON string convention when converting between formats."""
+
+import json
+
+import pytest
+
+pytest.importorskip("msgpack")
+from emailProcessor import merge_batches_to_jsonl
+from recordStream import RecordWriter, iter_cases, iter_records
+
+
+def test_msgpack_batches_merge_to_jsonl_with_string_output(tmp_path):
+    case = {"@type": "EmailMessage", "body": "Shipment report attached.", "crossRefEmails": ["2"]}
+    with RecordWriter(tmp_path / "enriched_batch_001.msgpack") as writer:
+        writer.write({"email_id": "1", "output": json.dumps(case, indent=2)})
+
+    merged = tmp_path / "merged.jsonl"
+    assert merge_batches_to_jsonl(str(tmp_path), str(merged)) == 1
+
+    item = next(iter_records(merged))
+    assert isinstance(item["output"], str)
+    assert json.loads(item["output"]) == case
+
+
+def test_modified_case_is_encoded_into_json_array(tmp_path):
+    source = tmp_path / "cases.msgpack"
+    with RecordWriter(source) as writer:
+        writer.write({"email_id": "1", "output": {"body": "old"}})
+
+    target = tmp_path / "cases.json"
+    with RecordWriter(target) as writer:
+        for item, case in iter_cases(source):
+            case["body"] = "new"
+            writer.write(item, case)
+
+    (item,) = json.loads(target.read_text(encoding="utf-8"))
+    assert json.loads(item["output"]) == {"body": "new"}
+
+
+def test_json_array_without_ijson_warns(tmp_path, monkeypatch):
+    import recordStream
+
+    path = tmp_path / "cases.json"
+    path.write_text(json.dumps([{"email_id": "1"}, {"email_id": "2"}]), encoding="utf-8")
+    monkeypatch.setattr(recordStream, "ijson", None)
+
+    with pytest.warns(RuntimeWarning, match="ijson"):
+        assert [item["email_id"] for item in iter_records(path)] == ["1", "2"]
+
+
+def test_merge_returns_records_on_request(tmp_path):
+    with RecordWriter(tmp_path / "enriched_batch_001.json") as writer:
+        writer.write({"email_id": "1", "output": "{}"})
+
+    assert merge_batches_to_jsonl(str(tmp_path), str(tmp_path / "merged.jsonl")) == 1
+    assert merge_batches_to_jsonl(str(tmp_path), str(tmp_path / "merged.jsonl"), return_data=True) == [
+        {"email_id": "1", "output": "{}"}]
@@ -0,0 +1,159 @@
+"""RxNavClient + RxNormCache against a local stand-in for the RxNav REST API."""
+
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from asyncPool import run_async
+from rxnormResolvers import MISS, RxNavClient, RxNormCache
+
+RXCUIS = {"oxycodone": "7804", "oxycontin": "7804", "hydrocodone": "5489"}
+NAMES = {"7804": "oxycodone", "5489": "hydrocodone"}
+
+
+class FakeRxNav:
+    def __init__(self, throttle_first: int = 0, delay: float = 0):
+        self.requests = Counter() # path -> count
+        self.throttle_first = throttle_first
+        self.delay = delay
+        self.in_flight = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                with fake.lock:
+                    fake.requests[url.path] += 1
+                    throttled = sum(fake.requests.values()) <= fake.throttle_first
+                    fake.in_flight += 1
+                    fake.peak = max(fake.peak, fake.in_flight)
+                time.sleep(fake.delay)
+                with fake.lock:
+                    fake.in_flight -= 1
+                if throttled:
+                    self.reply(429, {}, {"Retry-After": "0"})
+                elif url.path.endswith("/approximateTerm.json"):
+                    term = parse_qs(url.query)["term"][0]
+                    candidates = [{"rxcui": RXCUIS[term]}] if term in RXCUIS else []
+                    self.reply(200, {"approximateGroup": {"candidate": candidates}})
+                else:
+                    rxcui = url.path.split("/")[-2]
+                    self.reply(200, {"properties": {"name": NAMES[rxcui]}})
+
+            def reply(self, status, body, headers=None):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        return Handler
+
+
+@pytest.fixture
+def rxnav():
+    def start(**kwargs):
+        fake = FakeRxNav(**kwargs)
+        server = ThreadingHTTPServer(("127.0.0.1", 0), fake.handler())
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return fake, f"http://127.0.0.1:{server.server_port}/REST"
+
+    servers = []
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def resolve(base_url, cache, terms):
+    return run_async(RxNavClient(base_url, cache=cache, concurrency=4, rate=200).resolve_terms(terms))
+
+
+def test_cache_hits_skip_the_network(rxnav, tmp_path):
+    fake, base_url = rxnav()
+    cache = RxNormCache(str(tmp_path / "rxnorm.sqlite"))
+    terms = ["oxycodone", "oxycontin", "hydrocodone"]
+
+    assert resolve(base_url, cache, terms) == {"oxycodone": "oxycodone", "oxycontin": "oxycodone",
+                                               "hydrocodone": "hydrocodone"}
+    # Two terms share rxcui 7804: its name is fetched once
+    assert fake.requests["/REST/rxcui/7804/properties.json"] == 1
+    sent = sum(fake.requests.values())
+
+    assert resolve(base_url, cache, terms)["oxycontin"] == "oxycodone"
+    assert sum(fake.requests.values()) == sent
+    assert cache.hits >= len(terms)
+
+
+def test_negative_results_are_cached(rxnav, tmp_path):
+    fake, base_url = rxnav()
+    cache = RxNormCache(str(tmp_path / "rxnorm.sqlite"))
+
+    assert resolve(base_url, cache, ["notadrug"]) == {}
+    assert cache.get_rxcui("notadrug") is None # cached miss, not MISS
+    assert resolve(base_url, cache, ["notadrug"]) == {}
+    assert fake.requests["/REST/approximateTerm.json"] == 1
+
+
+def test_expired_entries_are_fetched_again(rxnav, tmp_path):
+    fake, base_url = rxnav()
+    path = str(tmp_path / "rxnorm.sqlite")
+    cache = RxNormCache(path)
+    resolve(base_url, cache, ["hydrocodone"])
+    cache.close()
+
+    expired = RxNormCache(path, ttl_seconds=0)
+    assert expired.get_rxcui("hydrocodone") is MISS
+    assert resolve(base_url, expired, ["hydrocodone"]) == {"hydrocodone": "hydrocodone"}
+    assert fake.requests["/REST/approximateTerm.json"] == 2
+
+
+def test_throttled_requests_are_retried(rxnav):
+    fake, base_url = rxnav(throttle_first=2)
+    client = RxNavClient(base_url, concurrency=1, rate=200)
+
+    assert run_async(client.resolve_terms(["oxycodone"])) == {"oxycodone": "oxycodone"}
+    assert client.errors == 0
+    assert client.requests == 4 # two 429s, then approximateTerm and properties
+
+
+def test_terms_are_resolved_concurrently_up_to_the_pool_size(rxnav):
+    fake, base_url = rxnav(delay=0.1)
+    client = RxNavClient(base_url, concurrency=4, rate=1000)
+
+    start = time.monotonic()
+    assert run_async(client.resolve_terms([f"term{i}" for i in range(20)])) == {}
+    elapsed = time.monotonic() - start
+
+    assert fake.requests["/REST/approximateTerm.json"] == 20
+    assert 2 <= fake.peak <= 4
+    assert elapsed < 20 * 0.1 # faster than one request at a time
+
+
+def test_requests_are_rate_limited(rxnav):
+    fake, base_url = rxnav()
+    client = RxNavClient(base_url, concurrency=8, rate=20)
+
+    start = time.monotonic()
+    run_async(client.resolve_terms([f"term{i}" for i in range(21)]))
+
+    # a bucket of one token refilled at 20/s: the other 20 requests need ~1s
+    assert time.monotonic() - start >= 0.9
+    assert client.requests == 21